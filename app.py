@@ -14,9 +14,15 @@ from reportlab.pdfbase.ttfonts import TTFont
 import base64
 import warnings
 import json
+import hashlib
+import contextlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import date
 import pymongo
 import pandas as pd
+import numpy as np
 import plotly.graph_objects as go
 
 # Suppress the ScriptRunContext warnings
@@ -29,16 +35,44 @@ st.set_page_config(
     layout="wide"
 )
 
+# Seconds between MongoDB health checks (shared by all sessions of the server process)
+MONGO_HEALTH_CHECK_TTL = 60
+
+@st.cache_resource(show_spinner=False)
+def get_mongo_client(connection_string, max_pool_size=20, min_pool_size=0,
+                     server_selection_timeout_ms=5000, connect_timeout_ms=10000, socket_timeout_ms=30000):
+    """Create the MongoClient shared by every session of this server process.
+
+    MongoClient is thread-safe and keeps its own connection pool, so all terminals
+    reuse the same bounded pool instead of opening one per browser session.
+    """
+    return pymongo.MongoClient(
+        connection_string,
+        maxPoolSize=max_pool_size,
+        minPoolSize=min_pool_size,
+        serverSelectionTimeoutMS=server_selection_timeout_ms,
+        connectTimeoutMS=connect_timeout_ms,
+        socketTimeoutMS=socket_timeout_ms,
+    )
+
 def init_mongodb_client():
     """Initialize MongoDB client using Streamlit secrets"""
     try:
         if "mongodb" in st.secrets:
             # Get connection details from secrets
-            connection_string = st.secrets["mongodb"]["connection_string"]
-            database_name = st.secrets["mongodb"]["database"]
-            
-            # Create MongoDB client
-            client = pymongo.MongoClient(connection_string)
+            mongo_secrets = st.secrets["mongodb"]
+            connection_string = mongo_secrets["connection_string"]
+            database_name = mongo_secrets["database"]
+            
+            # Get (or lazily create) the shared MongoDB client
+            client = get_mongo_client(
+                connection_string,
+                max_pool_size=int(mongo_secrets.get("max_pool_size", 20)),
+                min_pool_size=int(mongo_secrets.get("min_pool_size", 0)),
+                server_selection_timeout_ms=int(mongo_secrets.get("server_selection_timeout_ms", 5000)),
+                connect_timeout_ms=int(mongo_secrets.get("connect_timeout_ms", 10000)),
+                socket_timeout_ms=int(mongo_secrets.get("socket_timeout_ms", 30000)),
+            )
             db = client[database_name]
             
             # Store in session state
@@ -58,36 +92,451 @@ def init_mongodb_client():
             st.sidebar.error(f"Error initializing MongoDB: {str(e)}")
         return None, None
 
+@st.cache_data(ttl=MONGO_HEALTH_CHECK_TTL, show_spinner=False)
+def _ping_mongodb(_client, database_name):
+    """Ping the server; successful results are cached for MONGO_HEALTH_CHECK_TTL seconds"""
+    _client.admin.command('ping')
+    return True
+
+# Primary key of each MongoDB collection. Saves only send the rows that changed
+# since the last persisted state; collections without a natural key
+# (material_costs, labor_costs, marketing_costs) are diffed on full row content.
+COLLECTION_KEYS = {
+    'products': ['product_id'],
+    'materials': ['material_id'],
+    'recipes': ['product_id', 'material_id'],
+    'orders': ['order_id'],
+    'order_items': ['order_id', 'product_id'],
+    'invoices': ['invoice_id'],
+    'invoice_status': ['invoice_id'],
+    'income': ['date'],
+    'product_costs': ['product_id'],
+    'family_expenses': ['transaction_id'],
+    'expense_categories': ['category_id'],
+    'expected_transactions': ['transaction_id'],
+    'preparations': ['prep_id'],
+    'preparation_items': ['prep_id', 'component_id'],
+    'stock_movements': ['movement_id', 'material_id'],
+    'stock_snapshots': ['ts', 'material_id'],
+    'settings': ['key'],
+    'sales_cube': ['date', 'product_id', 'customer', 'payment_method'],
+}
+
+# Secondary (non-unique) indexes backing lookups and date-range queries
+SECONDARY_INDEXES = {
+    'orders': [['date']],
+    'order_items': [['product_id']],
+    'recipes': [['material_id']],
+    'invoices': [['order_id'], ['date']],
+    'material_costs': [['date'], ['material_id']],
+    'labor_costs': [['date']],
+    'marketing_costs': [['date']],
+    'family_expenses': [['date']],
+    'expected_transactions': [['date']],
+    'preparation_items': [['component_id']],
+    'stock_movements': [['date'], ['ts'], ['material_id', 'ts']],
+    'stock_snapshots': [['date', 'ts']],
+}
+
+def _build_collection_indexes():
+    """Index declarations per collection: unique primary keys plus secondary indexes"""
+    indexes = {}
+    for coll_name, key_fields in COLLECTION_KEYS.items():
+        indexes.setdefault(coll_name, []).append(pymongo.IndexModel(
+            [(field, pymongo.ASCENDING) for field in key_fields],
+            name='uniq_' + '_'.join(key_fields),
+            unique=True,
+        ))
+    for coll_name, index_fields in SECONDARY_INDEXES.items():
+        for fields in index_fields:
+            indexes.setdefault(coll_name, []).append(pymongo.IndexModel(
+                [(field, pymongo.ASCENDING) for field in fields],
+                name='idx_' + '_'.join(fields),
+            ))
+    return indexes
+
+COLLECTION_INDEXES = _build_collection_indexes()
+
+@st.cache_resource(show_spinner=False)
+def ensure_indexes(_db, database_name):
+    """Create the declared indexes once per server process.
+
+    create_index is idempotent, so existing indexes are left untouched. An index that
+    cannot be built (e.g. a unique key over duplicated data) is reported, not raised.
+    Returns {collection name: [error messages]}.
+    """
+    errors = {}
+    for coll_name, models in COLLECTION_INDEXES.items():
+        for model in models:
+            try:
+                _db[coll_name].create_indexes([model])
+            except pymongo.errors.PyMongoError as e:
+                errors.setdefault(coll_name, []).append(f"{model.document['name']}: {e}")
+    return errors
+
+# Fields returned when loading documents: the MongoDB _id and the bookkeeping marker
+# written by apply_inventory_movement are not part of the tables
+LOAD_PROJECTION = {'_id': 0, 'last_movement_id': 0}
+
+def _record_fingerprint(record):
+    """Stable text fingerprint of a record, used to detect changed rows"""
+    return json.dumps(record, sort_keys=True, default=str, ensure_ascii=False)
+
+def _persisted_state(coll_name, records):
+    """Build the diff baseline of a collection from its records.
+
+    Keyed collections map primary key -> fingerprint, keyless collections map
+    fingerprint -> number of identical rows. Returns None when a keyed collection
+    contains duplicate keys, in which case it can only be rewritten as a whole.
+    """
+    key_fields = COLLECTION_KEYS.get(coll_name)
+    state = {}
+    if key_fields:
+        for record in records:
+            key = tuple(record.get(field) for field in key_fields)
+            if key in state:
+                return None
+            state[key] = _record_fingerprint(record)
+    else:
+        for record in records:
+            fingerprint = _record_fingerprint(record)
+            state[fingerprint] = state.get(fingerprint, 0) + 1
+    return state
+
+def _set_persisted_state(coll_name, state, version=None):
+    """Use state as the diff baseline of a collection for this session.
+
+    version is the shared cache version the baseline corresponds to (None if unknown,
+    e.g. after other writes this session has not seen).
+    """
+    persisted = st.session_state.setdefault('_persisted_rows', {})
+    versions = st.session_state.setdefault('_persisted_versions', {})
+    if state is None:
+        persisted.pop(coll_name, None)
+        versions.pop(coll_name, None)
+    else:
+        persisted[coll_name] = state
+        versions[coll_name] = version
+
+def _content_fingerprint(df):
+    """Cheap vectorized fingerprint of a table's content (None if it cannot be hashed)"""
+    try:
+        row_hashes = pd.util.hash_pandas_object(df, index=False)
+    except TypeError:
+        return None
+    digest = hashlib.sha1(row_hashes.values.tobytes()).hexdigest()
+    return (tuple(df.columns), tuple(str(dtype) for dtype in df.dtypes), len(df), digest)
+
+def _remember_fingerprint(coll_name, df):
+    """Record the content of df as the last version loaded from or saved to storage"""
+    st.session_state.setdefault('_table_fingerprints', {})[coll_name] = _content_fingerprint(df)
+
+def _forget_fingerprint(coll_name):
+    """Mark a table as not matching storage, so it is saved by the next save_all_data"""
+    st.session_state.setdefault('_table_fingerprints', {}).pop(coll_name, None)
+
+def is_table_dirty(name):
+    """Whether a loaded table changed since it was last loaded or saved"""
+    stored = st.session_state.get('_table_fingerprints', {}).get(name)
+    if stored is None:
+        return True
+    return _content_fingerprint(st.session_state[name]) != stored
+
+class SharedTableCache:
+    """Process-wide cache of the tables loaded from MongoDB.
+
+    Every collection has a version counter that is bumped on each write made by
+    this process. A cached frame is only served while its version is current, so
+    sessions reuse materialized tables and refetch just the collections that changed.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._tables = {}
+    
+    def version(self, coll_name):
+        with self._lock:
+            return self._versions.get(coll_name, 0)
+    
+    def is_current(self, coll_name):
+        """Whether a current frame of the collection is cached"""
+        with self._lock:
+            entry = self._tables.get(coll_name)
+            return entry is not None and entry[0] == self._versions.get(coll_name, 0)
+    
+    def get(self, coll_name):
+        """Return (df copy, diff baseline, version) if a current frame is cached, else None"""
+        with self._lock:
+            entry = self._tables.get(coll_name)
+            if entry is None or entry[0] != self._versions.get(coll_name, 0):
+                return None
+            version, df, state = entry
+        return df.copy(), state, version
+    
+    def put(self, coll_name, version, df, state):
+        """Cache a frame fetched at `version` (ignored if a write happened meanwhile)"""
+        with self._lock:
+            if version == self._versions.get(coll_name, 0):
+                self._tables[coll_name] = (version, df.copy(), state)
+    
+    def store_write(self, coll_name, df, state, base_version):
+        """Record a successful write and bump the version.
+
+        The written frame only becomes the cached version when the writer started from
+        the current version. Otherwise the collection may also hold writes the writer
+        never saw, so the cached frame is dropped and the next load reads MongoDB.
+        Returns the new version if the written frame was cached, else None.
+        """
+        with self._lock:
+            current = self._versions.get(coll_name, 0)
+            self._versions[coll_name] = current + 1
+            if base_version is not None and base_version == current:
+                self._tables[coll_name] = (current + 1, df.copy(), state)
+                return current + 1
+            self._tables.pop(coll_name, None)
+            return None
+    
+    def invalidate(self, coll_name):
+        """Bump the version of a collection changed outside the cache"""
+        with self._lock:
+            self._versions[coll_name] = self._versions.get(coll_name, 0) + 1
+            self._tables.pop(coll_name, None)
+
+@st.cache_resource(show_spinner=False)
+def get_table_cache(database_name):
+    """Shared table cache of a database"""
+    return SharedTableCache()
+
+def _table_cache():
+    """Table cache of the connected database"""
+    return get_table_cache(st.session_state.mongo_db.name)
+
+def _build_write_ops(coll_name, records, baseline):
+    """Compute the bulk write operations turning baseline into records.
+
+    Returns None when the diff cannot be expressed per row (duplicate keys).
+    """
+    key_fields = COLLECTION_KEYS.get(coll_name)
+    ops = []
+    if key_fields:
+        current = {}
+        for record in records:
+            key = tuple(record.get(field) for field in key_fields)
+            if key in current:
+                return None
+            fingerprint = _record_fingerprint(record)
+            current[key] = fingerprint
+            if baseline.get(key) != fingerprint:
+                ops.append(pymongo.ReplaceOne(dict(zip(key_fields, key)), dict(record), upsert=True))
+        for key in baseline:
+            if key not in current:
+                ops.append(pymongo.DeleteMany(dict(zip(key_fields, key))))
+    else:
+        current = {}
+        for record in records:
+            current.setdefault(_record_fingerprint(record), []).append(record)
+        for fingerprint, rows in current.items():
+            for record in rows[baseline.get(fingerprint, 0):]:
+                ops.append(pymongo.InsertOne(dict(record)))
+        for fingerprint, count in baseline.items():
+            for _ in range(count - len(current.get(fingerprint, []))):
+                ops.append(pymongo.DeleteOne(json.loads(fingerprint)))
+    return ops
+
+def _plan_collection_write(collection, coll_name, records):
+    """Operations needed to store records in a collection (None means full rewrite),
+    and the shared cache version the diff baseline corresponds to"""
+    persisted = st.session_state.setdefault('_persisted_rows', {})
+    if coll_name not in persisted:
+        # This session never loaded the collection: use the shared cache or read what is stored once
+        cached = _table_cache().get(coll_name)
+        if cached is not None:
+            _, baseline, version = cached
+        else:
+            version = _table_cache().version(coll_name)
+            baseline = _persisted_state(coll_name, list(collection.find({}, LOAD_PROJECTION)))
+    else:
+        baseline = persisted[coll_name]
+        version = st.session_state.get('_persisted_versions', {}).get(coll_name)
+    if baseline is None:
+        return None, version
+    return _build_write_ops(coll_name, records, baseline), version
+
+def _apply_collection_write(collection, records, ops, session=None):
+    """Execute the operations computed by _plan_collection_write"""
+    if ops is None:
+        # Duplicate keys: fall back to rewriting the whole collection
+        collection.delete_many({}, session=session)
+        if records:
+            collection.insert_many([dict(record) for record in records], session=session)
+    elif ops:
+        # Send only inserts/updates/deletes in a single round trip
+        result = collection.bulk_write(ops, ordered=False, session=session)
+        # Rows of keyless collections are deleted by content; a filter rebuilt from the
+        # fingerprint may not match the stored document (missing fields, non-JSON types).
+        # If any row was not deleted, rewrite the collection so it matches records.
+        expected_deletes = sum(1 for op in ops if isinstance(op, pymongo.DeleteOne))
+        if expected_deletes and result.deleted_count < expected_deletes:
+            collection.delete_many({}, session=session)
+            if records:
+                collection.insert_many([dict(record) for record in records], session=session)
+
+def _use_transactions():
+    """Whether multi-collection saves should run in a MongoDB transaction"""
+    try:
+        return bool(st.secrets["mongodb"].get("use_transactions", False))
+    except Exception:
+        return False
+
+def _use_aggregation_pushdown():
+    """Whether report aggregations should run as MongoDB pipelines (`aggregation_pushdown` in secrets)"""
+    try:
+        return bool(st.secrets["mongodb"].get("aggregation_pushdown", False))
+    except Exception:
+        return False
+
+def _persist_collections(frames, appends=()):
+    """Write several dataframes ({collection name: df}) to MongoDB together.
+
+    All write operations are computed first and then executed back to back, inside
+    a multi-document transaction when `use_transactions` is enabled in secrets.
+    appends: (collection name, new rows) of append-only tables (see _append_rows), inserted
+    first; without a transaction they are deleted again if a later write fails.
+    """
+    db = st.session_state.mongo_db
+    persisted = st.session_state.setdefault('_persisted_rows', {})
+    plans = []
+    base_versions = {}
+    durations = {}
+    for coll_name, df in frames.items():
+        start = time.perf_counter()
+        records = df.to_dict(orient='records')
+        collection = db[coll_name]
+        ops, base_version = _plan_collection_write(collection, coll_name, records)
+        plans.append((coll_name, collection, records, ops))
+        base_versions[coll_name] = base_version
+        durations[coll_name] = time.perf_counter() - start
+    
+    write_durations = {}
+    inserted = []
+    def write_all(session=None):
+        inserted.clear()
+        for coll_name, new_rows in appends:
+            inserted.append((coll_name, _insert_appended(coll_name, new_rows, session=session)))
+        for coll_name, collection, records, ops in plans:
+            start = time.perf_counter()
+            _apply_collection_write(collection, records, ops, session=session)
+            write_durations[coll_name] = time.perf_counter() - start
+    
+    in_transaction = _use_transactions() and sum(1 for plan in plans if plan[3] != []) + len(appends) > 1
+    try:
+        if in_transaction:
+            with st.session_state.mongo_client.start_session() as session:
+                session.with_transaction(write_all)
+        else:
+            write_all()
+    except Exception:
+        if not in_transaction:
+            for coll_name, ids in inserted:
+                db[coll_name].delete_many({'_id': {'$in': ids}})
+        # Part of the writes may have been applied, so the baselines are unknown
+        for coll_name in list(frames) + [coll_name for coll_name, _ in appends]:
+            persisted.pop(coll_name, None)
+            _table_cache().invalidate(coll_name)
+        raise
+    
+    for coll_name, new_rows in appends:
+        _keep_appended(coll_name, new_rows)
+    save_report = st.session_state.setdefault('_save_report', {})
+    for coll_name, collection, records, ops in plans:
+        # Record the written frame as this session's baseline; it is only shared with
+        # other sessions if no other write happened since this session's baseline
+        state = _persisted_state(coll_name, records)
+        version = _table_cache().store_write(coll_name, frames[coll_name], state, base_versions[coll_name])
+        _set_persisted_state(coll_name, state, version)
+        _remember_fingerprint(coll_name, frames[coll_name])
+        save_report[coll_name] = {
+            'changes': len(records) if ops is None else len(ops),
+            'ms': (durations[coll_name] + write_durations.get(coll_name, 0)) * 1000,
+        }
+        if show_debug:
+            if ops is None:
+                st.sidebar.write(f"Saved {len(records)} rows to MongoDB: {coll_name} (full rewrite)")
+            else:
+                st.sidebar.write(f"Saved {len(ops)} changed rows to MongoDB: {coll_name}")
+
+class SaveError(Exception):
+    """A unit of work could not be written to MongoDB"""
+
+def _flush_save_batch(frames, appends=None):
+    """Persist the dataframes and appended rows collected by a unit of work (raises SaveError if the write fails)"""
+    if not (frames or appends) or "mongo_client" not in st.session_state or "mongo_db" not in st.session_state:
+        return
+    try:
+        _persist_collections(frames or {}, appends or ())
+    except Exception as e:
+        names = ", ".join(list(frames or {}) + [name for name, _ in appends or ()])
+        print(f"Error saving {names}: {e}")
+        raise SaveError(f"Failed to save {names}: {e}") from e
+
+@contextlib.contextmanager
+def unit_of_work():
+    """Collect save_dataframe calls and write them together when the block ends.
+
+    The batch is committed when the block exits normally or through st.rerun()/st.stop(),
+    and discarded (nothing is written to MongoDB) when it raises any other error.
+    Rows appended to the stock ledger inside the block are written together with the batch.
+    If the write fails, SaveError is raised (in place of a pending rerun/stop), so code
+    after the block, such as success messages, does not run. Nested blocks join the outermost one.
+    """
+    if st.session_state.get('_save_batch') is not None:
+        yield
+        return
+    
+    st.session_state._save_batch = {}
+    st.session_state._append_batch = []
+    try:
+        yield
+    except BaseException as e:
+        pending = st.session_state.pop('_save_batch', None)
+        pending_appends = st.session_state.pop('_append_batch', None)
+        # Streamlit's rerun/stop are control flow, not failures
+        if type(e).__name__ in ('RerunException', 'StopException'):
+            _flush_save_batch(pending, pending_appends)
+        raise
+    else:
+        _flush_save_batch(st.session_state.pop('_save_batch', None), st.session_state.pop('_append_batch', None))
+
+def table_writes(name):
+    """Number of times a table was saved in this session (changes whenever it may have been edited)"""
+    return st.session_state.get('_table_writes', {}).get(name, 0)
+
 def save_dataframe(df, collection_name):
     """Save a dataframe to MongoDB or session state"""
     try:
+        # Get collection name (remove .csv extension)
+        key = collection_name.replace('.csv', '')
+        writes = st.session_state.setdefault('_table_writes', {})
+        writes[key] = writes.get(key, 0) + 1
+        
+        # Inside a unit of work the write is deferred until the block ends
+        batch = st.session_state.get('_save_batch')
+        if batch is not None:
+            batch[key] = df
+            st.session_state[key] = df
+            return True
+        
         # Try to save to MongoDB if client is available
         if "mongo_client" in st.session_state and "mongo_db" in st.session_state:
-            db = st.session_state.mongo_db
-            
-            # Convert dataframe to records
-            records = df.to_dict(orient='records')
-            
-            # Get collection name (remove .csv extension)
-            coll_name = collection_name.replace('.csv', '')
-            collection = db[coll_name]
-            
-            # Delete existing documents and insert new ones
-            collection.delete_many({})
-            if records:
-                collection.insert_many(records)
-            
-            if show_debug:
-                st.sidebar.write(f"Saved {len(records)} rows to MongoDB: {coll_name}")
+            _persist_collections({key: df})
             
             # Also save to session state as backup
-            key = collection_name.replace('.csv', '')
             st.session_state[key] = df
             
             return True
         else:
             # Save to session state only
-            key = collection_name.replace('.csv', '')
             st.session_state[key] = df
             
             if show_debug:
@@ -117,20 +566,34 @@ def load_dataframe(collection_name, default_df):
             coll_name = collection_name.replace('.csv', '')
             
             try:
-                # Try to get data from MongoDB
-                collection = db[coll_name]
-                data = list(collection.find({}, {'_id': 0}))  # Exclude MongoDB _id field
+                # Reuse the frame materialized by another session if it is still current
+                table_cache = _table_cache()
+                cached = table_cache.get(coll_name)
+                if cached is not None:
+                    df, state, version = cached
+                    source = "shared cache"
+                else:
+                    # Try to get data from MongoDB
+                    version = table_cache.version(coll_name)
+                    collection = db[coll_name]
+                    data = list(collection.find({}, LOAD_PROJECTION))  # Exclude MongoDB _id field
+                    df = _frame_from_documents(coll_name, data)
+                    state = _persisted_state(coll_name, df.to_dict(orient='records'))
+                    table_cache.put(coll_name, version, df, state)
+                    source = "MongoDB"
+                
+                # Remember what is stored so later saves only send changes
+                _set_persisted_state(coll_name, state, version)
                 
-                if data:
-                    # Convert to DataFrame
-                    df = pd.DataFrame(data)
+                if len(df) > 0:
+                    _remember_fingerprint(coll_name, df)
                     
                     # Save to session state as a backup
                     key = collection_name.replace('.csv', '')
                     st.session_state[key] = df
                     
                     if show_debug:
-                        st.sidebar.write(f"Loaded {len(df)} rows from MongoDB: {coll_name}")
+                        st.sidebar.write(f"Loaded {len(df)} rows from {source}: {coll_name}")
                     
                     return df
                 else:
@@ -143,6 +606,8 @@ def load_dataframe(collection_name, default_df):
                     if key in st.session_state:
                         df = st.session_state[key]
                         if len(df) > 0:
+                            # These rows are not stored in MongoDB
+                            _forget_fingerprint(coll_name)
                             if show_debug:
                                 st.sidebar.write(f"Loaded {len(df)} rows from session state: {key}")
                             return df
@@ -151,7 +616,13 @@ def load_dataframe(collection_name, default_df):
                     if show_debug:
                         st.sidebar.write(f"No data found in session state, using default")
                     
-                    return default_df.copy()
+                    df = default_df.copy()
+                    if df.empty:
+                        # An empty table matches the empty collection: nothing to save yet
+                        _remember_fingerprint(coll_name, df)
+                    else:
+                        _forget_fingerprint(coll_name)
+                    return df
             except Exception as e:
                 # Handle MongoDB errors
                 if show_debug:
@@ -212,8 +683,8 @@ def ensure_mongodb_connection():
             mongo_client = st.session_state.mongo_client
             mongo_db = st.session_state.mongo_db
             
-            # Check if connection is alive
-            info = mongo_client.server_info()
+            # Check if connection is alive (at most once per MONGO_HEALTH_CHECK_TTL seconds)
+            _ping_mongodb(mongo_client, mongo_db.name)
             
             if show_debug:
                 st.sidebar.write(f"MongoDB database is accessible: {mongo_db.name}")
@@ -226,7 +697,13 @@ def ensure_mongodb_connection():
     return False
 
 # Call this function after initialization
-ensure_mongodb_connection()
+if ensure_mongodb_connection():
+    # Create the declared indexes (once per server process)
+    index_errors = ensure_indexes(st.session_state.mongo_db, st.session_state.mongo_db.name)
+    if show_debug:
+        for coll_name, messages in index_errors.items():
+            for message in messages:
+                st.sidebar.warning(f"Index not created on {coll_name}: {message}")
 
 
 # Default dataframes (will be used if files don't exist)
@@ -254,8 +731,9 @@ default_invoices = pd.DataFrame(columns=[
     'invoice_id', 'order_id', 'date', 'customer_name', 'total_amount', 'payment_method'
 ])
 
+# Daily revenue, derived from the orders that have an invoice (see compute_income_rows)
 default_income = pd.DataFrame(columns=[
-    'date', 'total_sales', 'cost_of_goods', 'profit', 'other_costs', 'depreciation_costs', 'material_import_costs'
+    'date', 'total_sales', 'cost_of_goods', 'profit', 'other_costs', 'depreciation_costs', 'discount_costs'
 ])
 
 default_material_costs = pd.DataFrame(columns=[
@@ -282,45 +760,404 @@ default_expected_transactions = pd.DataFrame(columns=[
     'transaction_id', 'date', 'category', 'description', 'amount', 'payment_method', 'type', 'is_completed'
 ])
 
-# Load data from files or use defaults
-if 'products' not in st.session_state:
-    st.session_state.products = load_dataframe("products.csv", default_products)
+# Intermediate preparations (sponge base, buttercream, ...) usable in recipes in place of a material.
+# A batch of yield_quantity units is made from the components listed in preparation_items,
+# each component being a material or another preparation.
+default_preparations = pd.DataFrame(columns=[
+    'prep_id', 'name', 'unit', 'yield_quantity'
+])
+
+default_preparation_items = pd.DataFrame(columns=[
+    'prep_id', 'component_id', 'quantity'
+])
+
+# Append-only stock ledger: one row per material per movement (delta > 0 into stock).
+# ts is 'YYYY-MM-DD HH:MM:SS.ffffff' so it sorts as a string, date is its first 10 characters.
+default_stock_movements = pd.DataFrame(columns=[
+    'movement_id', 'ts', 'date', 'material_id', 'delta', 'kind', 'ref'
+])
+
+# Stock of every material as of ts (all movements up to and including ts)
+default_stock_snapshots = pd.DataFrame(columns=[
+    'ts', 'date', 'material_id', 'quantity'
+])
+
+default_product_costs = pd.DataFrame(columns=[
+    'product_id', 'material_cost', 'production_fee', 'other_fee', 'Depreciation_fee', 'total_cost', 'price'
+])
+
+default_marketing_costs = pd.DataFrame(columns=[
+    'date', 'campaign_name', 'description', 'platform', 'amount', 'notes'
+])
+
+# Shop-wide settings shared by every terminal, one row per key
+default_settings = pd.DataFrame(columns=[
+    'key', 'value'
+])
+
+# Sales cube: invoiced order lines summed per day, product, customer and payment method.
+# Kept up to date with the orders of each day like income; product categories are joined when queried.
+default_sales_cube = pd.DataFrame(columns=[
+    'date', 'product_id', 'customer', 'payment_method', 'revenue', 'quantity', 'lines'
+])
+
+# Default dataframe of every table, keyed by collection name
+TABLE_DEFAULTS = {
+    'products': default_products,
+    'materials': default_materials,
+    'recipes': default_recipes,
+    'orders': default_orders,
+    'order_items': default_order_items,
+    'invoices': default_invoices,
+    'income': default_income,
+    'material_costs': default_material_costs,
+    'invoice_status': default_invoice_status,
+    'labor_costs': default_labor_costs,
+    'family_expenses': default_expenses,
+    'expense_categories': default_expense_categories,
+    'expected_transactions': default_expected_transactions,
+    'product_costs': default_product_costs,
+    'marketing_costs': default_marketing_costs,
+    'preparations': default_preparations,
+    'preparation_items': default_preparation_items,
+    'stock_movements': default_stock_movements,
+    'stock_snapshots': default_stock_snapshots,
+    'settings': default_settings,
+    'sales_cube': default_sales_cube,
+}
+
+# Column dtypes applied when a table is loaded (columns not listed keep the inferred dtype):
+#   'integer'  int64 when every value is a whole number, otherwise float64 (VND amounts, counts)
+#   'number'   float64 (stock quantities and amounts computed with fractions)
+#   'flag'     bool when the column holds only True/False
+#   'date'     canonical 'YYYY-MM-DD' strings, the format every filter and lookup compares against
+#   'label'    categorical, only for columns that are never edited in place with new values
+TABLE_SCHEMAS = {
+    'products': {'price': 'integer'},
+    'materials': {
+        'quantity': 'number', 'price_per_unit': 'number', 'used_quantity': 'number', 'lead_time_days': 'number',
+        'consumed_quantity': 'number', 'unit': 'label',
+    },
+    'recipes': {'quantity': 'number'},
+    'orders': {
+        'date': 'date', 'total_amount': 'integer', 'shipping_fee': 'integer', 'discount_amount': 'integer',
+        'material_cost': 'number', 'other_fee': 'number', 'Depreciation_fee': 'number', 'status': 'label',
+    },
+    'order_items': {'quantity': 'integer', 'price': 'integer', 'subtotal': 'integer'},
+    'invoices': {'date': 'date', 'total_amount': 'integer'},
+    'income': {
+        'date': 'date', 'total_sales': 'number', 'cost_of_goods': 'number', 'profit': 'number',
+        'other_costs': 'number', 'depreciation_costs': 'number', 'material_import_costs': 'number',
+        'discount_costs': 'number',
+    },
+    'material_costs': {'date': 'date', 'quantity': 'number', 'total_cost': 'number'},
+    'invoice_status': {'is_completed': 'flag'},
+    'labor_costs': {'date': 'date', 'hours': 'number', 'unit_rate': 'integer', 'total_cost': 'number'},
+    'family_expenses': {'date': 'date', 'amount': 'integer', 'type': 'label'},
+    'expense_categories': {'type': 'label'},
+    'expected_transactions': {'date': 'date', 'amount': 'integer', 'type': 'label', 'is_completed': 'flag'},
+    'product_costs': {
+        'material_cost': 'number', 'production_fee': 'number', 'other_fee': 'number',
+        'Depreciation_fee': 'number', 'total_cost': 'number', 'price': 'integer',
+    },
+    'marketing_costs': {'date': 'date', 'amount': 'integer'},
+    'preparations': {'yield_quantity': 'number'},
+    'preparation_items': {'quantity': 'number'},
+    'stock_movements': {'date': 'date', 'delta': 'number', 'kind': 'label'},
+    'stock_snapshots': {'date': 'date', 'quantity': 'number'},
+    'sales_cube': {'date': 'date', 'revenue': 'number', 'quantity': 'number', 'lines': 'integer'},
+}
+
+def _coerce_column(series, kind):
+    """Convert a column to the dtype of its schema kind, leaving it unchanged if that would lose data"""
+    if kind in ('integer', 'number'):
+        values = pd.to_numeric(series, errors='coerce')
+        if values.isna().sum() > series.isna().sum():
+            # Some values are not numbers: keep the column as it is
+            return series
+        if kind == 'integer' and values.notna().all() and (values % 1 == 0).all():
+            return values.astype('int64')
+        return values.astype('float64')
+    if kind == 'flag':
+        if series.isna().any() or not series.isin([True, False]).all():
+            return series
+        return series.astype(bool)
+    if kind == 'date':
+        return series.map(lambda value: value.strftime('%Y-%m-%d') if hasattr(value, 'strftime') else value)
+    if kind == 'label':
+        return series.astype('category')
+    return series
+
+def apply_table_schema(name, df):
+    """Coerce the columns of a loaded table to the compact dtypes declared in TABLE_SCHEMAS"""
+    for column, kind in TABLE_SCHEMAS.get(name, {}).items():
+        if column in df.columns:
+            df[column] = _coerce_column(df[column], kind)
+    return df
+
+def _frame_from_documents(name, data):
+    """Build a typed DataFrame from MongoDB documents"""
+    return apply_table_schema(name, pd.DataFrame(data))
+
+# Tables used by each sidebar section (including the helper functions it calls).
+# They are loaded the first time the section is opened, not at startup.
+PAGE_TABLES = {
+    "Quản lý Đơn hàng": ['products', 'materials', 'material_costs', 'recipes', 'preparations', 'preparation_items', 'orders', 'order_items', 'invoices', 'income', 'product_costs', 'settings', 'sales_cube'],
+    # Income, the sales cube and the material, labor and marketing costs are read through query_dataframe /
+    # aggregate_dataframe for the selected period only (and loaded in full only to edit them)
+    "Theo dõi Doanh thu": ['materials'],
+    "Kho Nguyên liệu": ['materials', 'material_costs', 'products', 'recipes', 'preparations', 'preparation_items', 'orders', 'order_items', 'product_costs', 'settings'],
+    "Quản lý Sản phẩm": ['products', 'materials', 'recipes', 'preparations', 'preparation_items', 'order_items', 'product_costs'],
+    "Quản lý Hóa đơn": ['invoices', 'invoice_status', 'orders', 'order_items', 'products', 'materials', 'recipes', 'preparations', 'preparation_items', 'income', 'product_costs', 'sales_cube'],
+    "Quản lý Dữ liệu": list(TABLE_DEFAULTS),
+    "Quản lý chi tiêu gia đình": ['family_expenses', 'expense_categories', 'expected_transactions'],
+}
+
+def get_table(name):
+    """Return a table from session state, loading it on first access"""
+    if name not in st.session_state:
+        st.session_state[name] = load_dataframe(f"{name}.csv", TABLE_DEFAULTS[name])
+    return st.session_state[name]
 
-if 'materials' not in st.session_state:
-    st.session_state.materials = load_dataframe("materials.csv", default_materials)
+def _date_key(value):
+    """Normalize a date bound to the 'YYYY-MM-DD' string format used in the tables"""
+    if value is None or isinstance(value, str):
+        return value
+    return value.strftime('%Y-%m-%d')
 
-if 'recipes' not in st.session_state:
-    st.session_state.recipes = load_dataframe("recipes.csv", default_recipes)
+def query_dataframe(name, start_date=None, end_date=None, fields=None, filters=None, date_field='date'):
+    """Return the rows of a table within an inclusive date range that match equality filters.
 
-if 'orders' not in st.session_state:
-    st.session_state.orders = load_dataframe("orders.csv", default_orders)
+    A table already loaded in this session is filtered in memory. Otherwise the date
+    range, the equality filters and the field projection are pushed down to MongoDB,
+    so only the requested window is transferred and nothing is kept in session state.
+    """
+    start_date, end_date = _date_key(start_date), _date_key(end_date)
+    filters = filters or {}
+    
+    if name not in st.session_state and "mongo_client" in st.session_state and "mongo_db" in st.session_state:
+        query = dict(filters)
+        date_range = {}
+        if start_date is not None:
+            date_range['$gte'] = start_date
+        if end_date is not None:
+            date_range['$lte'] = end_date
+        if date_range:
+            query[date_field] = date_range
+        
+        if fields:
+            projection = {'_id': 0}
+            projection.update({field: 1 for field in fields})
+        else:
+            projection = dict(LOAD_PROJECTION)
+        
+        try:
+            data = list(st.session_state.mongo_db[name].find(query, projection))
+            if data:
+                return _frame_from_documents(name, data)
+            columns = fields or list(TABLE_DEFAULTS[name].columns)
+            return pd.DataFrame(columns=columns)
+        except Exception as e:
+            if show_debug:
+                st.sidebar.error(f"Error querying {name}: {str(e)}")
+    
+    # Filter the in-memory table
+    df = get_table(name)
+    mask = pd.Series(True, index=df.index)
+    if date_field in df.columns:
+        if start_date is not None:
+            mask &= df[date_field] >= start_date
+        if end_date is not None:
+            mask &= df[date_field] <= end_date
+    for field, value in filters.items():
+        if field in df.columns:
+            mask &= df[field] == value
+    result = df[mask]
+    if fields:
+        result = result[[field for field in fields if field in result.columns]]
+    return result.copy()
 
-if 'order_items' not in st.session_state:
-    st.session_state.order_items = load_dataframe("order_items.csv", default_order_items)
+def _aggregates_on_server(name):
+    """Whether an aggregation over a table runs in MongoDB: pushdown is enabled, the database is
+    connected and the session holds no unsaved changes to the table"""
+    if not _use_aggregation_pushdown():
+        return False
+    if "mongo_client" not in st.session_state or "mongo_db" not in st.session_state:
+        return False
+    return name not in st.session_state or not is_table_dirty(name)
 
-if 'invoices' not in st.session_state:
-    st.session_state.invoices = load_dataframe("invoices.csv", default_invoices)
+def aggregate_dataframe(name, group_by, measures, start_date=None, end_date=None, filters=None, date_field='date'):
+    """Sum numeric fields per group over the rows of a table within an inclusive date range.
 
-if 'income' not in st.session_state:
-    st.session_state.income = load_dataframe("income.csv", default_income)
+    With aggregation pushdown the work is compiled into a MongoDB pipeline ($match on the
+    indexed date field and the equality filters, $group, $project), so only the aggregated
+    rows are transferred. Otherwise, or if the pipeline fails, the rows are read with
+    query_dataframe and grouped in pandas. Rows whose group values are missing are dropped.
+    Returns a DataFrame with the group_by columns, the measures and a row `count`
+    (a single row of totals when group_by is empty).
+    """
+    group_by, measures = list(group_by), list(measures)
+    start_date, end_date = _date_key(start_date), _date_key(end_date)
+    filters = filters or {}
+    columns = group_by + measures + ['count']
+    result = None
+    
+    if _aggregates_on_server(name):
+        match = dict(filters)
+        date_range = {}
+        if start_date is not None:
+            date_range['$gte'] = start_date
+        if end_date is not None:
+            date_range['$lte'] = end_date
+        if date_range:
+            match[date_field] = date_range
+        
+        group = {'_id': {field: f'${field}' for field in group_by} if group_by else None, 'count': {'$sum': 1}}
+        for measure in measures:
+            # Non-numeric values count as 0, like pd.to_numeric(errors='coerce') in the pandas path
+            group[measure] = {'$sum': {'$convert': {'input': f'${measure}', 'to': 'double', 'onError': 0, 'onNull': 0}}}
+        project = {'_id': 0, 'count': 1}
+        project.update({measure: 1 for measure in measures})
+        project.update({field: f'$_id.{field}' for field in group_by})
+        pipeline = ([{'$match': match}] if match else []) + [{'$group': group}, {'$project': project}]
+        
+        try:
+            data = list(st.session_state.mongo_db[name].aggregate(pipeline))
+            result = pd.DataFrame(data, columns=columns)
+        except Exception as e:
+            if show_debug:
+                st.sidebar.error(f"Error aggregating {name}: {str(e)}")
+    
+    if result is None:
+        df = query_dataframe(name, start_date, end_date, fields=list(dict.fromkeys(group_by + measures)),
+                             filters=filters, date_field=date_field)
+        values = df.reindex(columns=measures).apply(pd.to_numeric, errors='coerce').fillna(0)
+        values['count'] = 1
+        if group_by:
+            keys = df.reindex(columns=group_by)
+            result = values.groupby([keys[field] for field in group_by]).sum().reset_index()
+        else:
+            result = values.sum().to_frame().T
+    
+    if not group_by:
+        if result.empty:
+            return pd.DataFrame([[0.0] * len(measures) + [0]], columns=columns)
+        return result[columns]
+    return result.dropna(subset=group_by).sort_values(group_by)[columns].reset_index(drop=True)
 
-if 'material_costs' not in st.session_state:
-    st.session_state.material_costs = load_dataframe("material_costs.csv", default_material_costs)
+def get_date_bounds(name, date_field='date'):
+    """First and last date of a table as strings, or (None, None) if it has no rows"""
+    if name not in st.session_state and "mongo_client" in st.session_state and "mongo_db" in st.session_state:
+        try:
+            collection = st.session_state.mongo_db[name]
+            query = {date_field: {'$type': 'string'}}
+            projection = {date_field: 1, '_id': 0}
+            first = list(collection.find(query, projection).sort(date_field, 1).limit(1))
+            last = list(collection.find(query, projection).sort(date_field, -1).limit(1))
+            if not first:
+                return None, None
+            return first[0][date_field], last[0][date_field]
+        except Exception as e:
+            if show_debug:
+                st.sidebar.error(f"Error reading date range of {name}: {str(e)}")
+    
+    df = get_table(name)
+    if df.empty or date_field not in df.columns:
+        return None, None
+    dates = df[date_field].dropna()
+    if dates.empty:
+        return None, None
+    return dates.min(), dates.max()
 
-if 'invoice_status' not in st.session_state:
-    st.session_state.invoice_status = load_dataframe("invoice_status.csv", default_invoice_status)
+def delete_matching_row(name, row):
+    """Delete the first row of a table whose values equal row (e.g. a row read with
+    query_dataframe) and save the table. Returns False if no such row exists anymore."""
+    df = get_table(name)
+    matches = pd.Series(True, index=df.index)
+    for column, value in row.items():
+        if column not in df.columns:
+            continue
+        if pd.isna(value):
+            matches &= df[column].isna()
+        else:
+            matches &= df[column] == value
+    if not matches.any():
+        return False
+    st.session_state[name] = df.drop(matches.idxmax()).reset_index(drop=True)
+    save_dataframe(st.session_state[name], f"{name}.csv")
+    return True
 
-if 'labor_costs' not in st.session_state:
-    st.session_state.labor_costs = load_dataframe("labor_costs.csv", default_labor_costs)
+# Maximum number of collections fetched at the same time
+LOAD_WORKERS = 8
 
-if 'family_expenses' not in st.session_state:
-    st.session_state.family_expenses = load_dataframe("family_expenses.csv", default_expenses)
+def _fetch_collection(collection):
+    """Fetch all documents of a collection (runs in a worker thread, no Streamlit calls)"""
+    start = time.perf_counter()
+    data = list(collection.find({}, LOAD_PROJECTION))
+    return data, time.perf_counter() - start
 
-if 'expense_categories' not in st.session_state:
-    st.session_state.expense_categories = load_dataframe("expense_categories.csv", default_expense_categories)
+def ensure_tables_loaded(names):
+    """Load the given tables that this session has not loaded yet.
 
-if 'expected_transactions' not in st.session_state:
-    st.session_state.expected_transactions = load_dataframe("expected_transactions.csv", default_expected_transactions)
+    Collections missing from the shared table cache are fetched concurrently on a
+    thread pool and materialized into the cache as they arrive; get_table() then
+    serves every table from the cache.
+    """
+    pending = [name for name in names if name not in st.session_state]
+    if not pending:
+        return
+    
+    timings = {}
+    if "mongo_client" in st.session_state and "mongo_db" in st.session_state:
+        db = st.session_state.mongo_db
+        table_cache = _table_cache()
+        to_fetch = [name for name in pending if not table_cache.is_current(name)]
+        
+        if to_fetch:
+            with ThreadPoolExecutor(max_workers=min(LOAD_WORKERS, len(to_fetch))) as executor:
+                futures = {
+                    executor.submit(_fetch_collection, db[name]): (name, table_cache.version(name))
+                    for name in to_fetch
+                }
+                for future in as_completed(futures):
+                    name, version = futures[future]
+                    try:
+                        data, fetch_seconds = future.result()
+                    except Exception as e:
+                        # load_dataframe retries the collection and reports the error
+                        if show_debug:
+                            st.sidebar.error(f"Error fetching {name}: {str(e)}")
+                        continue
+                    
+                    start = time.perf_counter()
+                    df = _frame_from_documents(name, data)
+                    table_cache.put(name, version, df, _persisted_state(name, df.to_dict(orient='records')))
+                    timings[name] = {
+                        'rows': len(df),
+                        'fetch_ms': fetch_seconds * 1000,
+                        'build_ms': (time.perf_counter() - start) * 1000,
+                    }
+    
+    for name in pending:
+        if name not in timings:
+            start = time.perf_counter()
+            get_table(name)
+            timings[name] = {
+                'rows': len(st.session_state[name]),
+                'fetch_ms': 0.0,
+                'build_ms': (time.perf_counter() - start) * 1000,
+            }
+        else:
+            get_table(name)
+    st.session_state.setdefault('_load_timings', {}).update(timings)
+    
+    if show_debug:
+        st.sidebar.write("### Load Timings")
+        for name in pending:
+            timing = timings[name]
+            st.sidebar.write(
+                f"{name}: {timing['rows']} rows, fetch {timing['fetch_ms']:.0f} ms, build {timing['build_ms']:.0f} ms"
+            )
 
 # Function to ensure we have Unicode support for Vietnamese
 def setup_vietnamese_font():
@@ -353,79 +1190,1304 @@ def setup_vietnamese_font():
         # Fall back to Helvetica
         return 'Helvetica'
 
-def save_all_data():
-    """Save all dataframes to CSV files"""
-    save_dataframe(st.session_state.products, "products.csv")
-    save_dataframe(st.session_state.materials, "materials.csv")
-    save_dataframe(st.session_state.recipes, "recipes.csv")
-    save_dataframe(st.session_state.orders, "orders.csv")
-    save_dataframe(st.session_state.order_items, "order_items.csv")
-    save_dataframe(st.session_state.invoices, "invoices.csv")
-    save_dataframe(st.session_state.income, "income.csv")
+def save_all_data(force=False):
+    """Save the loaded dataframes that changed since they were last loaded or saved.
+
+    With force=True every loaded table is saved, compared with what MongoDB currently
+    stores rather than with this session's last load/save (e.g. after another client
+    changed or emptied a collection).
+    Returns a list of {'name', 'changes', 'ms'} entries for the tables written.
+    Raises SaveError if the write to MongoDB fails.
+    """
+    # Tables this session never loaded are unchanged (and must not be overwritten with defaults)
+    if force:
+        changed = [name for name in TABLE_DEFAULTS if name in st.session_state]
+        if "mongo_client" in st.session_state and "mongo_db" in st.session_state:
+            for name in changed:
+                # Without a baseline the write is planned against the stored documents
+                _set_persisted_state(name, None)
+                _table_cache().invalidate(name)
+    else:
+        changed = [name for name in TABLE_DEFAULTS if name in st.session_state and is_table_dirty(name)]
+    
+    st.session_state._save_report = {}
+    # Raises SaveError if the write fails; the tables then stay dirty
+    with unit_of_work():
+        for name in changed:
+            save_dataframe(st.session_state[name], f"{name}.csv")
+    
+    written = []
+    for name in changed:
+        report = st.session_state._save_report.get(name)
+        if report is None:
+            # Without MongoDB the table only lives in session state
+            _remember_fingerprint(name, st.session_state[name])
+            report = {'changes': len(st.session_state[name]), 'ms': 0.0}
+        written.append({'name': name, 'changes': report['changes'], 'ms': report['ms']})
+    return written
+
+def show_save_summary(written):
+    """Display which tables save_all_data wrote"""
+    if not written:
+        st.info("Không có dữ liệu nào thay đổi kể từ lần lưu trước.")
+        return
+    st.success(f"Đã lưu {len(written)} bảng dữ liệu có thay đổi!")
+    st.table(pd.DataFrame([
+        {
+            "Tên dữ liệu": item['name'],
+            "Số bản ghi thay đổi": item['changes'],
+            "Thời gian (ms)": f"{item['ms']:,.1f}",
+        }
+        for item in written
+    ]))
+
+def find_preparation_cycle(preparation_items):
+    """
+    Tìm vòng lặp trong công thức bán thành phẩm (A dùng B, B lại dùng A)
+    Trả về danh sách prep_id tạo thành vòng lặp, hoặc None nếu không có
+    """
+    graph = {}
+    for prep_id, component_id in zip(preparation_items['prep_id'], preparation_items['component_id']):
+        graph.setdefault(prep_id, []).append(component_id)
     
-    if 'material_costs' in st.session_state:
-        save_dataframe(st.session_state.material_costs, "material_costs.csv")
+    done = set()
+    def visit(prep_id, path):
+        if prep_id in path:
+            return path[path.index(prep_id):] + [prep_id]
+        if prep_id in done or prep_id not in graph:
+            return None
+        for component_id in graph[prep_id]:
+            cycle = visit(component_id, path + [prep_id])
+            if cycle:
+                return cycle
+        done.add(prep_id)
+        return None
     
-    if 'invoice_status' in st.session_state:
-        save_dataframe(st.session_state.invoice_status, "invoice_status.csv")
+    for prep_id in graph:
+        cycle = visit(prep_id, [])
+        if cycle:
+            return cycle
+    return None
+
+def explode_recipes():
+    """
+    Triển khai công thức nhiều cấp về nguyên liệu thô
+    Trả về (recipes phẳng gồm product_id, material_id, quantity; dict prep_id -> {material_id: lượng cho 1 đơn vị})
+    Kết quả được lưu lại và chỉ tính lại khi recipes, preparations hoặc preparation_items thay đổi,
+    mỗi bán thành phẩm chỉ được triển khai một lần (memoization)
+    """
+    recipes = st.session_state.recipes
+    preparations = get_table('preparations')
+    preparation_items = get_table('preparation_items')
+    key = (
+        _content_fingerprint(recipes),
+        _content_fingerprint(preparations),
+        _content_fingerprint(preparation_items),
+    )
+    cached = st.session_state.get('_exploded_recipes')
+    if cached is not None and None not in key and cached[0] == key:
+        return cached[1], cached[2]
+    
+    yields = {}
+    for prep_id, yield_quantity in zip(preparations['prep_id'], pd.to_numeric(preparations['yield_quantity'], errors='coerce')):
+        yields[prep_id] = yield_quantity if yield_quantity and yield_quantity > 0 else 1.0
+    graph = {}
+    item_quantities = pd.to_numeric(preparation_items['quantity'], errors='coerce').fillna(0)
+    for prep_id, component_id, quantity in zip(preparation_items['prep_id'], preparation_items['component_id'], item_quantities):
+        graph.setdefault(prep_id, []).append((component_id, float(quantity)))
+    
+    compositions = {}
+    def explode(prep_id, path):
+        """Lượng nguyên liệu thô cho 1 đơn vị bán thành phẩm"""
+        if prep_id in compositions:
+            return compositions[prep_id]
+        if prep_id in path:
+            # Vòng lặp (đã được chặn khi lưu): bỏ qua nhánh này
+            return {}
+        composition = {}
+        for component_id, quantity in graph.get(prep_id, []):
+            per_unit = quantity / yields[prep_id]
+            if component_id in yields:
+                for material_id, material_quantity in explode(component_id, path | {prep_id}).items():
+                    composition[material_id] = composition.get(material_id, 0) + per_unit * material_quantity
+            else:
+                composition[component_id] = composition.get(component_id, 0) + per_unit
+        compositions[prep_id] = composition
+        return composition
+    
+    for prep_id in yields:
+        explode(prep_id, frozenset())
+    
+    if compositions:
+        rows = []
+        recipe_quantities = pd.to_numeric(recipes['quantity'], errors='coerce').fillna(0)
+        for product_id, component_id, quantity in zip(recipes['product_id'], recipes['material_id'], recipe_quantities):
+            if component_id in compositions:
+                for material_id, material_quantity in compositions[component_id].items():
+                    rows.append((product_id, material_id, quantity * material_quantity))
+            else:
+                rows.append((product_id, component_id, quantity))
+        flat_recipes = pd.DataFrame(rows, columns=['product_id', 'material_id', 'quantity'])
+    else:
+        flat_recipes = recipes
+    
+    st.session_state._exploded_recipes = (key, flat_recipes, compositions)
+    return flat_recipes, compositions
+
+# Bill of materials (BOM): product x material quantity matrix built from the exploded recipes
+def get_bom():
+    """
+    Trả về ma trận định mức nguyên liệu thô (dòng: product_id, cột: material_id)
+    Ma trận chỉ được tính lại khi công thức hoặc bán thành phẩm thay đổi
+    """
+    recipes, _ = explode_recipes()
+    cached = st.session_state.get('_bom')
+    if cached is not None and cached[0] is recipes:
+        return cached[1]
+    
+    if recipes.empty:
+        bom = pd.DataFrame(dtype=float)
+    else:
+        lines = recipes[['product_id', 'material_id']].copy()
+        lines['quantity'] = pd.to_numeric(recipes['quantity'], errors='coerce').fillna(0)
+        bom = lines.pivot_table(
+            index='product_id', columns='material_id', values='quantity', aggfunc='sum', fill_value=0
+        ).astype(float)
+    
+    st.session_state._bom = (recipes, bom)
+    return bom
+
+def preparation_unit_costs():
+    """Giá vốn nguyên liệu cho 1 đơn vị của từng bán thành phẩm (Series prep_id -> VND)"""
+    _, compositions = explode_recipes()
+    prices = pd.to_numeric(material_rows()['price_per_unit'], errors='coerce').fillna(0)
+    return pd.Series({
+        prep_id: sum(quantity * prices.get(material_id, 0) for material_id, quantity in composition.items())
+        for prep_id, composition in compositions.items()
+    }, dtype=float)
+
+def materials_required(product_quantities):
+    """
+    Tính lượng nguyên liệu cần cho một giỏ sản phẩm bằng một phép nhân ma trận - vector
+    product_quantities: Series (product_id -> số lượng), có thể lặp product_id
+    Trả về Series (material_id -> lượng cần), chỉ gồm các nguyên liệu có nhu cầu
+    """
+    bom = get_bom()
+    if bom.empty or len(product_quantities) == 0:
+        return pd.Series(dtype=float)
+    
+    quantities = pd.to_numeric(product_quantities, errors='coerce').fillna(0).groupby(level=0).sum()
+    quantities = quantities.reindex(bom.index, fill_value=0).astype(float)
+    required = bom.T.dot(quantities)
+    return required[required > 0]
+
+def order_product_quantities(order_ids):
+    """Tổng số lượng từng sản phẩm (Series product_id -> số lượng) của các đơn hàng"""
+    order_items = st.session_state.order_items
+    items = order_items[order_items['order_id'].isin(order_ids)]
+    return pd.to_numeric(items['quantity'], errors='coerce').fillna(0).groupby(items['product_id']).sum()
+
+def material_rows():
+    """Dòng đầu tiên của mỗi material_id trong bảng nguyên liệu, đánh chỉ mục theo material_id"""
+    materials = st.session_state.materials
+    first_rows = materials[~materials['material_id'].duplicated()]
+    return first_rows.set_index('material_id')
+
+# Product fee columns of product_costs that are part of the unit cost
+PRODUCT_FEE_COLUMNS = ['production_fee', 'other_fee', 'Depreciation_fee']  # Note the capital 'D'
+
+def _product_fees():
+    """Chi phí theo sản phẩm từ product_costs (chỉ mục product_id), thiếu dữ liệu thì bằng 0"""
+    product_costs = get_table('product_costs')
+    if product_costs.empty:
+        return pd.DataFrame(columns=PRODUCT_FEE_COLUMNS, dtype=float)
+    product_costs = product_costs[~product_costs['product_id'].duplicated()].set_index('product_id')
+    fees = pd.DataFrame(index=product_costs.index)
+    for column in PRODUCT_FEE_COLUMNS:
+        if column in product_costs.columns:
+            fees[column] = pd.to_numeric(product_costs[column], errors='coerce').fillna(0).astype(float)
+        else:
+            fees[column] = 0.0
+    return fees
+
+def get_unit_costs():
+    """
+    Bảng giá thành đơn vị của từng sản phẩm (chỉ mục product_id) gồm material_cost,
+    production_fee, other_fee, Depreciation_fee và total_cost
+    Bảng được lưu lại trong phiên, khi giá nguyên liệu, công thức hoặc chi phí sản phẩm
+    thay đổi thì chỉ các sản phẩm bị ảnh hưởng được tính lại
+    """
+    bom = get_bom()
+    prices = pd.to_numeric(material_rows()['price_per_unit'], errors='coerce').fillna(0).astype(float)
+    fees = _product_fees()
+    product_ids = bom.index.union(fees.index)
+    
+    state = st.session_state.get('_unit_costs')
+    if state is None:
+        affected = product_ids
+        table = pd.DataFrame(0.0, index=product_ids, columns=['material_cost'] + PRODUCT_FEE_COLUMNS + ['total_cost'])
+    else:
+        # Sản phẩm mới
+        affected = product_ids.difference(state['table'].index)
+        
+        # Sản phẩm có dòng công thức thay đổi (get_bom trả về cùng đối tượng nếu công thức không đổi)
+        if state['bom'] is not bom:
+            materials_union = bom.columns.union(state['bom'].columns)
+            old_bom = state['bom'].reindex(index=product_ids, columns=materials_union, fill_value=0)
+            new_bom = bom.reindex(index=product_ids, columns=materials_union, fill_value=0)
+            affected = affected.union(product_ids[(old_bom != new_bom).any(axis=1).to_numpy()])
+        
+        # Sản phẩm dùng nguyên liệu có giá thay đổi
+        materials_union = prices.index.union(state['prices'].index)
+        changed_prices = materials_union[
+            (prices.reindex(materials_union).fillna(0) != state['prices'].reindex(materials_union).fillna(0)).to_numpy()
+        ]
+        if len(changed_prices) > 0:
+            usage = bom.reindex(columns=changed_prices, fill_value=0)
+            affected = affected.union(usage.index[(usage != 0).any(axis=1).to_numpy()])
+        
+        # Sản phẩm có chi phí thay đổi
+        old_fees = state['fees'].reindex(product_ids).fillna(0)
+        new_fees = fees.reindex(product_ids).fillna(0)
+        affected = affected.union(product_ids[(old_fees != new_fees).any(axis=1).to_numpy()])
+        
+        table = state['table'].reindex(product_ids).fillna(0)
+    
+    if len(affected) > 0:
+        affected_bom = bom.reindex(index=affected, fill_value=0)
+        table.loc[affected, 'material_cost'] = affected_bom.dot(prices.reindex(bom.columns).fillna(0)).to_numpy()
+        table.loc[affected, PRODUCT_FEE_COLUMNS] = fees.reindex(affected).fillna(0).to_numpy()
+        table.loc[affected, 'total_cost'] = table.loc[affected, ['material_cost'] + PRODUCT_FEE_COLUMNS].sum(axis=1)
+    
+    st.session_state._unit_costs = {'bom': bom, 'prices': prices, 'fees': fees, 'table': table}
+    return table
+
+def order_cost_breakdown(order_id):
+    """
+    Chi phí của một đơn hàng theo bảng giá thành đơn vị
+    Trả về dict gồm material_cost, other_fee, Depreciation_fee và production_fee (đã nhân số lượng)
+    """
+    product_quantities = order_product_quantities([order_id])
+    unit_costs = get_unit_costs().reindex(product_quantities.index).fillna(0)
+    return {
+        column: float((unit_costs[column] * product_quantities).sum())
+        for column in ['material_cost'] + PRODUCT_FEE_COLUMNS
+    }
+
+# Costing methods for the material cost of new orders
+COSTING_METHODS = {
+    'fifo': 'FIFO (nhập trước - xuất trước)',
+    'average': 'Bình quân gia quyền các lần nhập',
+    'standard': 'Giá hiện tại của nguyên liệu',
+}
+
+# Movement kinds that move the FIFO position of a material (consumed_quantity in materials)
+FIFO_MOVEMENT_KINDS = ('sale', 'return')
+
+def shop_setting(key, default=None):
+    """Giá trị một thiết lập của cửa hàng (bảng settings), default nếu chưa được đặt"""
+    settings = get_table('settings')
+    values = settings.loc[settings['key'] == key, 'value'].dropna()
+    return values.iloc[0] if not values.empty else default
+
+def set_shop_setting(key, value):
+    """Lưu một thiết lập của cửa hàng (dùng chung cho mọi máy)"""
+    settings = get_table('settings')
+    rows = settings.index[settings['key'] == key]
+    if len(rows):
+        settings.at[rows[0], 'value'] = value
+    else:
+        st.session_state.settings = pd.concat([settings, pd.DataFrame([{'key': key, 'value': value}])], ignore_index=True)
+    return save_dataframe(st.session_state.settings, "settings.csv")
+
+def costing_method():
+    """Phương pháp tính giá vốn nguyên liệu của cửa hàng (mặc định: giá hiện tại của nguyên liệu)"""
+    method = shop_setting('costing_method', 'standard')
+    return method if method in COSTING_METHODS else 'standard'
+
+def get_cost_layers():
+    """
+    Lớp giá nhập của từng nguyên liệu từ material_costs, theo thứ tự ngày nhập
+    Trả về dict material_id -> (lượng nhập cộng dồn, chi phí cộng dồn), hai mảng numpy bắt đầu bằng 0
+    Các mảng chỉ được dựng lại khi material_costs thay đổi
+    """
+    material_costs = get_table('material_costs')
+    key = _content_fingerprint(material_costs)
+    cached = st.session_state.get('_cost_layers')
+    if cached is not None and key is not None and cached[0] == key:
+        return cached[1]
+    
+    imports = pd.DataFrame({
+        'date': material_costs['date'],
+        'material_id': material_costs['material_id'],
+        'quantity': pd.to_numeric(material_costs['quantity'], errors='coerce').fillna(0),
+        'total_cost': pd.to_numeric(material_costs['total_cost'], errors='coerce').fillna(0),
+    })
+    # Dòng cập nhật nhà cung cấp có số lượng 0 không phải là một lần nhập
+    imports = imports[imports['quantity'] > 0].sort_values('date', kind='stable')
+    cumulative = imports.groupby('material_id')[['quantity', 'total_cost']].cumsum()
+    
+    layers = {}
+    for material_id, rows in imports.groupby('material_id').groups.items():
+        layers[material_id] = (
+            np.concatenate(([0.0], cumulative.loc[rows, 'quantity'].to_numpy(dtype=float))),
+            np.concatenate(([0.0], cumulative.loc[rows, 'total_cost'].to_numpy(dtype=float))),
+        )
+    
+    st.session_state._cost_layers = (key, layers)
+    return layers
+
+def _cumulative_import_cost(cum_quantity, cum_cost, position, extra_price):
+    """
+    Tổng chi phí của `position` đơn vị nhập đầu tiên (nội suy trong lớp bằng tìm kiếm nhị phân)
+    Phần vượt quá tổng lượng đã nhập được tính theo extra_price
+    """
+    if position <= cum_quantity[-1]:
+        return float(np.interp(position, cum_quantity, cum_cost))
+    return float(cum_cost[-1] + (position - cum_quantity[-1]) * extra_price)
+
+def material_issue_costs(required, method=None):
+    """
+    Giá vốn của lượng nguyên liệu xuất kho cho một lần bán, gọi trước khi trừ kho
+    required: Series (material_id -> lượng xuất); method: khóa của COSTING_METHODS
+    Với FIFO, lần xuất này lấy tiếp các lớp giá từ lượng đã bán của nguyên liệu (consumed_quantity,
+    cộng khi bán và trừ khi hoàn kho), nên hao hụt, điều chỉnh tay và tồn kho không có lịch sử nhập
+    không làm dịch vị trí trong các lớp giá và không cần duyệt lại lịch sử bán hàng
+    Nguyên liệu không có lịch sử nhập được tính theo giá hiện tại
+    Trả về Series material_id -> chi phí
+    """
+    method = method or costing_method()
+    stock = material_rows()
+    prices = pd.to_numeric(stock['price_per_unit'], errors='coerce').fillna(0).reindex(required.index).fillna(0)
+    if method == 'standard':
+        return (required * prices).astype(float)
+    
+    layers = get_cost_layers()
+    consumed = pd.to_numeric(stock.get('consumed_quantity', pd.Series(dtype=float)), errors='coerce')
+    consumed = consumed.reindex(required.index).fillna(0)
+    costs = {}
+    for material_id, quantity in required.items():
+        if material_id not in layers:
+            costs[material_id] = quantity * prices[material_id]
+            continue
+        cum_quantity, cum_cost = layers[material_id]
+        if method == 'average':
+            costs[material_id] = quantity * cum_cost[-1] / cum_quantity[-1]
+        else:
+            start = max(float(consumed[material_id]), 0.0)
+            costs[material_id] = (
+                _cumulative_import_cost(cum_quantity, cum_cost, start + quantity, prices[material_id])
+                - _cumulative_import_cost(cum_quantity, cum_cost, start, prices[material_id])
+            )
+    return pd.Series(costs, dtype=float)
+
+def remaining_cost_layers(material_id):
+    """
+    Các lớp giá nhập của một nguyên liệu và lượng còn lại trong kho của mỗi lớp theo FIFO
+    (tồn kho hiện tại nằm ở các lớp nhập sau cùng)
+    """
+    layers = get_cost_layers().get(material_id)
+    if layers is None:
+        return pd.DataFrame(columns=['quantity', 'unit_cost', 'remaining'])
+    
+    material_costs = get_table('material_costs')
+    imports = material_costs[
+        (material_costs['material_id'] == material_id)
+        & (pd.to_numeric(material_costs['quantity'], errors='coerce').fillna(0) > 0)
+    ].sort_values('date', kind='stable')
+    cum_quantity, cum_cost = layers
+    quantities = np.diff(cum_quantity)
+    on_hand = max(float(stock_levels([material_id]).iloc[0]), 0.0)
+    consumed = max(cum_quantity[-1] - on_hand, 0.0)
+    remaining = np.clip(cum_quantity[1:] - np.maximum(cum_quantity[:-1], consumed), 0, quantities)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        unit_costs = np.where(quantities > 0, np.diff(cum_cost) / quantities, 0)
+    return pd.DataFrame({
+        'date': imports['date'].to_numpy(),
+        'supplier': imports['supplier'].to_numpy() if 'supplier' in imports.columns else '',
+        'quantity': quantities,
+        'unit_cost': unit_costs,
+        'remaining': remaining,
+    })
+
+def get_order_date(order_id):
+    """Ngày của đơn hàng ('YYYY-MM-DD'), None nếu không tìm thấy đơn hàng"""
+    orders = st.session_state.orders
+    dates = orders.loc[orders['order_id'] == order_id, 'date'].dropna()
+    return _date_key(dates.iloc[0]) if not dates.empty else None
+
+# Costs recorded on an order when it is sold (material cost by the costing method, fees by the unit costs of that day)
+ORDER_COST_COLUMNS = ['material_cost', 'other_fee', 'Depreciation_fee']
+
+def order_recorded_cost(order_id, column='material_cost'):
+    """Chi phí (một cột của ORDER_COST_COLUMNS) đã ghi trên đơn hàng lúc bán, None nếu đơn hàng chưa có"""
+    orders = st.session_state.orders
+    if column not in orders.columns:
+        return None
+    values = pd.to_numeric(orders.loc[orders['order_id'] == order_id, column], errors='coerce').dropna()
+    return float(values.iloc[0]) if not values.empty else None
+
+def stock_levels(material_ids):
+    """Tồn kho hiện tại (số âm tính là 0) của các nguyên liệu, theo thứ tự material_ids"""
+    stock = pd.to_numeric(material_rows()['quantity'], errors='coerce').fillna(0).astype(float)
+    return stock.reindex(material_ids).fillna(0).clip(lower=0)
+
+def product_capacity():
+    """
+    Số lượng tối đa có thể làm của từng sản phẩm với tồn kho hiện tại, tính riêng từng sản phẩm
+    (min trên các nguyên liệu của công thức của tồn kho / định mức)
+    Trả về DataFrame (chỉ mục product_id) gồm max_quantity và limiting_material
+    """
+    bom = get_bom()
+    if bom.empty:
+        return pd.DataFrame(columns=['max_quantity', 'limiting_material'])
+    
+    requirements = bom.to_numpy()
+    stock = stock_levels(bom.columns).to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = np.where(requirements > 0, stock / requirements, np.inf)
+    limiting = ratios.argmin(axis=1)
+    # + 1e-9: tỷ lệ như 0.3 / 0.1 ra 2.9999999999999996, floor thẳng sẽ thiếu 1 sản phẩm
+    max_quantity = np.floor(ratios[np.arange(len(bom.index)), limiting] + 1e-9)
+    
+    # Sản phẩm không có dòng công thức nào thì không bị giới hạn bởi nguyên liệu
+    has_recipe = (requirements > 0).any(axis=1)
+    return pd.DataFrame({
+        'max_quantity': np.where(has_recipe, max_quantity, np.nan),
+        'limiting_material': np.where(has_recipe, bom.columns.to_numpy()[limiting], None)
+    }, index=bom.index)
+
+def allocate_product_mix(requested):
+    """
+    Phân bổ nguyên liệu dùng chung cho một giỏ sản phẩm mong muốn
+    requested: Series (product_id -> số lượng mong muốn), thứ tự là thứ tự ưu tiên
+    Trước tiên làm đồng đều một tỷ lệ lớn nhất của cả giỏ, phần nguyên liệu còn lại
+    được chia tiếp cho từng sản phẩm theo thứ tự ưu tiên
+    Trả về DataFrame (chỉ mục product_id) gồm requested và allocated
+    """
+    bom = get_bom()
+    requested = pd.to_numeric(requested, errors='coerce').fillna(0).clip(lower=0).groupby(level=0, sort=False).sum()
+    result = pd.DataFrame({'requested': requested, 'allocated': 0.0})
+    if bom.empty or requested.sum() == 0:
+        return result
+    
+    requirements = bom.reindex(requested.index, fill_value=0).to_numpy()
+    remaining = stock_levels(bom.columns).to_numpy()
+    wanted = requested.to_numpy(dtype=float)
+    
+    # Tỷ lệ chung lớn nhất (không vượt quá 1) mà tồn kho đáp ứng được cho cả giỏ
+    total_need = requirements.T.dot(wanted)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        share = np.min(np.where(total_need > 0, remaining / total_need, np.inf), initial=np.inf)
+    allocated = np.minimum(np.floor(wanted * min(share, 1.0) + 1e-9), wanted)
+    remaining = remaining - requirements.T.dot(allocated)
+    
+    for row in range(len(wanted)):
+        missing = wanted[row] - allocated[row]
+        if missing <= 0:
+            continue
+        needs = requirements[row]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            extra = np.min(np.where(needs > 0, remaining / needs, np.inf), initial=np.inf)
+        extra = min(np.floor(max(extra, 0) + 1e-9), missing)
+        allocated[row] += extra
+        remaining = remaining - needs * extra
+    
+    result['allocated'] = allocated
+    return result
+
+def product_margins(product_ids):
+    """Lãi gộp mỗi đơn vị (giá bán - giá thành) của các sản phẩm, theo thứ tự product_ids"""
+    products = st.session_state.products
+    products = products[~products['product_id'].duplicated()].set_index('product_id')
+    prices = pd.to_numeric(products['price'], errors='coerce').fillna(0).astype(float)
+    unit_costs = get_unit_costs()['total_cost']
+    return prices.reindex(product_ids).fillna(0) - unit_costs.reindex(product_ids).fillna(0)
+
+def _greedy_production_mix(requirements, stock, margins, lower, upper):
+    """Phương án dự phòng khi không có scipy: ưu tiên sản phẩm lãi cao nhất trên phần tồn kho còn lại"""
+    quantities = lower.copy()
+    remaining = stock - requirements.dot(quantities)
+    for column in np.argsort(-margins):
+        if margins[column] <= 0:
+            break
+        needs = requirements[:, column]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            extra = np.min(np.where(needs > 0, remaining / needs, np.inf), initial=np.inf)
+        extra = min(np.floor(max(extra, 0) + 1e-9), upper[column] - quantities[column])
+        quantities[column] += extra
+        remaining = remaining - needs * extra
+    return quantities
+
+def optimize_production_mix(product_ids, min_quantities=None, max_quantities=None, time_limit=1.0):
+    """
+    Đề xuất số lượng mỗi sản phẩm cần làm để lãi gộp lớn nhất với tồn kho hiện tại
+    (bài toán quy hoạch nguyên: max sum(lãi * số lượng) với định mức * số lượng <= tồn kho)
+    min_quantities / max_quantities: dict product_id -> số lượng tối thiểu / tối đa (tùy chọn)
+    Sản phẩm không dùng nguyên liệu nào và không có số lượng tối đa chỉ được làm ở mức tối thiểu
+    Trả về (DataFrame chỉ mục product_id gồm quantity, unit_margin, margin; thông tin lời giải),
+    hoặc (None, thông báo lỗi) nếu không đáp ứng được số lượng tối thiểu
+    Thông tin lời giải là dict gồm method ('milp' hoặc 'greedy'), status (result.status của milp,
+    None nếu không chạy milp) và reason (xem PRODUCTION_PLAN_REASONS)
+    """
+    min_quantities = min_quantities or {}
+    max_quantities = max_quantities or {}
+    product_ids = pd.Index(product_ids).drop_duplicates()
+    bom = get_bom()
+    
+    requirements = bom.reindex(index=product_ids, fill_value=0).to_numpy().T if not bom.empty else np.zeros((0, len(product_ids)))
+    stock = stock_levels(bom.columns).to_numpy()
+    margins = product_margins(product_ids).to_numpy(dtype=float)
+    lower = np.array([float(min_quantities.get(pid, 0) or 0) for pid in product_ids])
+    upper = np.array([
+        float(max_quantities[pid]) if max_quantities.get(pid) is not None else np.inf
+        for pid in product_ids
+    ])
+    uses_materials = (requirements > 0).any(axis=0)
+    upper = np.where(np.isinf(upper) & ~uses_materials, lower, upper)
+    
+    if (lower > upper).any() or (requirements.dot(lower) > stock + 1e-9).any():
+        return None, "Tồn kho không đủ cho số lượng tối thiểu đã chọn"
+    
+    try:
+        from scipy.optimize import milp, LinearConstraint, Bounds
+    except ImportError:
+        milp = None
+    
+    info = {'method': 'greedy', 'status': None, 'reason': 'no_scipy' if milp is None else 'no_products'}
+    quantities = None
+    if milp is not None and len(product_ids) > 0:
+        constraints = [LinearConstraint(requirements, -np.inf, stock)] if len(stock) else []
+        result = milp(
+            c=-margins,
+            constraints=constraints,
+            integrality=np.ones(len(product_ids)),
+            bounds=Bounds(lower, upper),
+            options={'time_limit': time_limit}
+        )
+        info['status'] = result.status
+        if result.x is not None:
+            # status 0: tối ưu đã được chứng minh; 1: dừng do giới hạn thời gian với lời giải khả thi
+            quantities = np.round(result.x)
+            info.update(method='milp', reason='optimal' if result.status == 0 else 'time_limit')
+        else:
+            info['reason'] = 'no_solution'
+    if quantities is None:
+        quantities = _greedy_production_mix(requirements, stock, margins, lower, upper)
+    
+    plan = pd.DataFrame({
+        'quantity': quantities,
+        'unit_margin': margins,
+        'margin': quantities * margins
+    }, index=product_ids)
+    return plan, info
+
+# Mô tả lời giải của optimize_production_mix theo reason
+PRODUCTION_PLAN_REASONS = {
+    'optimal': "Phương án tối ưu",
+    'time_limit': "Phương án khả thi, chưa chứng minh là tối ưu (hết thời gian giải)",
+    'no_solution': "Phương án gần đúng (bộ giải MILP không tìm được lời giải)",
+    'no_scipy': "Phương án gần đúng (chưa cài scipy)",
+    'no_products': "Phương án gần đúng",
+}
+
+# Replenishment: consumption history window, default supplier lead time, days of usage
+# covered by each purchase and safety factor (z-score of a 95% service level)
+REPLENISHMENT_WINDOW_DAYS = 90
+DEFAULT_LEAD_TIME_DAYS = 2
+REVIEW_PERIOD_DAYS = 7
+SERVICE_LEVEL_Z = 1.65
+
+def daily_product_sales(start_date, end_date):
+    """
+    Số lượng bán mỗi ngày của từng sản phẩm từ orders / order_items
+    Trả về DataFrame (dòng: mọi ngày 'YYYY-MM-DD' từ start_date đến end_date, cột: product_id)
+    """
+    dates = pd.date_range(start_date, end_date).strftime('%Y-%m-%d')
+    orders = get_table('orders')
+    order_items = get_table('order_items')
+    if orders.empty or order_items.empty:
+        return pd.DataFrame(index=dates, dtype=float)
+    
+    window = orders[(orders['date'] >= dates[0]) & (orders['date'] <= dates[-1])][['order_id', 'date']]
+    items = order_items[['order_id', 'product_id']].assign(
+        quantity=pd.to_numeric(order_items['quantity'], errors='coerce').fillna(0)
+    ).merge(window, on='order_id')
+    if items.empty:
+        return pd.DataFrame(index=dates, dtype=float)
+    return items.pivot_table(
+        index='date', columns='product_id', values='quantity', aggfunc='sum', fill_value=0
+    ).reindex(index=dates, fill_value=0).astype(float)
+
+def daily_material_usage(end_date=None, days=REPLENISHMENT_WINDOW_DAYS):
+    """
+    Lượng nguyên liệu tiêu thụ mỗi ngày trong `days` ngày kết thúc vào end_date (mặc định hôm nay)
+    tính từ đơn hàng: ma trận (ngày x sản phẩm) nhân ma trận định mức (sản phẩm x nguyên liệu)
+    Trả về DataFrame (dòng: ngày 'YYYY-MM-DD', cột: material_id), được lưu lại đến khi đơn hàng hoặc công thức thay đổi
+    """
+    end = pd.Timestamp(end_date or datetime.date.today())
+    dates = pd.date_range(end - pd.Timedelta(days=days - 1), end).strftime('%Y-%m-%d')
+    orders = get_table('orders')
+    order_items = get_table('order_items')
+    bom = get_bom()
+    
+    key = (_content_fingerprint(orders), _content_fingerprint(order_items), dates[0], dates[-1])
+    cached = st.session_state.get('_material_usage')
+    if cached is not None and None not in key and cached[0] == key and cached[1] is bom:
+        return cached[2]
+    
+    if bom.empty:
+        usage = pd.DataFrame(index=dates, dtype=float)
+    else:
+        sold = daily_product_sales(dates[0], dates[-1]).reindex(columns=bom.index, fill_value=0)
+        usage = sold.dot(bom)
+    
+    st.session_state._material_usage = (key, bom, usage)
+    return usage
+
+# Demand forecast: history used when the model is (re)fitted, days used to initialise it
+# and smoothing factors of the level and of the day-of-week seasonal terms
+FORECAST_HISTORY_DAYS = 365
+FORECAST_INIT_DAYS = 28
+FORECAST_LEVEL_SMOOTHING = 0.3
+FORECAST_SEASON_SMOOTHING = 0.1
+
+def _sales_key(sales):
+    """Dấu vân tay của ma trận bán hàng (bỏ qua sản phẩm không bán được ngày nào)"""
+    sales = sales.loc[:, (sales != 0).any()].sort_index(axis=1)
+    digest = hashlib.sha1(repr(list(sales.columns)).encode('utf-8'))
+    digest.update(np.ascontiguousarray(sales.to_numpy()).tobytes())
+    return (len(sales), digest.hexdigest())
+
+def _smooth_demand(sales, level, season):
+    """
+    Cập nhật mô hình san bằng mũ có thành phần mùa vụ theo thứ trong tuần qua từng ngày của sales
+    (mỗi bước là phép toán vectơ trên toàn bộ sản phẩm)
+    level: mảng (sản phẩm), season: mảng (7 x sản phẩm)
+    """
+    alpha, gamma = FORECAST_LEVEL_SMOOTHING, FORECAST_SEASON_SMOOTHING
+    level = np.array(level, dtype=float)
+    season = np.array(season, dtype=float)
+    days = pd.DatetimeIndex(sales.index).dayofweek
+    for values, day in zip(sales.to_numpy(), days):
+        new_level = alpha * (values - season[day]) + (1 - alpha) * level
+        season[day] = gamma * (values - new_level) + (1 - gamma) * season[day]
+        level = new_level
+    return level, season
+
+def get_demand_model():
+    """
+    Mô hình dự báo nhu cầu của mọi sản phẩm, khớp đến hết ngày hôm qua
+    Trạng thái được lưu trong phiên: khi có đơn hàng của các ngày mới chỉ các ngày đó được đưa vào mô hình,
+    mô hình chỉ được khớp lại từ đầu khi dữ liệu của các ngày đã khớp thay đổi (đơn hàng ghi lùi ngày, xóa đơn...)
+    Trả về dict gồm products (Index), level, season, start và through
+    """
+    through = (datetime.date.today() - datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+    data_key = (_content_fingerprint(get_table('orders')), _content_fingerprint(get_table('order_items')), through)
+    state = st.session_state.get('_demand_model')
+    if state is not None and None not in data_key and state['data_key'] == data_key:
+        return state
+    
+    new_days = None
+    if state is not None and state['through'] <= through:
+        sales = daily_product_sales(state['start'], through)
+        if _sales_key(sales.loc[:state['through']]) == state['history_key']:
+            # Chỉ các ngày mới; sản phẩm mới bắt đầu từ 0
+            products = state['products'].union(sales.columns)
+            level = pd.Series(state['level'], index=state['products']).reindex(products, fill_value=0).to_numpy()
+            season = pd.DataFrame(state['season'], columns=state['products']).reindex(columns=products, fill_value=0).to_numpy()
+            new_days = sales.loc[sales.index > state['through']].reindex(columns=products, fill_value=0)
+            start = state['start']
+    
+    if new_days is None:
+        start = (datetime.date.today() - datetime.timedelta(days=FORECAST_HISTORY_DAYS)).strftime('%Y-%m-%d')
+        sales = daily_product_sales(start, through)
+        products = sales.columns
+        initial = sales.iloc[:FORECAST_INIT_DAYS]
+        level = initial.mean().to_numpy()
+        season = (
+            initial.groupby(pd.DatetimeIndex(initial.index).dayofweek).mean()
+            .reindex(range(7)).fillna(initial.mean()).to_numpy() - level
+        )
+        new_days = sales
+    
+    level, season = _smooth_demand(new_days, level, season)
+    state = {
+        'products': products,
+        'level': level,
+        'season': season,
+        'start': start,
+        'through': through,
+        'history_key': _sales_key(sales.reindex(columns=products, fill_value=0)),
+        'data_key': data_key,
+    }
+    st.session_state._demand_model = state
+    return state
+
+def forecast_product_demand(target_date):
+    """Nhu cầu dự báo (Series product_id -> số lượng) của một ngày sau ngày hôm qua"""
+    model = get_demand_model()
+    day = pd.Timestamp(target_date).dayofweek
+    forecast = np.clip(model['level'] + model['season'][day], 0, None) if len(model['products']) else []
+    return pd.Series(forecast, index=model['products'], dtype=float)
+
+def replenishment_plan(lead_time_days=DEFAULT_LEAD_TIME_DAYS, review_days=REVIEW_PERIOD_DAYS, service_z=SERVICE_LEVEL_Z):
+    """
+    Điểm đặt hàng lại và lượng nên mua của mọi nguyên liệu, tính một lượt bằng phép toán vectơ
+    - tiêu thụ/ngày và độ lệch chuẩn lấy từ daily_material_usage()
+    - tồn kho an toàn = z * độ lệch chuẩn * sqrt(thời gian giao hàng)
+    - điểm đặt hàng lại = tiêu thụ/ngày * thời gian giao hàng + tồn kho an toàn
+    - khi tồn kho <= điểm đặt hàng lại, mua đủ đến điểm đặt hàng lại + tiêu thụ của review_days ngày
+    Thời gian giao hàng lấy từ cột lead_time_days của nguyên liệu nếu có, nếu không dùng lead_time_days
+    Trả về DataFrame (chỉ mục material_id)
+    """
+    stock = material_rows()
+    usage = daily_material_usage().reindex(columns=stock.index, fill_value=0)
+    velocity = usage.mean()
+    deviation = usage.std(ddof=0).fillna(0)
+    
+    if 'lead_time_days' in stock.columns:
+        lead_time = pd.to_numeric(stock['lead_time_days'], errors='coerce')
+        lead_time = lead_time.where(lead_time > 0).fillna(lead_time_days)
+    else:
+        lead_time = pd.Series(float(lead_time_days), index=stock.index)
+    
+    on_hand = pd.to_numeric(stock['quantity'], errors='coerce').fillna(0)
+    safety_stock = service_z * deviation * np.sqrt(lead_time)
+    reorder_point = velocity * lead_time + safety_stock
+    target = reorder_point + velocity * review_days
+    suggested = (target - on_hand).clip(lower=0).where(on_hand <= reorder_point, 0.0)
+    with np.errstate(divide='ignore'):
+        days_of_cover = on_hand.clip(lower=0) / velocity
+    
+    return pd.DataFrame({
+        'name': stock['name'],
+        'unit': stock['unit'].astype(str),
+        'quantity': on_hand,
+        'daily_usage': velocity,
+        'lead_time_days': lead_time,
+        'safety_stock': safety_stock,
+        'reorder_point': reorder_point,
+        'suggested_quantity': suggested,
+        'days_of_cover': days_of_cover,
+        'price_per_unit': pd.to_numeric(stock['price_per_unit'], errors='coerce').fillna(0),
+    })
+
+def _apply_stock_deltas(deltas, kind=None):
+    """
+    Cộng lượng thay đổi vào tồn kho trong phiên bằng một phép toán vectơ (âm là xuất kho)
+    Lượng xuất kho được cộng vào used_quantity, lượng hoàn lại được trừ khỏi used_quantity
+    (và consumed_quantity nếu kind là một loại trong FIFO_MOVEMENT_KINDS)
+    deltas: Series (material_id -> lượng thay đổi), các nguyên liệu không có trong kho bị bỏ qua
+    """
+    materials = st.session_state.materials
+    first_rows = materials[~materials['material_id'].duplicated()]
+    row_index = pd.Series(first_rows.index, index=first_rows['material_id'])
+    deltas = deltas[deltas.index.isin(row_index.index)]
+    if deltas.empty:
+        return
+    
+    rows = row_index.loc[deltas.index].to_numpy()
+    amounts = deltas.to_numpy(dtype=float)
+    if 'used_quantity' not in materials.columns:
+        materials['used_quantity'] = 0.0
+    materials['quantity'] = pd.to_numeric(materials['quantity'], errors='coerce').fillna(0).astype(float)
+    materials['used_quantity'] = pd.to_numeric(materials['used_quantity'], errors='coerce').fillna(0).astype(float)
+    materials.loc[rows, 'quantity'] = materials.loc[rows, 'quantity'].to_numpy() + amounts
+    materials.loc[rows, 'used_quantity'] = materials.loc[rows, 'used_quantity'].to_numpy() - amounts
+    if kind in FIFO_MOVEMENT_KINDS:
+        if 'consumed_quantity' not in materials.columns:
+            materials['consumed_quantity'] = 0.0
+        materials['consumed_quantity'] = pd.to_numeric(materials['consumed_quantity'], errors='coerce').fillna(0).astype(float)
+        materials.loc[rows, 'consumed_quantity'] = materials.loc[rows, 'consumed_quantity'].to_numpy() - amounts
+
+def _sync_stock_levels(docs):
+    """
+    Ghi đè quantity/used_quantity/consumed_quantity trong phiên bằng giá trị đọc từ MongoDB
+    và cập nhật trạng thái đã lưu để lần lưu bảng materials sau không ghi đè lên chúng
+    """
+    materials = st.session_state.materials
+    first_rows = materials[~materials['material_id'].duplicated()]
+    row_index = pd.Series(first_rows.index, index=first_rows['material_id'])
+    
+    persisted = st.session_state.get('_persisted_rows', {})
+    baseline = persisted.get('materials')
+    if baseline is not None:
+        # The baseline may be shared with the process cache: update a copy
+        baseline = dict(baseline)
+        persisted['materials'] = baseline
+    
+    for doc in docs:
+        material_id = doc['material_id']
+        if material_id not in row_index.index:
+            continue
+        row = row_index[material_id]
+        for column in ['quantity', 'used_quantity', 'consumed_quantity']:
+            if column in doc:
+                materials.at[row, column] = float(doc[column])
+        
+        key = (material_id,)
+        if baseline is not None and key in baseline:
+            stored = json.loads(baseline[key])
+            for column in ['quantity', 'used_quantity', 'consumed_quantity']:
+                if column in doc:
+                    stored[column] = float(doc[column])
+            baseline[key] = _record_fingerprint(stored)
+
+class StockShortageError(Exception):
+    """Không đủ tồn kho trên server cho một biến động kho (applied: các nguyên liệu đã được cập nhật trước đó)"""
+    def __init__(self, material_ids, applied=()):
+        super().__init__(f"Không đủ nguyên liệu: {', '.join(map(str, material_ids))}")
+        self.material_ids = material_ids
+        self.applied = list(applied)
+
+def apply_inventory_movement(deltas, kind='adjustment', ref='', date=None):
+    """
+    Áp dụng một biến động kho cho nhiều nguyên liệu cùng lúc và ghi vào sổ kho
+    deltas: Series (material_id -> lượng thay đổi), âm là xuất kho, dương là hoàn lại/nhập kho
+    kind, ref: loại biến động (xem STOCK_MOVEMENT_KINDS) và mã tham chiếu (mã đơn hàng...)
+    date: ngày ghi sổ của biến động (mặc định là hôm nay), ví dụ ngày của đơn hàng
+    
+    Khi có MongoDB, mỗi nguyên liệu được cập nhật bằng một lệnh $inc (find_one_and_update), lệnh
+    xuất kho chỉ áp dụng nếu tồn kho trên server vẫn đủ, nên hai máy bán hàng cùng lúc không ghi đè
+    tồn kho của nhau. Dòng sổ kho được ghi cùng transaction với các lệnh $inc; nếu thiếu hàng hoặc
+    không ghi được sổ kho, biến động bị hủy toàn bộ (transaction hoặc bù trừ đúng các nguyên liệu
+    đã cập nhật).
+    Trả về (True, []) nếu thành công, (False, danh sách material_id thiếu) nếu không đủ hàng
+    hoặc (False, []) nếu không ghi được vào MongoDB
+    """
+    deltas = pd.to_numeric(deltas, errors='coerce').fillna(0)
+    deltas = deltas[deltas != 0].groupby(level=0).sum()
+    stock = material_rows()
+    deltas = deltas[deltas.index.isin(stock.index)]
+    if deltas.empty:
+        return True, []
+    
+    # Kiểm tra trên dữ liệu trong phiên trước khi gửi lên server
+    available = pd.to_numeric(stock['quantity'], errors='coerce').fillna(0).reindex(deltas.index)
+    short = list(deltas.index[available + deltas < 0])
+    if short:
+        return False, short
+    
+    if "mongo_client" not in st.session_state or "mongo_db" not in st.session_state:
+        record_stock_movements(deltas, kind, ref, date)
+        _apply_stock_deltas(deltas, kind)
+        return True, []
+    
+    was_clean = not is_table_dirty('materials')
+    collection = st.session_state.mongo_db['materials']
+    material_ids = list(deltas.index)
+    
+    def increments(delta):
+        """$inc of one material; sales and returns also move its FIFO position"""
+        inc = {'quantity': float(delta), 'used_quantity': float(-delta)}
+        if kind in FIFO_MOVEMENT_KINDS:
+            inc['consumed_quantity'] = float(-delta)
+        return inc
+    
+    def undo_ops(applied):
+        """Give back the $inc of the materials that were updated"""
+        undo = [
+            pymongo.UpdateOne({'material_id': material_id}, {'$inc': increments(-deltas[material_id])})
+            for material_id in applied
+        ]
+        if undo:
+            collection.bulk_write(undo, ordered=False)
+    
+    def apply_ops(session=None):
+        """Apply the $inc of each material with its own find_one_and_update and return the
+        materials it updated, stopping at the first issue the server stock cannot cover.
+        The result of each update comes from the write itself, not from a later read."""
+        applied, missed = [], []
+        for material_id, delta in deltas.items():
+            query = {'material_id': material_id}
+            if delta < 0:
+                # Non-negative guard evaluated by the server
+                query['quantity'] = {'$gte': float(-delta)}
+            updated = collection.find_one_and_update(
+                query,
+                {'$inc': increments(delta)},
+                projection={'_id': 1},
+                session=session
+            )
+            if updated is not None:
+                applied.append(material_id)
+            elif delta < 0:
+                raise StockShortageError([material_id], applied)
+            else:
+                missed.append(material_id)
+        return applied, missed
+    
+    try:
+        _open_stock_ledger()
+        movements = _appended_frame('stock_movements', _stock_movement_rows(deltas, kind, ref, date))
+        if _use_transactions():
+            def apply_and_record(session):
+                # Raising StockShortageError or a write error aborts the transaction
+                result = apply_ops(session)
+                _insert_appended('stock_movements', movements, session=session)
+                return result
+            with st.session_state.mongo_client.start_session() as session:
+                applied, missed = session.with_transaction(apply_and_record)
+        else:
+            try:
+                applied, missed = apply_ops()
+            except StockShortageError as e:
+                # Undo exactly the updates that were applied
+                undo_ops(e.applied)
+                raise
+            try:
+                _insert_appended('stock_movements', movements)
+            except pymongo.errors.PyMongoError:
+                # Stock and ledger change together: without the ledger rows the stock is restored
+                undo_ops(applied)
+                raise
+    except StockShortageError as e:
+        short = e.material_ids
+    except pymongo.errors.PyMongoError as e:
+        st.error(f"Lỗi khi cập nhật tồn kho trên MongoDB: {e}")
+        _table_cache().invalidate('materials')
+        return False, []
+    else:
+        short = []
+        # Materials not stored in MongoDB yet only change in this session
+        _apply_stock_deltas(deltas[deltas.index.isin(missed)], kind)
+    
+    # Đồng bộ tồn kho trong phiên với giá trị trên server (bao gồm thay đổi từ máy khác)
+    _sync_stock_levels(collection.find(
+        {'material_id': {'$in': material_ids}},
+        {'_id': 0, 'material_id': 1, 'quantity': 1, 'used_quantity': 1, 'consumed_quantity': 1}
+    ))
+    _table_cache().invalidate('materials')
+    if was_clean:
+        _remember_fingerprint('materials', st.session_state.materials)
+    
+    if not short:
+        _keep_appended('stock_movements', movements)
+    return not short, short
+
+def set_stock_level(material_id, quantity, ref=''):
+    """
+    Đặt tồn kho của một nguyên liệu về số lượng cho trước (sửa tay, kiểm kê) và ghi phần chênh lệch
+    vào sổ kho dưới dạng biến động điều chỉnh
+    Khi có MongoDB, số lượng được đặt bằng một lệnh $set trả về giá trị cũ trên server, nên phần
+    chênh lệch tính từ tồn kho đang lưu (kể cả thay đổi từ máy khác) chứ không từ bản trong phiên.
+    Lệnh $set và dòng sổ kho được ghi cùng transaction, hoặc tồn kho được trả lại nếu không ghi
+    được sổ kho
+    Trả về False nếu không ghi được vào MongoDB
+    """
+    quantity = float(quantity)
+    materials = st.session_state.materials
+    rows = materials.index[materials['material_id'] == material_id]
+    current = float(pd.to_numeric(material_rows()['quantity'], errors='coerce').fillna(0).get(material_id, 0.0))
+    
+    if "mongo_client" not in st.session_state or "mongo_db" not in st.session_state:
+        record_stock_movements(pd.Series({material_id: quantity - current}), 'adjustment', ref)
+        if len(rows):
+            materials.at[rows[0], 'quantity'] = quantity
+        return True
+    
+    was_clean = not is_table_dirty('materials')
+    collection = st.session_state.mongo_db['materials']
+    
+    def set_and_record(session=None):
+        """Set the stored quantity and insert the adjustment for the difference to the stored value"""
+        stored = collection.find_one_and_update(
+            {'material_id': material_id},
+            {'$set': {'quantity': quantity}},
+            projection={'_id': 0, 'quantity': 1},
+            return_document=pymongo.ReturnDocument.BEFORE,
+            session=session
+        )
+        if stored is None:
+            return None, None
+        delta = quantity - float(stored.get('quantity') or 0)
+        movements = _appended_frame(
+            'stock_movements', _stock_movement_rows(pd.Series({material_id: delta}), 'adjustment', ref)
+        )
+        try:
+            _insert_appended('stock_movements', movements, session=session)
+        except pymongo.errors.PyMongoError:
+            if session is None:
+                collection.update_one({'material_id': material_id}, {'$inc': {'quantity': -delta}})
+            raise
+        return stored, movements
+    
+    try:
+        _open_stock_ledger()
+        if _use_transactions():
+            with st.session_state.mongo_client.start_session() as session:
+                stored, movements = session.with_transaction(set_and_record)
+        else:
+            stored, movements = set_and_record()
+    except pymongo.errors.PyMongoError as e:
+        st.error(f"Lỗi khi cập nhật tồn kho trên MongoDB: {e}")
+        _table_cache().invalidate('materials')
+        return False
+    
+    if stored is not None:
+        _sync_stock_levels([{'material_id': material_id, 'quantity': quantity}])
+        _table_cache().invalidate('materials')
+        if was_clean:
+            _remember_fingerprint('materials', st.session_state.materials)
+        _keep_appended('stock_movements', movements)
+        return True
+    
+    # Nguyên liệu chưa được lưu trong MongoDB chỉ thay đổi trong phiên
+    try:
+        record_stock_movements(pd.Series({material_id: quantity - current}), 'adjustment', ref)
+    except pymongo.errors.PyMongoError as e:
+        st.error(f"Lỗi khi ghi sổ kho: {e}")
+        return False
+    if len(rows):
+        materials.at[rows[0], 'quantity'] = quantity
+    return True
+
+# Stock movement kinds of the stock ledger
+STOCK_MOVEMENT_KINDS = {
+    'sale': 'Bán hàng',
+    'return': 'Hoàn kho',
+    'import': 'Nhập kho',
+    'adjustment': 'Điều chỉnh',
+    'waste': 'Hao hụt',
+    'removal': 'Xóa nguyên liệu',
+}
+
+# Number of movements since the latest snapshot after which writing a movement takes a new snapshot
+STOCK_SNAPSHOT_INTERVAL = 500
+
+# Fixed timestamp of the opening snapshot, so that every terminal upserts the same rows
+STOCK_LEDGER_OPENING_TS = '0000-00-00 00:00:00.000000'
+
+def _ledger_timestamp():
+    """Thời điểm hiện tại dạng chuỗi sắp xếp được của sổ kho"""
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+
+def _appended_frame(name, rows):
+    """Các dòng mới của một bảng chỉ ghi thêm, theo schema của bảng"""
+    return apply_table_schema(name, pd.DataFrame(rows, columns=TABLE_DEFAULTS[name].columns))
+
+def _insert_appended(name, new_rows, session=None):
+    """Insert các dòng mới vào MongoDB và trả về _id của chúng"""
+    documents = [dict(record) for record in new_rows.to_dict(orient='records')]
+    if not documents:
+        return []
+    # insert_many adds _id to the documents it is given
+    st.session_state.mongo_db[name].insert_many(documents, ordered=False, session=session)
+    return [document['_id'] for document in documents]
+
+def _keep_appended(name, new_rows):
+    """
+    Cập nhật phiên sau khi các dòng mới đã được lưu: bảng trong phiên (nếu đã tải) được nối thêm
+    và giữ trạng thái đã lưu để lần lưu sau không ghi lại các dòng này
+    """
+    _table_cache().invalidate(name)
+    if name in st.session_state:
+        was_clean = not is_table_dirty(name)
+        persisted = st.session_state.get('_persisted_rows', {}).get(name)
+        if persisted is not None:
+            baseline = dict(persisted)
+            baseline.update(_persisted_state(name, new_rows.to_dict(orient='records')) or {})
+            _set_persisted_state(name, baseline)
+        st.session_state[name] = pd.concat([st.session_state[name], new_rows], ignore_index=True)
+        if was_clean:
+            _remember_fingerprint(name, st.session_state[name])
+    if name == 'stock_movements':
+        _snapshot_stock_if_due()
+
+def _append_rows(name, rows):
+    """
+    Thêm các dòng mới vào một bảng chỉ ghi thêm (sổ kho) mà không ghi lại cả bảng
+    Khi có MongoDB chỉ các dòng mới được insert; trong unit_of_work chúng được ghi cùng các
+    bảng của nó (cùng transaction nếu được bật)
+    """
+    new_rows = _appended_frame(name, rows)
+    if "mongo_client" in st.session_state and "mongo_db" in st.session_state:
+        if st.session_state.get('_append_batch') is not None:
+            st.session_state._append_batch.append((name, new_rows))
+            return
+        _insert_appended(name, new_rows)
+        _keep_appended(name, new_rows)
+    else:
+        st.session_state[name] = pd.concat([get_table(name), new_rows], ignore_index=True)
+        if name == 'stock_movements':
+            _snapshot_stock_if_due()
+
+def take_stock_snapshot(stock, ts=None):
+    """Lưu tồn kho stock (Series material_id -> quantity) làm snapshot tại thời điểm ts"""
+    ts = ts or _ledger_timestamp()
+    _append_rows('stock_snapshots', [
+        {'ts': ts, 'date': ts[:10], 'material_id': material_id, 'quantity': float(quantity)}
+        for material_id, quantity in stock.items()
+    ])
+
+def _open_stock_ledger():
+    """
+    Lưu snapshot mở sổ kho (tồn kho đang lưu, trước biến động đầu tiên) nếu sổ kho chưa có snapshot
+    Gọi trước khi tồn kho thay đổi. Snapshot mở sổ có ts cố định và được ghi bằng upsert theo
+    (ts, material_id), nên hai máy cùng mở sổ vẫn chỉ tạo một snapshot
+    """
+    if st.session_state.get('_stock_ledger_opened'):
+        return
+    
+    if "mongo_client" in st.session_state and "mongo_db" in st.session_state:
+        db = st.session_state.mongo_db
+        if db['stock_snapshots'].find_one({}, {'_id': 1}) is None:
+            opening = [
+                pymongo.UpdateOne(
+                    {'ts': STOCK_LEDGER_OPENING_TS, 'material_id': doc['material_id']},
+                    {'$setOnInsert': {'date': STOCK_LEDGER_OPENING_TS[:10], 'quantity': float(doc.get('quantity') or 0)}},
+                    upsert=True
+                )
+                for doc in db['materials'].find({}, {'_id': 0, 'material_id': 1, 'quantity': 1})
+            ]
+            if opening:
+                db['stock_snapshots'].bulk_write(opening, ordered=False)
+                _table_cache().invalidate('stock_snapshots')
+                # The loaded copy no longer matches the stored snapshots
+                st.session_state.pop('stock_snapshots', None)
+                _forget_fingerprint('stock_snapshots')
+    elif get_table('stock_snapshots').empty:
+        stock = pd.to_numeric(material_rows()['quantity'], errors='coerce').fillna(0).astype(float)
+        take_stock_snapshot(stock, STOCK_LEDGER_OPENING_TS)
+    st.session_state._stock_ledger_opened = True
+
+def _stock_movement_rows(deltas, kind, ref='', date=None):
+    """Các dòng sổ kho của một biến động (mỗi nguyên liệu một dòng, cùng movement_id)"""
+    ts = _ledger_timestamp()
+    movement_id = uuid.uuid4().hex[:12]
+    return [
+        {
+            'movement_id': movement_id, 'ts': ts, 'date': _date_key(date) or ts[:10], 'material_id': material_id,
+            'delta': float(delta), 'kind': kind, 'ref': ref
+        }
+        for material_id, delta in deltas.items()
+        if delta != 0
+    ]
+
+def record_stock_movements(deltas, kind, ref='', date=None):
+    """
+    Ghi một biến động kho vào sổ kho (mỗi nguyên liệu một dòng, cùng movement_id)
+    Gọi trước khi tồn kho trong bảng materials thay đổi và trong cùng unit_of_work với lần lưu
+    bảng materials, để tồn kho và sổ kho được ghi cùng nhau. Lỗi MongoDB được raise (SaveError
+    khi ghi cùng unit_of_work)
+    date: ngày ghi sổ (mặc định là hôm nay); ts luôn là thời điểm ghi, nên đơn hàng ghi lùi ngày
+    vẫn được tính sau các snapshot đã có
+    """
+    deltas = pd.to_numeric(deltas, errors='coerce').fillna(0)
+    deltas = deltas[deltas != 0]
+    if deltas.empty:
+        return
+    _open_stock_ledger()
+    _append_rows('stock_movements', _stock_movement_rows(deltas, kind, ref, date))
+
+def latest_stock_snapshot(as_of=None):
+    """
+    Snapshot gần nhất đến hết ngày as_of (None là snapshot mới nhất)
+    Khi có MongoDB, thời điểm của snapshot được lấy bằng một find_one sắp xếp theo index (date, ts)
+    Trả về (ts, Series material_id -> quantity), hoặc (None, Series rỗng) nếu chưa có snapshot
+    """
+    as_of = _date_key(as_of)
+    if ('stock_snapshots' not in st.session_state
+            and "mongo_client" in st.session_state and "mongo_db" in st.session_state):
+        latest = st.session_state.mongo_db['stock_snapshots'].find_one(
+            {'date': {'$lte': as_of}} if as_of else {},
+            {'_id': 0, 'ts': 1},
+            sort=[('date', pymongo.DESCENDING), ('ts', pymongo.DESCENDING)]
+        )
+        if latest is None:
+            return None, pd.Series(dtype=float)
+        snapshots = query_dataframe('stock_snapshots', filters={'ts': latest['ts']})
+    else:
+        snapshots = get_table('stock_snapshots')
+        if as_of is not None:
+            snapshots = snapshots[snapshots['date'].astype(str) <= as_of]
+        if snapshots.empty:
+            return None, pd.Series(dtype=float)
+        snapshots = snapshots[snapshots['ts'] == snapshots['ts'].max()]
+    quantities = pd.to_numeric(snapshots['quantity'], errors='coerce').fillna(0)
+    return snapshots['ts'].iloc[0], quantities.groupby(snapshots['material_id']).sum()
+
+def _movements_after(ts, as_of=None):
+    """Biến động ghi sau thời điểm ts (theo thời điểm ghi, nên biến động ghi lùi ngày vẫn được tính)"""
+    movements = query_dataframe(
+        'stock_movements', start_date=ts, fields=['ts', 'date', 'material_id', 'delta'], date_field='ts'
+    )
+    movements = movements[movements['ts'] > ts]
+    if as_of is not None:
+        movements = movements[movements['date'] <= as_of]
+    return movements
+
+def derive_stock(as_of=None):
+    """
+    Tồn kho theo sổ kho: snapshot gần nhất cộng các biến động sau snapshot
+    as_of: ngày 'YYYY-MM-DD' (hoặc date), tồn kho cuối ngày đó; None là tồn kho hiện tại
+    Chỉ đọc sổ kho; snapshot mới được lưu khi ghi biến động (_snapshot_stock_if_due)
+    Trả về Series material_id -> quantity
+    """
+    as_of = _date_key(as_of)
+    ts, stock = latest_stock_snapshot(as_of)
+    if ts:
+        movements = _movements_after(ts, as_of)
+    else:
+        movements = query_dataframe('stock_movements', end_date=as_of, fields=['ts', 'material_id', 'delta'])
+    if movements.empty:
+        return stock
     
-    if 'product_costs' in st.session_state:
-        save_dataframe(st.session_state.product_costs, "product_costs.csv") 
+    deltas = pd.to_numeric(movements['delta'], errors='coerce').fillna(0).groupby(movements['material_id']).sum()
+    return stock.add(deltas, fill_value=0)
 
-    if 'labor_costs' in st.session_state:
-        save_dataframe(st.session_state.labor_costs, "labor_costs.csv")
-        
-    # Added new dataframes for family expense management
-    if 'family_expenses' in st.session_state:
-        save_dataframe(st.session_state.family_expenses, "family_expenses.csv")
-        
-    if 'expense_categories' in st.session_state:
-        save_dataframe(st.session_state.expense_categories, "expense_categories.csv")
-        
-    if 'expected_transactions' in st.session_state:
-        save_dataframe(st.session_state.expected_transactions, "expected_transactions.csv")
+def _snapshot_stock_if_due():
+    """
+    Lưu snapshot tồn kho theo sổ kho khi đã có STOCK_SNAPSHOT_INTERVAL biến động kể từ snapshot
+    gần nhất, để đọc tồn kho chỉ cần các biến động sau snapshot (gọi sau khi ghi biến động)
+    """
+    try:
+        ts, stock = latest_stock_snapshot()
+        if ts is None:
+            return
+        if ('stock_movements' not in st.session_state
+                and "mongo_client" in st.session_state and "mongo_db" in st.session_state):
+            since = st.session_state.mongo_db['stock_movements'].count_documents({'ts': {'$gt': ts}})
+        else:
+            since = int((get_table('stock_movements')['ts'] > ts).sum())
+        if since < STOCK_SNAPSHOT_INTERVAL:
+            return
         
-    # Added marketing costs tracking
-    if 'marketing_costs' in st.session_state:
-        save_dataframe(st.session_state.marketing_costs, "marketing_costs.csv")
+        movements = _movements_after(ts)
+        deltas = pd.to_numeric(movements['delta'], errors='coerce').fillna(0).groupby(movements['material_id']).sum()
+        take_stock_snapshot(stock.add(deltas, fill_value=0), movements['ts'].max())
+    except pymongo.errors.PyMongoError as e:
+        # The snapshot only speeds up reads; the movements are already stored
+        if show_debug:
+            st.sidebar.error(f"Error taking stock snapshot: {str(e)}")
 
-# Function to update material quantities after an order
 def update_materials_after_order(order_id):
     """
     Cập nhật số lượng nguyên liệu sau khi tạo đơn hàng
-    Không cho phép số lượng nguyên liệu âm
+    Không cho phép số lượng nguyên liệu âm: nếu thiếu bất kỳ nguyên liệu nào thì kho không bị thay đổi
     """
-    # Get order items
-    order_items_df = st.session_state.order_items[st.session_state.order_items['order_id'] == order_id]
+    required = materials_required(order_product_quantities([order_id]))
+    # Giá vốn theo lớp giá nhập phải tính trước khi trừ kho
+    material_cost = float(material_issue_costs(required).sum())
     
-    # For each order item, reduce materials according to recipe
-    for _, item in order_items_df.iterrows():
-        product_id = item['product_id']
-        order_quantity = item['quantity']
-        
-        # Get recipe for this product
-        product_recipe = st.session_state.recipes[st.session_state.recipes['product_id'] == product_id]
-        
-        # For each material in the recipe, reduce quantity and track usage
-        for _, recipe_item in product_recipe.iterrows():
-            material_id = recipe_item['material_id']
-            material_quantity_needed = recipe_item['quantity'] * order_quantity
-            
-            # Update material quantity
-            material_idx = st.session_state.materials[st.session_state.materials['material_id'] == material_id].index[0]
-            current_quantity = st.session_state.materials.at[material_idx, 'quantity']
-            
-            # Đảm bảo số lượng không âm
-            if current_quantity < material_quantity_needed:
-                # Không nên xảy ra vì đã kiểm tra trước khi đến đây, nhưng để chắc chắn
-                st.error(f"Lỗi: Không đủ nguyên liệu {material_id} để thực hiện đơn hàng!")
-                return False
-            
-            st.session_state.materials.at[material_idx, 'quantity'] -= material_quantity_needed
-            
-            # Update used quantity
-            st.session_state.materials.at[material_idx, 'used_quantity'] += material_quantity_needed
+    # Trừ kho toàn bộ nguyên liệu trong một biến động, không trừ gì nếu thiếu bất kỳ nguyên liệu nào
+    # (ghi sổ vào ngày của đơn hàng, kể cả đơn hàng ghi lùi ngày)
+    success, short = apply_inventory_movement(-required, kind='sale', ref=order_id, date=get_order_date(order_id))
+    if not success:
+        # Có thể xảy ra khi máy khác vừa dùng hết nguyên liệu sau bước kiểm tra
+        if short:
+            st.error(f"Lỗi: Không đủ nguyên liệu {short[0]} để thực hiện đơn hàng!")
+        return False
     
+    # Ghi giá vốn nguyên liệu và các chi phí lên đơn hàng để doanh thu (kể cả khi tính lại) và việc
+    # xóa đơn dùng đúng chi phí lúc bán
+    fees = order_cost_breakdown(order_id)
+    orders = st.session_state.orders
+    rows = orders['order_id'] == order_id
+    orders.loc[rows, 'material_cost'] = material_cost
+    for column in ORDER_COST_COLUMNS[1:]:
+        orders.loc[rows, column] = fees[column]
     return True
 
 def calculate_cost_of_goods(order_id):
@@ -433,54 +2495,13 @@ def calculate_cost_of_goods(order_id):
     Tính toán chi phí cho một đơn hàng và phân tách thành chi phí nguyên liệu và chi phí khác
     Trả về dict chứa chi phí nguyên liệu, chi phí khác và tổng chi phí
     """
-    total_material_cost = 0
-    total_other_cost = 0  # Bao gồm chi phí khác và chi phí khấu hao
-    
-    order_items_df = st.session_state.order_items[st.session_state.order_items['order_id'] == order_id]
-    
-    for _, item in order_items_df.iterrows():
-        product_id = item['product_id']
-        order_quantity = item['quantity']
-        
-        # Lấy chi phí từ thông tin sản phẩm (nếu có)
-        product_other_fee = 0
-        product_depreciation_fee = 0
-        
-        if 'product_costs' in st.session_state and not st.session_state.product_costs.empty:
-            product_cost_data = st.session_state.product_costs[
-                st.session_state.product_costs['product_id'] == product_id
-            ]
-            
-            if not product_cost_data.empty:
-                # Ensure column names are accessed correctly
-                if 'other_fee' in product_cost_data.columns:
-                    product_other_fee = product_cost_data['other_fee'].iloc[0] * order_quantity
-                
-                # Make sure we're accessing the correct column name for depreciation fee
-                if 'Depreciation_fee' in product_cost_data.columns:  # Note the capital 'D'
-                    product_depreciation_fee = product_cost_data['Depreciation_fee'].iloc[0] * order_quantity
-        
-        # Cộng vào tổng chi phí khác
-        total_other_cost += product_other_fee + product_depreciation_fee
-        
-        # Tính chi phí nguyên liệu dựa vào công thức
-        product_material_cost = 0
-        product_recipe = st.session_state.recipes[st.session_state.recipes['product_id'] == product_id]
-        
-        for _, recipe_item in product_recipe.iterrows():
-            material_id = recipe_item['material_id']
-            material_quantity = recipe_item['quantity'] * order_quantity
-            
-            # Lấy giá nguyên liệu
-            material_data = st.session_state.materials[
-                st.session_state.materials['material_id'] == material_id
-            ]
-            
-            if not material_data.empty:
-                material_price = material_data['price_per_unit'].iloc[0]
-                product_material_cost += material_quantity * material_price
-        
-        total_material_cost += product_material_cost
+    # Đơn hàng mới có các chi phí ghi lúc bán (giá vốn theo phương pháp tính giá), đơn cũ dùng giá thành đơn vị
+    costs = {column: order_recorded_cost(order_id, column) for column in ORDER_COST_COLUMNS}
+    if any(value is None for value in costs.values()):
+        current = order_cost_breakdown(order_id)
+        costs = {column: current[column] if value is None else value for column, value in costs.items()}
+    total_material_cost = costs['material_cost']
+    total_other_cost = costs['other_fee'] + costs['Depreciation_fee']  # Bao gồm chi phí khác và chi phí khấu hao
     
     # Trả về dict chứa chi tiết chi phí
     return {
@@ -495,180 +2516,451 @@ def check_sufficient_materials(selected_products, quantities):
     Trả về True nếu đủ, False nếu không đủ, cùng với danh sách nguyên liệu thiếu
     """
     # Tính toán tổng nguyên liệu cần thiết cho đơn hàng
-    required_materials = {}
-    
-    for product, quantity in zip(selected_products, quantities):
-        product_id = product['product_id']
-        # Lấy công thức của sản phẩm
-        product_recipe = st.session_state.recipes[st.session_state.recipes['product_id'] == product_id]
-        
-        # Cho mỗi nguyên liệu trong công thức
-        for _, recipe_item in product_recipe.iterrows():
-            material_id = recipe_item['material_id']
-            material_quantity_needed = recipe_item['quantity'] * quantity
-            
-            # Cộng dồn vào tổng nguyên liệu cần thiết
-            if material_id in required_materials:
-                required_materials[material_id] += material_quantity_needed
-            else:
-                required_materials[material_id] = material_quantity_needed
+    product_ids = [product['product_id'] for product in selected_products]
+    required = materials_required(pd.Series(list(quantities), index=product_ids, dtype=float))
     
     # Kiểm tra xem có đủ nguyên liệu trong kho không
-    insufficient_materials = []
-    
-    for material_id, required_quantity in required_materials.items():
-        # Lấy thông tin nguyên liệu
-        material_data = st.session_state.materials[st.session_state.materials['material_id'] == material_id]
-        
-        if not material_data.empty:
-            available_quantity = material_data['quantity'].iloc[0]
-            material_name = material_data['name'].iloc[0]
-            material_unit = material_data['unit'].iloc[0]
-            
-            # So sánh số lượng cần với số lượng hiện có
-            if required_quantity > available_quantity:
-                insufficient_materials.append({
-                    'id': material_id,
-                    'name': material_name,
-                    'unit': material_unit,
-                    'required': required_quantity,
-                    'available': available_quantity,
-                    'shortage': required_quantity - available_quantity
-                })
+    stock = material_rows()
+    stock = stock[stock.index.isin(required.index)]
+    required = required.reindex(stock.index)
+    short = required > stock['quantity']
+    
+    insufficient_materials = [
+        {
+            'id': material_id,
+            'name': stock.at[material_id, 'name'],
+            'unit': stock.at[material_id, 'unit'],
+            'required': required[material_id],
+            'available': stock.at[material_id, 'quantity'],
+            'shortage': required[material_id] - stock.at[material_id, 'quantity']
+        }
+        for material_id in stock.index[short]
+    ]
     
     return len(insufficient_materials) == 0, insufficient_materials
 
-# Function to update income records after completing an order
-def update_income(order_id):
-    order_data = st.session_state.orders[st.session_state.orders['order_id'] == order_id].iloc[0]
-    order_date = order_data['date']
-    
-    # Get product amount 
-    product_amount = float(order_data['total_amount'])
-    
-    # Lấy thông tin giảm giá (nếu có)
-    discount_amount = order_data.get('discount_amount', 0)
+def compute_income_rows(orders):
+    """
+    Tổng hợp doanh thu theo ngày của các đơn hàng cho trước bằng các phép groupby vectơ
+    - total_sales: tiền sản phẩm sau giảm giá (không gồm phí vận chuyển), discount_costs: tiền giảm giá
+    - cost_of_goods, other_costs, depreciation_costs: giá vốn nguyên liệu, chi phí khác và khấu hao
+      ghi trên đơn hàng lúc bán (ORDER_COST_COLUMNS); đơn hàng cũ chưa ghi thì theo bảng giá thành đơn vị
+    - profit = total_sales - cost_of_goods - other_costs - depreciation_costs
+    """
+    if orders.empty:
+        return default_income.copy()
     
-    # Calculate total revenue (không bao gồm phí vận chuyển nữa)
-    total_amount = product_amount
+    def order_column(column):
+        if column not in orders.columns:
+            return pd.Series(np.nan, index=orders.index)
+        return pd.to_numeric(orders[column], errors='coerce')
     
-    # Calculate cost of materials used (đổi tên từ cost_of_goods)
-    try:
-        cost_of_goods_value = calculate_cost_of_goods(order_id)
-        if isinstance(cost_of_goods_value, dict):
-            # Nếu là dict, lấy giá trị từ dict
-            if len(cost_of_goods_value) > 0:
-                material_cost = float(cost_of_goods_value.get('material_cost', 0))
-                cost_of_goods = material_cost  # Chỉ lấy chi phí nguyên liệu
-            else:
-                cost_of_goods = 0.0
-        else:
-            # Nếu không phải dict, chuyển sang float
-            cost_of_goods = float(cost_of_goods_value)
-    except Exception as e:
-        if show_debug:
-            st.sidebar.error(f"Error calculating material cost: {str(e)}")
-        cost_of_goods = 0.0
+    costs = {column: order_column(column) for column in ORDER_COST_COLUMNS}
+    if any(values.isna().any() for values in costs.values()):
+        # Chỉ đơn hàng cũ cần chi phí theo giá thành đơn vị hiện tại
+        order_items = st.session_state.order_items
+        items = order_items[order_items['order_id'].isin(orders['order_id'])]
+        quantities = pd.to_numeric(items['quantity'], errors='coerce').fillna(0).to_numpy()
+        unit_costs = get_unit_costs().reindex(items['product_id']).fillna(0)
+        item_costs = pd.DataFrame({'order_id': items['order_id'].to_numpy()})
+        for column in ORDER_COST_COLUMNS:
+            item_costs[column] = unit_costs[column].to_numpy() * quantities
+        per_order = item_costs.groupby('order_id').sum().reindex(orders['order_id']).fillna(0)
+        costs = {
+            column: values.fillna(pd.Series(per_order[column].to_numpy(), index=orders.index))
+            for column, values in costs.items()
+        }
     
-    # Lấy thông tin chi phí khác và chi phí khấu hao từ product_costs
-    other_costs = 0.0
-    depreciation_costs = 0.0
+    facts = pd.DataFrame({
+        'date': orders['date'].to_numpy(),
+        'total_sales': order_column('total_amount').fillna(0).to_numpy(),
+        'cost_of_goods': costs['material_cost'].to_numpy(),
+        'other_costs': costs['other_fee'].to_numpy(),
+        'depreciation_costs': costs['Depreciation_fee'].to_numpy(),
+        'discount_costs': order_column('discount_amount').fillna(0).to_numpy(),
+    })
+    daily = facts.groupby('date', as_index=False).sum()
+    daily['profit'] = daily['total_sales'] - daily['cost_of_goods'] - daily['other_costs'] - daily['depreciation_costs']
+    return apply_table_schema('income', daily[list(default_income.columns)])
+
+def _invoiced_orders(orders, excluded_invoice_ids=()):
+    """Các đơn hàng có hóa đơn (bỏ qua các hóa đơn sắp bị xóa)"""
+    invoices = st.session_state.invoices
+    if len(excluded_invoice_ids):
+        invoices = invoices[~invoices['invoice_id'].isin(excluded_invoice_ids)]
+    return orders[orders['order_id'].isin(invoices['order_id'])]
+
+def refresh_income_days(dates, excluded_invoice_ids=()):
+    """
+    Tính lại dòng doanh thu (và các ô cube doanh thu) của các ngày cho trước từ đơn hàng của riêng những ngày đó
+    Ngày không còn đơn hàng nào thì dòng doanh thu bị xóa
+    """
+    dates = list(dates)
+    orders = st.session_state.orders
+    rows = compute_income_rows(_invoiced_orders(orders[orders['date'].isin(dates)], excluded_invoice_ids))
+    income = get_table('income')
+    st.session_state.income = pd.concat(
+        [income[~income['date'].isin(dates)], rows], ignore_index=True
+    ).sort_values('date', kind='stable').reset_index(drop=True)
+    refresh_sales_cube_days(dates, excluded_invoice_ids)
+
+def rebuild_income():
+    """
+    Dựng lại toàn bộ bảng doanh thu theo ngày từ đơn hàng
+    Ngày có đơn hàng cũ chưa ghi chi phí lúc bán giữ nguyên dòng doanh thu đã có, vì tính lại
+    sẽ dùng giá thành đơn vị hiện tại thay cho giá của ngày bán
+    """
+    orders = _invoiced_orders(st.session_state.orders)
+    recorded = orders.reindex(columns=ORDER_COST_COLUMNS).apply(pd.to_numeric, errors='coerce').notna().all(axis=1)
+    income = get_table('income')
+    kept = income[income['date'].isin(orders.loc[~recorded, 'date'])]
+    rows = compute_income_rows(orders)
+    st.session_state.income = pd.concat(
+        [rows[~rows['date'].isin(kept['date'])], kept], ignore_index=True
+    ).sort_values('date', kind='stable').reset_index(drop=True)
+
+class PrefixSumIndex:
+    """Tổng cộng dồn theo ngày của các cột số trong một bảng, tách theo nhóm danh mục.
+
+    Mỗi nhóm giữ mảng ngày đã sắp xếp và mảng tổng cộng dồn (dòng đầu bằng 0), nên
+    tổng của một khoảng ngày bất kỳ chỉ cần hai lần tìm kiếm nhị phân và một phép trừ.
+    Các dòng thêm vào cuối bảng được cộng dồn tiếp; chỉ mục chỉ dựng lại khi dòng cũ bị sửa hoặc xóa.
+    """
     
-    # Lấy danh sách sản phẩm trong đơn hàng
-    order_items_df = st.session_state.order_items[st.session_state.order_items['order_id'] == order_id]
+    def __init__(self, metrics, categories=()):
+        self.metrics = list(metrics)
+        self.categories = list(categories)
+        self.version = None
+        self.writes = None
+        self._row_hashes = None
+        self._groups = {}
     
-    # Nếu có theo dõi chi phí sản phẩm
-    if 'product_costs' in st.session_state and not st.session_state.product_costs.empty:
-        for _, item in order_items_df.iterrows():
-            product_id = item['product_id']
-            quantity = float(item['quantity'])
-            
-            # Tìm thông tin chi phí của sản phẩm
-            product_cost_data = st.session_state.product_costs[st.session_state.product_costs['product_id'] == product_id]
-            
-            if not product_cost_data.empty:
-                # Lấy chi phí khác
-                if 'other_fee' in product_cost_data.columns:
-                    try:
-                        other_fee = float(product_cost_data['other_fee'].iloc[0])
-                        other_costs += other_fee * quantity
-                    except Exception as e:
-                        if show_debug:
-                            st.sidebar.error(f"Error converting other_fee: {str(e)}")
-                
-                # Lấy chi phí khấu hao
-                if 'Depreciation_fee' in product_cost_data.columns:
-                    try:
-                        depreciation_fee = float(product_cost_data['Depreciation_fee'].iloc[0])
-                        depreciation_costs += depreciation_fee * quantity
-                    except Exception as e:
-                        if show_debug:
-                            st.sidebar.error(f"Error converting Depreciation_fee: {str(e)}")
+    def _row_hash(self, df):
+        columns = ['date', *self.categories, *self.metrics]
+        return pd.util.hash_pandas_object(df.reindex(columns=columns), index=False).to_numpy()
     
-    # Calculate profit (lợi nhuận trước khi trừ các chi phí nhập hàng và nhân công)
-    try:
-        profit = float(total_amount) - float(cost_of_goods) - float(other_costs) - float(depreciation_costs)
-    except Exception as e:
-        if show_debug:
-            st.sidebar.error(f"Error calculating profit: {str(e)}")
-        profit = 0.0
-    
-    # Check if date already exists in income DataFrame
-    if order_date in st.session_state.income['date'].values:
-        idx = st.session_state.income[st.session_state.income['date'] == order_date].index[0]
-        st.session_state.income.at[idx, 'total_sales'] += total_amount
-        st.session_state.income.at[idx, 'cost_of_goods'] += cost_of_goods
-        st.session_state.income.at[idx, 'profit'] += profit
-        
-        # Track other costs
-        if 'other_costs' in st.session_state.income.columns:
-            st.session_state.income.at[idx, 'other_costs'] += other_costs
+    def _add(self, group, dates, amounts):
+        """Cộng tổng theo ngày (ngày đã sắp xếp, không trùng) vào một nhóm"""
+        entry = self._groups.get(group)
+        if entry is None:
+            old_dates, old_amounts = dates[:0], amounts[:0]
         else:
-            st.session_state.income['other_costs'] = 0
-            st.session_state.income.at[idx, 'other_costs'] = other_costs
-            
-        # Track depreciation costs
-        if 'depreciation_costs' in st.session_state.income.columns:
-            st.session_state.income.at[idx, 'depreciation_costs'] += depreciation_costs
+            old_dates, cumulative = entry
+            if dates[0] > old_dates[-1]:
+                # Chỉ thêm ngày mới ở cuối: cộng dồn tiếp từ tổng cuối cùng
+                self._groups[group] = (
+                    np.concatenate([old_dates, dates]),
+                    np.vstack([cumulative, cumulative[-1] + np.cumsum(amounts, axis=0)])
+                )
+                return
+            old_amounts = np.diff(cumulative, axis=0)
+        
+        merged_dates = np.union1d(old_dates, dates)
+        merged = np.zeros((len(merged_dates), len(self.metrics)))
+        merged[np.searchsorted(merged_dates, old_dates)] += old_amounts
+        merged[np.searchsorted(merged_dates, dates)] += amounts
+        self._groups[group] = (
+            merged_dates,
+            np.vstack([np.zeros((1, len(self.metrics))), np.cumsum(merged, axis=0)])
+        )
+    
+    def _merge(self, df):
+        """Cộng các dòng của df vào chỉ mục"""
+        frame = df.reindex(columns=['date', *self.categories, *self.metrics])
+        frame = frame[frame['date'].notna()]
+        if frame.empty:
+            return
+        values = frame[self.metrics].apply(pd.to_numeric, errors='coerce').fillna(0)
+        keys = [frame[column].astype(str) for column in [*self.categories, 'date']]
+        daily = values.groupby(keys, sort=True).sum()
+        if self.categories:
+            blocks = daily.groupby(level=list(range(len(self.categories))), sort=False)
         else:
-            st.session_state.income['depreciation_costs'] = 0
-            st.session_state.income.at[idx, 'depreciation_costs'] = depreciation_costs
-            
-        # Track discount costs - THÊM MỚI
-        if 'discount_costs' in st.session_state.income.columns:
-            st.session_state.income.at[idx, 'discount_costs'] += discount_amount
+            blocks = [((), daily)]
+        for group, block in blocks:
+            group = group if isinstance(group, tuple) else (group,)
+            dates = block.index.get_level_values(-1).to_numpy(dtype=str)
+            self._add(group, dates, block.to_numpy(dtype=float))
+    
+    def rebuild(self, df):
+        """Dựng lại toàn bộ chỉ mục từ df"""
+        self._groups = {}
+        self._row_hashes = None
+        self._merge(df)
+    
+    def sync(self, df, writes=None):
+        """
+        Đồng bộ với bảng: chỉ cộng các dòng mới ở cuối nếu các dòng đã đánh chỉ mục không đổi
+        writes: số lần bảng đã được lưu (table_writes). Khi không đổi, chỉ số dòng và dòng cuối đã
+        đánh chỉ mục được so sánh, nên mỗi lần chạy lại trang không phải băm lại cả bảng; sau mỗi
+        lần lưu, mọi dòng được so lại một lần để phát hiện dòng cũ bị sửa hoặc xóa
+        """
+        known = self._row_hashes
+        if known is not None and writes is not None and writes == self.writes and len(df) >= len(known):
+            count = len(known)
+            if count == 0 or self._row_hash(df.iloc[count - 1:count])[0] == known[-1]:
+                if len(df) > count:
+                    tail = df.iloc[count:]
+                    self._merge(tail)
+                    self._row_hashes = np.concatenate([known, self._row_hash(tail)])
+                return
+        
+        hashes = self._row_hash(df)
+        if known is not None and len(hashes) >= len(known) and np.array_equal(hashes[:len(known)], known):
+            self._merge(df.iloc[len(known):])
         else:
-            st.session_state.income['discount_costs'] = 0
-            st.session_state.income.at[idx, 'discount_costs'] = discount_amount
+            self.rebuild(df)
+        self._row_hashes = hashes
+        self.writes = writes
+        self.version = None
+    
+    def range_totals(self, starts, ends, **filters):
+        """
+        Tổng các cột trong từng khoảng ngày [starts[i], ends[i]] (bao gồm hai đầu) của các nhóm khớp bộ lọc
+        Trả về mảng (số khoảng × số cột)
+        """
+        starts = np.asarray(starts, dtype=str)
+        ends = np.asarray(ends, dtype=str)
+        positions = {self.categories.index(column): str(value) for column, value in filters.items()}
+        result = np.zeros((len(starts), len(self.metrics)))
+        for group, (dates, cumulative) in self._groups.items():
+            if any(group[position] != value for position, value in positions.items()):
+                continue
+            lo = np.searchsorted(dates, starts, side='left')
+            hi = np.searchsorted(dates, ends, side='right')
+            result += np.where((hi > lo)[:, None], cumulative[hi] - cumulative[lo], 0.0)
+        return result
+    
+    def total(self, start_date=None, end_date=None, **filters):
+        """Tổng các cột trong một khoảng ngày, dạng Series theo tên cột"""
+        start_date = _date_key(start_date) or '0000-00-00'
+        end_date = _date_key(end_date) or '9999-12-31'
+        return pd.Series(self.range_totals([start_date], [end_date], **filters)[0], index=self.metrics)
+
+def get_prefix_index(name, metrics, categories=()):
+    """
+    Chỉ mục tổng cộng dồn của một bảng, đồng bộ với dữ liệu hiện tại
+    - Bảng đã nạp trong phiên: chỉ các dòng mới thêm vào cuối được cộng vào chỉ mục (các dòng cũ
+      chỉ được so lại sau khi bảng được lưu)
+    - Bảng chưa nạp (hoặc khi bật aggregation pushdown): chỉ đọc tổng theo ngày từ MongoDB, và đọc lại khi bảng có ghi mới
+    """
+    indexes = st.session_state.setdefault('_prefix_indexes', {})
+    key = (name, tuple(metrics), tuple(categories))
+    index = indexes.get(key)
+    if index is None:
+        index = indexes[key] = PrefixSumIndex(metrics, categories)
+    
+    mongo_connected = "mongo_client" in st.session_state and "mongo_db" in st.session_state
+    if (name not in st.session_state and mongo_connected) or _aggregates_on_server(name):
+        # Daily totals are enough to build the index (computed by MongoDB with aggregation pushdown)
+        version = _table_cache().version(name)
+        if index.version != version:
+            index.rebuild(aggregate_dataframe(name, ['date', *categories], metrics))
+            index.version = version
     else:
-        # Create new row for this date
-        if 'other_costs' not in st.session_state.income.columns:
-            # Add other costs column if it doesn't exist
-            st.session_state.income['other_costs'] = 0
-            
-        if 'depreciation_costs' not in st.session_state.income.columns:
-            # Add depreciation costs column if it doesn't exist
-            st.session_state.income['depreciation_costs'] = 0
-            
-        if 'discount_costs' not in st.session_state.income.columns:
-            # Add discount costs column if it doesn't exist - THÊM MỚI
-            st.session_state.income['discount_costs'] = 0
-            
-        new_row = pd.DataFrame({
-            'date': [order_date],
-            'total_sales': [total_amount],
-            'cost_of_goods': [cost_of_goods],
-            'profit': [profit],
-            'other_costs': [other_costs],
-            'depreciation_costs': [depreciation_costs],
-            'discount_costs': [discount_amount]  # THÊM MỚI
-        })
-        
-        st.session_state.income = pd.concat([st.session_state.income, new_row], ignore_index=True)
+        index.sync(get_table(name), table_writes(name))
+    return index
+
+def previous_period(start_date, end_date):
+    """Khoảng ngày cùng độ dài ngay trước khoảng cho trước, để so sánh kỳ trước"""
+    start = datetime.datetime.strptime(_date_key(start_date), '%Y-%m-%d').date()
+    end = datetime.datetime.strptime(_date_key(end_date), '%Y-%m-%d').date()
+    previous_end = start - datetime.timedelta(days=1)
+    previous_start = previous_end - (end - start)
+    return previous_start.strftime('%Y-%m-%d'), previous_end.strftime('%Y-%m-%d')
+
+# Kỳ báo cáo: tên hiển thị và tần suất pandas Period tương ứng
+REPORT_PERIODS = {
+    'week': ('Tuần', 'W'),
+    'month': ('Tháng', 'M'),
+    'quarter': ('Quý', 'Q'),
+    'year': ('Năm', 'Y'),
+}
+
+# Các cột của báo cáo doanh thu: (bảng nguồn, cột giá trị)
+REPORT_SOURCES = {
+    'total_sales': ('income', 'total_sales'),
+    'gross_profit': ('income', 'profit'),
+    'cost_of_goods': ('income', 'cost_of_goods'),
+    'other_costs': ('income', 'other_costs'),
+    'depreciation_costs': ('income', 'depreciation_costs'),
+    'discount_costs': ('income', 'discount_costs'),
+    'material_import_costs': ('material_costs', 'total_cost'),
+    'labor_costs': ('labor_costs', 'total_cost'),
+    'marketing_costs': ('marketing_costs', 'amount'),
+}
+
+# Các cột được tính vào tổng chi phí
+REPORT_COST_COLUMNS = [
+    'cost_of_goods', 'material_import_costs', 'labor_costs', 'other_costs',
+    'depreciation_costs', 'discount_costs', 'marketing_costs',
+]
 
+def period_label(period, period_type):
+    """Nhãn hiển thị của một kỳ báo cáo"""
+    if period_type == 'week':
+        return period.start_time.strftime('%d/%m/%Y')
+    if period_type == 'quarter':
+        return f"Q{period.quarter}/{period.year}"
+    if period_type == 'year':
+        return str(period.year)
+    return period.strftime('%m/%Y')
 
-# Cập nhật hàm adjust_income_after_delete_invoice để giữ lại chi phí khấu hao và chi phí nguyên liệu đã sử dụng
-# Đơn giản hóa cách xử lý khi xóa hóa đơn
+def period_totals(df, columns, start_date, end_date, period_type='month'):
+    """
+    Tổng các cột của một bảng theo kỳ bằng một phép groupby duy nhất (không sửa bảng đầu vào)
+    Kết quả có đủ mọi kỳ giao với khoảng ngày (kỳ không có dữ liệu bằng 0)
+    """
+    freq = REPORT_PERIODS[period_type][1]
+    periods = pd.period_range(_date_key(start_date), _date_key(end_date), freq=freq)
+    if df is None or df.empty or 'date' not in df.columns:
+        return pd.DataFrame(0.0, index=periods, columns=columns)
+
+    keys = pd.to_datetime(df['date'], errors='coerce').dt.to_period(freq)
+    values = df.reindex(columns=columns).apply(pd.to_numeric, errors='coerce').fillna(0)
+    return values.groupby(keys).sum().reindex(periods, fill_value=0).astype(float)
+
+def report_range_totals(starts, ends):
+    """Doanh thu và các loại chi phí của từng khoảng ngày, tra từ chỉ mục tổng cộng dồn của mỗi bảng nguồn"""
+    by_table = {}
+    for column, (table, source_column) in REPORT_SOURCES.items():
+        by_table.setdefault(table, {})[source_column] = column
+    
+    report = {}
+    for table, columns in by_table.items():
+        totals = get_prefix_index(table, list(columns)).range_totals(starts, ends)
+        for position, column in enumerate(columns.values()):
+            report[column] = totals[:, position]
+    report = pd.DataFrame(report)[list(REPORT_SOURCES)]
+    report['total_costs'] = report[REPORT_COST_COLUMNS].sum(axis=1)
+    report['net_profit'] = report['total_sales'] - report['total_costs']
+    return report
+
+def build_period_report(start_date, end_date, period_type='month'):
+    """
+    Báo cáo doanh thu và mọi loại chi phí theo tuần/tháng/quý/năm trong khoảng ngày
+    - total_costs: giá vốn + nhập hàng + nhân công + chi phí khác + khấu hao + giảm giá + marketing
+    - net_profit = total_sales - total_costs
+    """
+    start_date, end_date = _date_key(start_date), _date_key(end_date)
+    periods = pd.period_range(start_date, end_date, freq=REPORT_PERIODS[period_type][1])
+    # Kỳ đầu và kỳ cuối được cắt theo khoảng ngày đã chọn
+    starts = periods.start_time.strftime('%Y-%m-%d').to_numpy(dtype=str)
+    ends = periods.end_time.strftime('%Y-%m-%d').to_numpy(dtype=str)
+    starts[starts < start_date] = start_date
+    ends[ends > end_date] = end_date
+    
+    report = report_range_totals(starts, ends)
+    sales = report['total_sales'].to_numpy()
+    report['profit_margin'] = np.divide(
+        report['net_profit'].to_numpy() * 100, sales, out=np.zeros(len(report)), where=sales > 0
+    )
+    report.index = [period_label(period, period_type) for period in periods]
+    return report
+
+# Các chiều và số đo của cube doanh thu (mức chi tiết: ngày)
+SALES_CUBE_DIMENSIONS = ['date', 'product_id', 'category', 'customer', 'payment_method']
+SALES_CUBE_MEASURES = ['revenue', 'quantity', 'lines']
+
+# Khóa của một ô trong bảng sales_cube (danh mục được ghép từ bảng sản phẩm khi truy vấn)
+SALES_CUBE_KEYS = ['date', 'product_id', 'customer', 'payment_method']
+
+def _sales_cube_cells(orders, excluded_invoice_ids=()):
+    """Các ô của cube (tổng theo ngày × sản phẩm × khách hàng × thanh toán) của các đơn hàng đã có hóa đơn"""
+    orders = _invoiced_orders(orders, excluded_invoice_ids).drop_duplicates('order_id').set_index('order_id')
+    order_items = st.session_state.order_items
+    lines = order_items[order_items['order_id'].isin(orders.index)]
+    invoices = st.session_state.invoices
+    invoices = invoices[~invoices['invoice_id'].isin(list(excluded_invoice_ids))]
+    payments = invoices.drop_duplicates('order_id').set_index('order_id')['payment_method']
+    quantity = pd.to_numeric(lines['quantity'], errors='coerce').fillna(0)
+    price = pd.to_numeric(lines['price'], errors='coerce').fillna(0) if 'price' in lines.columns else 0
+    revenue = pd.to_numeric(lines['subtotal'], errors='coerce').fillna(quantity * price) if 'subtotal' in lines.columns else quantity * price
+    
+    def dimension(values):
+        return values.fillna('').astype(str).to_numpy()
+    
+    facts = pd.DataFrame({
+        'date': dimension(orders['date'].reindex(lines['order_id'])),
+        'product_id': dimension(lines['product_id']),
+        'customer': dimension(orders['customer_name'].reindex(lines['order_id'])),
+        'payment_method': dimension(payments.reindex(lines['order_id'])),
+        'revenue': revenue.to_numpy(dtype=float),
+        'quantity': quantity.to_numpy(dtype=float),
+        'lines': 1,
+    })
+    cells = facts.groupby(SALES_CUBE_KEYS, as_index=False, sort=False).sum()
+    return apply_table_schema('sales_cube', cells.reindex(columns=default_sales_cube.columns))
+
+def refresh_sales_cube_days(dates, excluded_invoice_ids=()):
+    """Tính lại các ô cube doanh thu của các ngày cho trước từ đơn hàng của riêng những ngày đó"""
+    dates = [_date_key(date) for date in dates]
+    orders = st.session_state.orders
+    cells = _sales_cube_cells(orders[orders['date'].isin(dates)], excluded_invoice_ids)
+    cube = get_table('sales_cube')
+    st.session_state.sales_cube = pd.concat(
+        [cube[~cube['date'].isin(dates)], cells], ignore_index=True
+    ).sort_values('date', kind='stable').reset_index(drop=True)
+
+def rebuild_sales_cube():
+    """Dựng lại toàn bộ cube doanh thu từ đơn hàng"""
+    st.session_state.sales_cube = _sales_cube_cells(st.session_state.orders).sort_values(
+        'date', kind='stable'
+    ).reset_index(drop=True)
+
+def sales_cube_cells(start_date=None, end_date=None):
+    """
+    Các ô cube doanh thu trong khoảng ngày, kèm danh mục của sản phẩm
+    Khi bảng chưa được nạp, chỉ các ô trong khoảng ngày được đọc từ MongoDB
+    """
+    cells = query_dataframe('sales_cube', start_date, end_date)
+    categories = get_table('products').drop_duplicates('product_id').set_index('product_id')['category']
+    cells = cells.assign(category=categories.reindex(cells['product_id']).fillna('').astype(str).to_numpy())
+    return cells[SALES_CUBE_DIMENSIONS + SALES_CUBE_MEASURES]
+
+def cube_query(by=('category',), start_date=None, end_date=None, measures=SALES_CUBE_MEASURES, cells=None, **filters):
+    """
+    Truy vấn cube doanh thu: lọc theo khoảng ngày và giá trị của các chiều (slice/dice), gom nhóm theo `by`
+    - by: các chiều trong SALES_CUBE_DIMENSIONS, hoặc 'month'/'year' (gom theo tháng/năm của ngày)
+    - cells: các ô đã đọc bằng sales_cube_cells cho khoảng ngày này (None: đọc lại)
+    - filters: chiều -> một giá trị hoặc danh sách giá trị
+    Trả về DataFrame gồm các cột của `by` và các số đo, sắp xếp giảm dần theo số đo đầu tiên
+    """
+    if cells is None:
+        cells = sales_cube_cells(start_date, end_date)
+    mask = pd.Series(True, index=cells.index)
+    for dimension, value in filters.items():
+        if dimension not in SALES_CUBE_DIMENSIONS:
+            raise ValueError(f"Chiều không hợp lệ: {dimension}")
+        if isinstance(value, (list, tuple, set, pd.Index, np.ndarray)):
+            mask &= cells[dimension].isin(list(value))
+        else:
+            mask &= cells[dimension] == value
+    
+    selected = cells[mask]
+    measures = list(measures)
+    if not by:
+        return selected[measures].sum().to_frame().T
+    
+    keys = {}
+    for dimension in by:
+        if dimension == 'month':
+            keys[dimension] = selected['date'].str[:7]
+        elif dimension == 'year':
+            keys[dimension] = selected['date'].str[:4]
+        elif dimension in SALES_CUBE_DIMENSIONS:
+            keys[dimension] = selected[dimension]
+        else:
+            raise ValueError(f"Chiều không hợp lệ: {dimension}")
+    grouped = selected[measures].groupby([keys[dimension] for dimension in by]).sum()
+    grouped.index.names = list(by)
+    return grouped.reset_index().sort_values(measures[0], ascending=False, kind='stable').reset_index(drop=True)
+
+# Function to update income records after completing an order
+def update_income(order_id):
+    """Cập nhật dòng doanh thu của ngày có đơn hàng (gọi sau khi đã tạo hóa đơn)"""
+    order_dates = st.session_state.orders.loc[st.session_state.orders['order_id'] == order_id, 'date']
+    refresh_income_days(order_dates.unique())
 
 def adjust_income_after_delete_invoice(invoice_id, order_id):
     """Điều chỉnh dữ liệu doanh thu sau khi xóa hóa đơn - xóa các chi phí liên quan đến đơn hàng
@@ -692,92 +2984,10 @@ def adjust_income_after_delete_invoice(invoice_id, order_id):
         # 1. Hoàn lại nguyên liệu đã sử dụng
         restore_materials_after_delete_order(order_id)
         
-        # 2. Xóa dữ liệu doanh thu liên quan đến đơn hàng (chi phí nhập hàng được theo dõi
+        # 2. Tính lại doanh thu của ngày đó không kể hóa đơn bị xóa (chi phí nhập hàng được theo dõi
         # trong bảng material_costs riêng và không bị ảnh hưởng)
-        if order_date in st.session_state.income['date'].values:
-            # Tìm dòng doanh thu ứng với ngày của hóa đơn
-            income_rows = st.session_state.income[st.session_state.income['date'] == order_date]
-            
-            if not income_rows.empty:
-                idx = income_rows.index[0]
-                
-                # Lấy tổng giá trị đơn hàng
-                total_amount = float(order_data['total_amount'])
-                
-                # Lấy giá trị giảm giá (nếu có) - THÊM MỚI
-                discount_amount = float(order_data.get('discount_amount', 0))
-                
-                # Tính chi phí của đơn hàng
-                try:
-                    cost_result = calculate_cost_of_goods(order_id)
-                    if isinstance(cost_result, dict):
-                        # CHỖ NÀY CÓ SỬA - chỉ lấy chi phí nguyên liệu
-                        order_cost_of_goods = float(cost_result.get('material_cost', 0))
-                    else:
-                        order_cost_of_goods = float(cost_result)
-                except Exception as e:
-                    if show_debug:
-                        st.sidebar.error(f"Error calculating cost_of_goods for deletion: {str(e)}")
-                    order_cost_of_goods = 0
-                
-                # Tính chi phí khác và chi phí khấu hao từ product_costs
-                order_other_costs = 0
-                order_depreciation_costs = 0
-                for _, item in order_items.iterrows():
-                    product_id = item['product_id']
-                    quantity = float(item['quantity'])
-                    
-                    # Lấy thông tin chi phí khác và chi phí khấu hao sản phẩm
-                    if 'product_costs' in st.session_state and not st.session_state.product_costs.empty:
-                        product_cost_data = st.session_state.product_costs[st.session_state.product_costs['product_id'] == product_id]
-                        
-                        if not product_cost_data.empty:
-                            # Chi phí khác
-                            if 'other_fee' in product_cost_data.columns:
-                                try:
-                                    other_fee = float(product_cost_data['other_fee'].iloc[0])
-                                    order_other_costs += other_fee * quantity
-                                except Exception as e:
-                                    if show_debug:
-                                        st.sidebar.error(f"Error calculating other costs: {str(e)}")
-                            
-                            # Chi phí khấu hao
-                            if 'Depreciation_fee' in product_cost_data.columns:
-                                try:
-                                    depreciation_fee = float(product_cost_data['Depreciation_fee'].iloc[0])
-                                    order_depreciation_costs += depreciation_fee * quantity
-                                except Exception as e:
-                                    if show_debug:
-                                        st.sidebar.error(f"Error calculating depreciation: {str(e)}")
-                
-                # Tính lợi nhuận của đơn hàng
-                order_profit = total_amount - order_cost_of_goods - order_other_costs - order_depreciation_costs
-                
-                # Trừ các giá trị từ dòng doanh thu
-                st.session_state.income.at[idx, 'total_sales'] -= total_amount
-                st.session_state.income.at[idx, 'cost_of_goods'] -= order_cost_of_goods
-                st.session_state.income.at[idx, 'profit'] -= order_profit
-                
-                # Trừ chi phí khác nếu có theo dõi
-                if 'other_costs' in st.session_state.income.columns:
-                    st.session_state.income.at[idx, 'other_costs'] -= order_other_costs
-                
-                # Trừ chi phí khấu hao nếu có theo dõi
-                if 'depreciation_costs' in st.session_state.income.columns:
-                    st.session_state.income.at[idx, 'depreciation_costs'] -= order_depreciation_costs
-                    
-                # Trừ chi phí giảm giá nếu có theo dõi - THÊM MỚI
-                if 'discount_costs' in st.session_state.income.columns:
-                    st.session_state.income.at[idx, 'discount_costs'] -= discount_amount
-                
-                # Kiểm tra nếu sau khi trừ, không còn doanh thu nào trong ngày đó
-                if st.session_state.income.at[idx, 'total_sales'] <= 0:
-                    # Xóa dòng income của ngày đó
-                    # Chi phí nhập hàng được theo dõi riêng trong bảng material_costs
-                    st.session_state.income = st.session_state.income.drop(idx)
-            
-            return True
-        return False
+        refresh_income_days([order_date], excluded_invoice_ids=[invoice_id])
+        return True
     except Exception as e:
         if show_debug:
             st.sidebar.error(f"Error in adjust_income_after_delete_invoice: {str(e)}")
@@ -786,35 +2996,12 @@ def adjust_income_after_delete_invoice(invoice_id, order_id):
 def restore_materials_after_delete_order(order_id):
     """Hoàn lại nguyên liệu đã sử dụng khi xóa đơn hàng"""
     try:
-        # Lấy chi tiết đơn hàng
-        order_items_df = st.session_state.order_items[st.session_state.order_items['order_id'] == order_id]
-        
-        # Cho mỗi sản phẩm trong đơn hàng
-        for _, item in order_items_df.iterrows():
-            product_id = item['product_id']
-            order_quantity = item['quantity']
-            
-            # Lấy công thức của sản phẩm
-            product_recipe = st.session_state.recipes[st.session_state.recipes['product_id'] == product_id]
-            
-            # Cho mỗi nguyên liệu trong công thức, hoàn lại số lượng đã sử dụng
-            for _, recipe_item in product_recipe.iterrows():
-                material_id = recipe_item['material_id']
-                material_quantity_used = recipe_item['quantity'] * order_quantity
-                
-                # Cập nhật số lượng nguyên liệu (hoàn lại)
-                material_rows = st.session_state.materials[st.session_state.materials['material_id'] == material_id]
-                if not material_rows.empty:
-                    material_idx = material_rows.index[0]
-                    
-                    # Tăng số lượng nguyên liệu
-                    st.session_state.materials.at[material_idx, 'quantity'] += material_quantity_used
-                    
-                    # Giảm lượng đã sử dụng
-                    if 'used_quantity' in st.session_state.materials.columns:
-                        st.session_state.materials.at[material_idx, 'used_quantity'] -= material_quantity_used
-        
-        return True
+        # Hoàn lại toàn bộ nguyên liệu của đơn hàng trong một biến động kho
+        success, _ = apply_inventory_movement(
+            materials_required(order_product_quantities([order_id])), kind='return', ref=order_id,
+            date=get_order_date(order_id)
+        )
+        return success
     except Exception as e:
         if show_debug:
             st.sidebar.error(f"Error restoring materials after delete: {str(e)}")
@@ -1215,6 +3402,9 @@ if previous_selection != tab_selection:
     st.session_state.sidebar_selection = tab_selection
     st.rerun()
 
+# Load the tables needed by the selected section
+ensure_tables_loaded(PAGE_TABLES.get(tab_selection, []))
+
 # Order Management Tab
 if tab_selection == "Quản lý Đơn hàng":
     st.header("Quản lý Đơn hàng")
@@ -1447,9 +3637,6 @@ if tab_selection == "Quản lý Đơn hàng":
                     update_success = update_materials_after_order(order_id)
                     
                     if update_success:
-                        # Update income records
-                        update_income(order_id)
-                        
                         # Create invoice
                         invoice_id = f"INV-{uuid.uuid4().hex[:8].upper()}"
                         new_invoice = pd.DataFrame({
@@ -1463,18 +3650,34 @@ if tab_selection == "Quản lý Đơn hàng":
                         
                         st.session_state.invoices = pd.concat([st.session_state.invoices, new_invoice], ignore_index=True)
                         
-                        st.success(f"Đơn hàng {order_id} đã được tạo thành công!")
+                        # Update income records (the day's row is derived from its invoiced orders)
+                        update_income(order_id)
                         
-                        # Generate invoice download link
-                        pdf_data = generate_invoice_content(invoice_id, order_id, as_pdf=True)
-                        st.markdown(download_link(pdf_data, f"Hoadon_{invoice_id}.pdf", "Tải Hóa đơn (PDF)", is_pdf=True), unsafe_allow_html=True)
-
                         # Save data after creating order
-                        save_dataframe(st.session_state.orders, "orders.csv")
-                        save_dataframe(st.session_state.order_items, "order_items.csv")
-                        save_dataframe(st.session_state.invoices, "invoices.csv")
-                        save_dataframe(st.session_state.materials, "materials.csv")
-                        save_dataframe(st.session_state.income, "income.csv")
+                        try:
+                            with unit_of_work():
+                                save_dataframe(st.session_state.orders, "orders.csv")
+                                save_dataframe(st.session_state.order_items, "order_items.csv")
+                                save_dataframe(st.session_state.invoices, "invoices.csv")
+                                save_dataframe(st.session_state.income, "income.csv")
+                                save_dataframe(st.session_state.sales_cube, "sales_cube.csv")
+                        except SaveError as e:
+                            # Kho đã được trừ trên server trước khi lưu đơn hàng: hoàn lại kho
+                            # (ghi thêm biến động hoàn kho vào sổ) và bỏ đơn hàng khỏi phiên
+                            restored = restore_materials_after_delete_order(order_id)
+                            st.session_state.orders = st.session_state.orders[st.session_state.orders['order_id'] != order_id]
+                            st.session_state.order_items = st.session_state.order_items[st.session_state.order_items['order_id'] != order_id]
+                            st.session_state.invoices = st.session_state.invoices[st.session_state.invoices['invoice_id'] != invoice_id]
+                            refresh_income_days([order_date_str])
+                            st.error(f"Không thể lưu đơn hàng {order_id}: {e}")
+                            if not restored:
+                                st.warning("Không hoàn lại được nguyên liệu đã trừ cho đơn hàng này, vui lòng kiểm tra lại tồn kho!")
+                        else:
+                            st.success(f"Đơn hàng {order_id} đã được tạo thành công!")
+                            
+                            # Generate invoice download link
+                            pdf_data = generate_invoice_content(invoice_id, order_id, as_pdf=True)
+                            st.markdown(download_link(pdf_data, f"Hoadon_{invoice_id}.pdf", "Tải Hóa đơn (PDF)", is_pdf=True), unsafe_allow_html=True)
                     else:
                         # Xóa đơn hàng nếu việc cập nhật nguyên liệu thất bại
                         st.session_state.orders = st.session_state.orders[st.session_state.orders['order_id'] != order_id]
@@ -1598,60 +3801,28 @@ if tab_selection == "Quản lý Đơn hàng":
                     
                     # Tính toán nguyên liệu cần thiết
                     if not st.session_state.recipes.empty and not st.session_state.materials.empty:
-                        # Tạo dictionary để lưu tổng lượng nguyên liệu cần thiết
-                        material_needs = {}
-                        
-                        # Cho mỗi sản phẩm trong đơn hàng
-                        for _, item in daily_order_items.iterrows():
-                            product_id = item['product_id']
-                            quantity = item['quantity']
-                            
-                            # Lấy công thức của sản phẩm
-                            product_recipe = st.session_state.recipes[st.session_state.recipes['product_id'] == product_id]
-                            
-                            # Nếu có công thức
-                            if not product_recipe.empty:
-                                for _, recipe_item in product_recipe.iterrows():
-                                    material_id = recipe_item['material_id']
-                                    material_quantity = recipe_item['quantity'] * quantity
-                                    
-                                    # Thêm vào tổng lượng nguyên liệu cần thiết
-                                    if material_id in material_needs:
-                                        material_needs[material_id] += material_quantity
-                                    else:
-                                        material_needs[material_id] = material_quantity
+                        # Tổng lượng nguyên liệu cần thiết cho các đơn hàng trong ngày
+                        material_needs = materials_required(order_product_quantities(order_ids))
                         
                         # Nếu có nhu cầu nguyên liệu
-                        if material_needs:
-                            # Tạo DataFrame cho hiển thị
-                            materials_list = []
-                            
-                            for material_id, quantity_needed in material_needs.items():
-                                # Lấy thông tin nguyên liệu
-                                material_data = st.session_state.materials[st.session_state.materials['material_id'] == material_id]
-                                
-                                if not material_data.empty:
-                                    material_info = material_data.iloc[0]
-                                    material_name = material_info['name']
-                                    material_unit = material_info['unit']
-                                    material_available = material_info['quantity']
-                                    
-                                    # So sánh với lượng tồn kho
-                                    status = "✅ Đủ" if material_available >= quantity_needed else "❌ Thiếu"
-                                    shortage = max(0, quantity_needed - material_available)
-                                    
-                                    materials_list.append({
-                                        'Mã nguyên liệu': material_id,
-                                        'Tên nguyên liệu': material_name,
-                                        'Đơn vị': material_unit,
-                                        'Cần dùng': round(quantity_needed, 5),
-                                        'Tồn kho': round(material_available, 5),
-                                        'Trạng thái': status,
-                                        'Thiếu': round(shortage, 5) if shortage > 0 else 0
-                                    })
+                        if not material_needs.empty:
+                            # So sánh với lượng tồn kho
+                            stock = material_rows()
+                            stock = stock[stock.index.isin(material_needs.index)]
+                            quantity_needed = material_needs.reindex(stock.index)
+                            material_available = stock['quantity'].astype(float)
+                            shortage = (quantity_needed - material_available).clip(lower=0)
                             
-                            # Tạo DataFrame
-                            materials_df = pd.DataFrame(materials_list)
+                            # Tạo DataFrame cho hiển thị
+                            materials_df = pd.DataFrame({
+                                'Mã nguyên liệu': stock.index,
+                                'Tên nguyên liệu': stock['name'].to_numpy(),
+                                'Đơn vị': stock['unit'].to_numpy(),
+                                'Cần dùng': quantity_needed.round(5).to_numpy(),
+                                'Tồn kho': material_available.round(5).to_numpy(),
+                                'Trạng thái': (material_available >= quantity_needed).map({True: "✅ Đủ", False: "❌ Thiếu"}).to_numpy(),
+                                'Thiếu': shortage.round(5).to_numpy()
+                            })
                             
                             # Hiển thị bảng nhu cầu nguyên liệu
                             st.dataframe(materials_df)
@@ -1685,7 +3856,56 @@ if tab_selection == "Quản lý Đơn hàng":
                 st.info(f"Không có đơn hàng nào vào ngày {selected_date}.")
         else:
             st.info("Chưa có dữ liệu đơn hàng. Tạo đơn hàng mới để xem tổng hợp ở đây.")
-            
+        
+        # Dự báo nhu cầu sản phẩm và nguyên liệu
+        st.write("---")
+        st.write("### Dự báo nhu cầu và nguyên liệu")
+        forecast_date = st.date_input(
+            "Ngày cần dự báo",
+            value=datetime.date.today() + datetime.timedelta(days=1),
+            min_value=datetime.date.today(),
+            key="forecast_date"
+        )
+        forecast_date_str = forecast_date.strftime("%Y-%m-%d")
+        
+        forecast = forecast_product_demand(forecast_date)
+        booked = order_product_quantities(
+            st.session_state.orders.loc[st.session_state.orders['date'] == forecast_date_str, 'order_id']
+        )
+        # Đơn hàng đã đặt là mức tối thiểu của nhu cầu
+        expected = pd.concat([forecast, booked], axis=1).fillna(0).max(axis=1).round()
+        expected = expected[expected > 0]
+        
+        if expected.empty:
+            st.info("Chưa đủ dữ liệu đơn hàng để dự báo.")
+        else:
+            product_names = dict(zip(st.session_state.products['product_id'], st.session_state.products['name']))
+            st.dataframe(pd.DataFrame({
+                'Sản phẩm': [product_names.get(pid, pid) for pid in expected.index],
+                'Đã đặt': booked.reindex(expected.index).fillna(0).astype(int).to_numpy(),
+                'Dự báo': forecast.reindex(expected.index).fillna(0).round(1).to_numpy(),
+                'Nên chuẩn bị': expected.astype(int).to_numpy()
+            }))
+            
+            booked_needs = materials_required(booked)
+            expected_needs = materials_required(expected)
+            if not expected_needs.empty:
+                stock = material_rows()
+                stock = stock[stock.index.isin(expected_needs.index)]
+                quantity_needed = expected_needs.reindex(stock.index)
+                material_available = pd.to_numeric(stock['quantity'], errors='coerce').fillna(0)
+                st.dataframe(pd.DataFrame({
+                    'Tên nguyên liệu': stock['name'].to_numpy(),
+                    'Đơn vị': stock['unit'].to_numpy(),
+                    'Cần cho đơn đã đặt': booked_needs.reindex(stock.index).fillna(0).round(5).to_numpy(),
+                    'Cần theo dự báo': quantity_needed.round(5).to_numpy(),
+                    'Tồn kho': material_available.round(5).to_numpy(),
+                    'Thiếu': (quantity_needed - material_available).clip(lower=0).round(5).to_numpy()
+                }))
+                
+                if (quantity_needed > material_available).any():
+                    st.warning("⚠️ Tồn kho không đủ cho nhu cầu dự báo.")
+        
         # Thêm nút để trở về danh sách tất cả đơn hàng
         st.write("---")
         if st.button("Xem tất cả đơn hàng"):
@@ -1730,109 +3950,43 @@ if tab_selection == "Quản lý Đơn hàng":
 elif tab_selection == "Theo dõi Doanh thu":
     st.header("Theo dõi Doanh thu")
     
-    # Initialize material import cost tracking if not exists
-    if 'material_costs' not in st.session_state:
-        st.session_state.material_costs = pd.DataFrame(columns=[
-            'date', 'material_id', 'quantity', 'total_cost', 'supplier'
-        ])
-
-    if 'marketing_costs' not in st.session_state:
-        st.session_state.marketing_costs = pd.DataFrame(columns=[
-            'date', 'campaign_name', 'description', 'platform', 'amount', 'notes'
-        ])
-    
-    income_tab1, income_tab2, income_tab3, income_tab4 = st.tabs([
-            "Báo cáo Tổng quan", "Chi phí Nguyên liệu", "Chi phí Nhân công", "Chi phí Marketing"
+    income_tab1, income_tab2, income_tab3, income_tab4, income_tab5 = st.tabs([
+            "Báo cáo Tổng quan", "Chi phí Nguyên liệu", "Chi phí Nhân công", "Chi phí Marketing", "Phân tích Bán hàng"
         ])    
     # Helper function to create monthly summary
     # Cập nhật hàm create_monthly_summary để phản ánh đúng cấu trúc chi phí mới
 
     def create_monthly_summary(income_df, material_costs_df, labor_costs_df, start_date, end_date):
-        """Tạo bảng tổng hợp doanh thu và chi phí theo tháng"""
+        """Tạo bảng tổng hợp doanh thu và chi phí theo tháng (mỗi bảng được gom nhóm một lần, không sửa dữ liệu đầu vào)"""
         # Ensure we have data in the correct format
         if income_df.empty and material_costs_df.empty and labor_costs_df.empty:
             return pd.DataFrame()
-            
-        # Convert date strings to datetime objects for proper handling
-        income_df['date_obj'] = pd.to_datetime(income_df['date'])
-        if not material_costs_df.empty:
-            material_costs_df['date_obj'] = pd.to_datetime(material_costs_df['date'])
-        if not labor_costs_df.empty:
-            labor_costs_df['date_obj'] = pd.to_datetime(labor_costs_df['date'])
-        
-        # Create a date range from start to end
-        date_range = pd.date_range(start=start_date, end=end_date, freq='MS')  # MS = Month Start
-        
-        # Prepare results table
-        results = []
-        
-        for date in date_range:
-            month_name = date.strftime('%m/%Y')
-            month_start = date.strftime('%Y-%m-%d')
-            month_end = (date + pd.offsets.MonthEnd(1)).strftime('%Y-%m-%d')
-            
-            # Filter income data for this month
-            month_income = income_df[(income_df['date_obj'] >= month_start) & 
-                                (income_df['date_obj'] <= month_end)]
-            
-            # Calculate income values
-            total_sales = month_income['total_sales'].sum() if not month_income.empty else 0
-            cost_of_goods = month_income['cost_of_goods'].sum() if not month_income.empty else 0
-            
-            # Lấy chi phí khác từ income data
-            other_costs = 0
-            if 'other_costs' in month_income.columns:
-                other_costs = month_income['other_costs'].sum() if not month_income.empty else 0
-            
-            # Lấy chi phí khấu hao từ income data
-            depreciation_costs = 0
-            if 'depreciation_costs' in month_income.columns:
-                depreciation_costs = month_income['depreciation_costs'].sum() if not month_income.empty else 0
-                
-            # Lấy chi phí giảm giá từ income data - THÊM MỚI
-            discount_costs = 0
-            if 'discount_costs' in month_income.columns:
-                discount_costs = month_income['discount_costs'].sum() if not month_income.empty else 0
-            
-            # Calculate material costs for this month (chi phí nhập hàng)
-            material_costs = 0
-            if not material_costs_df.empty:
-                month_costs = material_costs_df[(material_costs_df['date_obj'] >= month_start) & 
-                                            (material_costs_df['date_obj'] <= month_end)]
-                material_costs = month_costs['total_cost'].sum() if not month_costs.empty else 0
-            
-            # Calculate labor costs for this month (chi phí nhân công)
-            labor_costs = 0
-            if not labor_costs_df.empty:
-                month_labor = labor_costs_df[(labor_costs_df['date_obj'] >= month_start) & 
-                                        (labor_costs_df['date_obj'] <= month_end)]
-                labor_costs = month_labor['total_cost'].sum() if not month_labor.empty else 0
-            
-            # Tính tổng chi phí từ tất cả các thành phần (bao gồm cả chi phí giảm giá) - THÊM MỚI
-            total_cost = other_costs + depreciation_costs + material_costs + labor_costs + discount_costs
-            
-            # Tính lợi nhuận ròng
-            net_profit = total_sales - total_cost
-            
-            # Calculate profit margin
-            profit_margin = (net_profit / total_sales * 100) if total_sales > 0 else 0
-            
-            # Tạo dòng kết quả cho tháng này (bao gồm chi phí giảm giá) - THÊM MỚI
-            results.append({
-                'Tháng': month_name,
-                'Doanh thu': total_sales,
-                'Chi phí Nguyên liệu đã sử dụng': cost_of_goods,
-                'Chi phí Nhập hàng': material_costs,
-                'Chi phí Nhân công': labor_costs,
-                'Chi phí Khác': other_costs,
-                'Chi phí Khấu hao': depreciation_costs,
-                'Chi phí Giảm giá': discount_costs,  # THÊM MỚI
-                'Tổng Chi phí': total_cost,
-                'Lợi nhuận': net_profit,
-                'Tỷ suất': profit_margin
-            })
         
-        return pd.DataFrame(results)
+        income_columns = ['total_sales', 'cost_of_goods', 'other_costs', 'depreciation_costs', 'discount_costs']
+        income = period_totals(income_df, income_columns, start_date, end_date, 'month')
+        material_costs = period_totals(material_costs_df, ['total_cost'], start_date, end_date, 'month')['total_cost']
+        labor_costs = period_totals(labor_costs_df, ['total_cost'], start_date, end_date, 'month')['total_cost']
+        
+        # Tổng chi phí từ tất cả các thành phần (bao gồm cả chi phí giảm giá)
+        total_cost = (income['other_costs'] + income['depreciation_costs'] + material_costs
+                      + labor_costs + income['discount_costs'])
+        net_profit = income['total_sales'] - total_cost
+        sales = income['total_sales'].to_numpy()
+        profit_margin = np.divide(net_profit.to_numpy() * 100, sales, out=np.zeros(len(sales)), where=sales > 0)
+        
+        return pd.DataFrame({
+            'Tháng': [period_label(period, 'month') for period in income.index],
+            'Doanh thu': income['total_sales'].to_numpy(),
+            'Chi phí Nguyên liệu đã sử dụng': income['cost_of_goods'].to_numpy(),
+            'Chi phí Nhập hàng': material_costs.to_numpy(),
+            'Chi phí Nhân công': labor_costs.to_numpy(),
+            'Chi phí Khác': income['other_costs'].to_numpy(),
+            'Chi phí Khấu hao': income['depreciation_costs'].to_numpy(),
+            'Chi phí Giảm giá': income['discount_costs'].to_numpy(),
+            'Tổng Chi phí': total_cost.to_numpy(),
+            'Lợi nhuận': net_profit.to_numpy(),
+            'Tỷ suất': profit_margin
+        })
     
     # Define a function to handle date range changes
     def handle_date_change():
@@ -1842,13 +3996,9 @@ elif tab_selection == "Theo dõi Doanh thu":
 
    # Cập nhật hiển thị báo cáo doanh thu với tất cả các tính năng trong một tab
     with income_tab1:
-        if len(st.session_state.income) > 0:
-            # Sort by date
-            income_df = st.session_state.income.sort_values('date', ascending=False)
-            material_costs_df = st.session_state.material_costs.copy() if 'material_costs' in st.session_state else pd.DataFrame()
-            labor_costs_df = st.session_state.labor_costs.copy() if 'labor_costs' in st.session_state else pd.DataFrame()
-            marketing_costs_df = st.session_state.marketing_costs.copy() if 'marketing_costs' in st.session_state else pd.DataFrame()
-            
+        # Only the date range of the income history is read up front
+        min_date_str, max_date_str = get_date_bounds('income')
+        if min_date_str is not None:
             # Enhanced date filter with period options
             period_type = st.radio(
                 "Chọn khoảng thời gian",
@@ -1858,10 +4008,6 @@ elif tab_selection == "Theo dõi Doanh thu":
             )
             
             try:
-                # Get min and max dates from data
-                min_date_str = income_df['date'].min()
-                max_date_str = income_df['date'].max()
-                
                 min_date = datetime.datetime.strptime(min_date_str, '%Y-%m-%d').date()
                 max_date = datetime.datetime.strptime(max_date_str, '%Y-%m-%d').date()
                 
@@ -1879,8 +4025,7 @@ elif tab_selection == "Theo dõi Doanh thu":
                     current_year = today.year if today <= max_date else max_date.year
                     
                     # Find available years in the data
-                    all_dates = pd.to_datetime(income_df['date'])
-                    available_years = sorted(list(set(date.year for date in all_dates)))
+                    available_years = list(range(min_date.year, max_date.year + 1))
                     
                     # Year selection first
                     selected_year = st.selectbox(
@@ -1914,8 +4059,7 @@ elif tab_selection == "Theo dõi Doanh thu":
                     current_year = today.year if today <= max_date else max_date.year
                     
                     # Find available years in the data
-                    all_dates = pd.to_datetime(income_df['date'])
-                    available_years = sorted(list(set(date.year for date in all_dates)))
+                    available_years = list(range(min_date.year, max_date.year + 1))
                     
                     # Year selection first
                     selected_year = st.selectbox(
@@ -1945,8 +4089,7 @@ elif tab_selection == "Theo dõi Doanh thu":
                 elif period_type == "Năm":
                     # Year selection
                     # Find available years in the data
-                    all_dates = pd.to_datetime(income_df['date'])
-                    available_years = sorted(list(set(date.year for date in all_dates)))
+                    available_years = list(range(min_date.year, max_date.year + 1))
                     
                     current_year = today.year if today <= max_date else max_date.year
                     
@@ -2005,89 +4148,49 @@ elif tab_selection == "Theo dõi Doanh thu":
                     # This button exists just to trigger a rerun with the new dates
                     pass
                     
-                # Filter income data with the new dates
-                filtered_income = income_df[
-                    (income_df['date'] >= start_date_str) & 
-                    (income_df['date'] <= end_date_str)
-                ]
+                # Read income data for the new dates only
+                filtered_income = query_dataframe('income', start_date_str, end_date_str).sort_values('date', ascending=False)
                                 
                 # Check if we have data in the selected range
                 if filtered_income.empty:
                     st.info(f"Không có dữ liệu doanh thu trong khoảng từ {start_date_str} đến {end_date_str}.")
                 else:
-                    # Filter material costs data (chi phí nhập hàng)
-                    filtered_costs = pd.DataFrame()
-                    material_costs_in_period = 0
-                    if not material_costs_df.empty:
-                        filtered_costs = material_costs_df[
-                            (material_costs_df['date'] >= start_date_str) & 
-                            (material_costs_df['date'] <= end_date_str)
-                        ]
-                        material_costs_in_period = filtered_costs['total_cost'].sum() if not filtered_costs.empty else 0
-                    
-                    # Filter labor costs data (chi phí nhân công)
-                    filtered_labor = pd.DataFrame()
-                    labor_costs_in_period = 0
-                    if not labor_costs_df.empty:
-                        filtered_labor = labor_costs_df[
-                            (labor_costs_df['date'] >= start_date_str) & 
-                            (labor_costs_df['date'] <= end_date_str)
-                        ]
-                        labor_costs_in_period = filtered_labor['total_cost'].sum() if not filtered_labor.empty else 0
-                    
-                    # Filter marketing costs data (chi phí marketing)
-                    filtered_marketing = pd.DataFrame()
-                    marketing_costs = 0
-                    if not marketing_costs_df.empty:
-                        filtered_marketing = marketing_costs_df[
-                            (marketing_costs_df['date'] >= start_date_str) & 
-                            (marketing_costs_df['date'] <= end_date_str)
-                        ]
-                        marketing_costs = filtered_marketing['amount'].sum() if not filtered_marketing.empty else 0
-
-                    # Get other costs from income data
-                    other_production_costs = 0
-                    if 'other_costs' in filtered_income.columns:
-                        other_production_costs = filtered_income['other_costs'].sum()
-                    
-                    # Get depreciation costs
-                    depreciation_costs = 0
-                    if 'depreciation_costs' in filtered_income.columns:
-                        depreciation_costs = filtered_income['depreciation_costs'].sum()
-
-                    # Get discount costs 
-                    discount_costs = 0
-                    if 'discount_costs' in filtered_income.columns:
-                        discount_costs = filtered_income['discount_costs'].sum()
-                    
-                    # Calculate total profit with all costs considered
-                    total_sales = filtered_income['total_sales'].sum()
-                    cost_of_goods = filtered_income['cost_of_goods'].sum()
-                    total_profit = filtered_income['profit'].sum()
-                    
-                    # Calculate total costs
-                    total_costs = (
-                        cost_of_goods + 
-                        material_costs_in_period + 
-                        labor_costs_in_period + 
-                        other_production_costs + 
-                        depreciation_costs + 
-                        discount_costs + 
-                        marketing_costs
+                    # Totals of the period and of the previous period of the same length,
+                    # looked up from the cumulative-sum index of each source table
+                    previous_start_str, previous_end_str = previous_period(start_date_str, end_date_str)
+                    range_totals = report_range_totals(
+                        [start_date_str, previous_start_str], [end_date_str, previous_end_str]
                     )
-                    
-                    # Calculate net profit
-                    net_profit = total_sales - total_costs
+                    current_totals, previous_totals = range_totals.iloc[0], range_totals.iloc[1]
+                    
+                    total_sales = current_totals['total_sales']
+                    cost_of_goods = current_totals['cost_of_goods']
+                    total_profit = current_totals['gross_profit']
+                    material_costs_in_period = current_totals['material_import_costs']  # chi phí nhập hàng
+                    labor_costs_in_period = current_totals['labor_costs']  # chi phí nhân công
+                    marketing_costs = current_totals['marketing_costs']  # chi phí marketing
+                    other_production_costs = current_totals['other_costs']
+                    depreciation_costs = current_totals['depreciation_costs']
+                    discount_costs = current_totals['discount_costs']
+                    
+                    # Calculate total costs and net profit
+                    total_costs = current_totals['total_costs']
+                    net_profit = current_totals['net_profit']
                     
                     # Display income summary
                     st.subheader("Tổng quan Doanh thu")
                     col1, col2, col3 = st.columns(3)
                     with col1:
-                        st.metric("Tổng Doanh thu", f"{total_sales:,.0f} VND")
+                        st.metric("Tổng Doanh thu", f"{total_sales:,.0f} VND",
+                                  delta=f"{total_sales - previous_totals['total_sales']:,.0f} VND so với kỳ trước")
                     with col2:
-                        st.metric("Tổng Chi phí", f"{total_costs:,.0f} VND")
+                        st.metric("Tổng Chi phí", f"{total_costs:,.0f} VND",
+                                  delta=f"{total_costs - previous_totals['total_costs']:,.0f} VND so với kỳ trước",
+                                  delta_color="inverse")
                     with col3:
-                        st.metric("Lợi nhuận Ròng", f"{net_profit:,.0f} VND")
+                        st.metric("Lợi nhuận Ròng", f"{net_profit:,.0f} VND",
+                                  delta=f"{net_profit - previous_totals['net_profit']:,.0f} VND so với kỳ trước")
+                    st.caption(f"Kỳ trước: {previous_start_str} đến {previous_end_str}")
                     
                     # Set a smaller font size for metric values
                     st.markdown("""
@@ -2511,6 +4614,41 @@ elif tab_selection == "Theo dõi Doanh thu":
                                 
                                 # Display the chart
                                 st.plotly_chart(fig, use_container_width=True)
+                    
+                    # Tổng hợp theo kỳ: mỗi bảng nguồn chỉ được gom nhóm một lần cho cả khoảng ngày
+                    st.subheader("Tổng hợp theo kỳ")
+                    report_period = st.selectbox(
+                        "Gom theo",
+                        options=list(REPORT_PERIODS),
+                        index=list(REPORT_PERIODS).index('month'),
+                        format_func=lambda x: REPORT_PERIODS[x][0],
+                        key="revenue_report_period"
+                    )
+                    period_report = build_period_report(start_date_str, end_date_str, report_period)
+                    period_columns = {
+                        'total_sales': 'Doanh thu',
+                        'cost_of_goods': 'Chi phí Nguyên liệu',
+                        'material_import_costs': 'Chi phí Nhập hàng',
+                        'labor_costs': 'Chi phí Nhân công',
+                        'other_costs': 'Chi phí Khác',
+                        'depreciation_costs': 'Chi phí Khấu hao',
+                        'discount_costs': 'Chi phí Giảm giá',
+                        'marketing_costs': 'Chi phí Marketing',
+                        'total_costs': 'Tổng Chi phí',
+                        'net_profit': 'Lợi nhuận Ròng',
+                    }
+                    period_display = pd.DataFrame({REPORT_PERIODS[report_period][0]: period_report.index})
+                    for column, label in period_columns.items():
+                        period_display[label] = [f"{x:,.0f} VND" for x in period_report[column]]
+                    period_display['Tỷ suất'] = [f"{x:.1f}%" for x in period_report['profit_margin']]
+                    st.dataframe(period_display, hide_index=True)
+                    st.download_button(
+                        label="Tải bảng tổng hợp theo kỳ (CSV)",
+                        data=period_report.rename(columns=period_columns).to_csv().encode('utf-8'),
+                        file_name=f'tong_hop_{report_period}_{start_date_str}_den_{end_date_str}.csv',
+                        mime='text/csv',
+                        key="download_period_report"
+                    )
             except Exception as e:
                 # Fallback if date parsing fails
                 st.error(f"Lỗi khi xử lý dữ liệu: {str(e)}")
@@ -2521,25 +4659,11 @@ elif tab_selection == "Theo dõi Doanh thu":
     with income_tab2:
         st.subheader("Chi phí nhập Nguyên liệu")
         
-        if len(st.session_state.material_costs) > 0:
-            # Display material costs
-            material_costs_df = st.session_state.material_costs.copy()
-            
-            # Format material costs for display
-            material_costs_display = pd.DataFrame({
-                'Ngày': material_costs_df['date'],
-                'Mã Nguyên liệu': material_costs_df['material_id'],
-                'Số lượng': material_costs_df['quantity'],
-                'Chi phí': material_costs_df['total_cost'].apply(lambda x: f"{x:,.0f} VND"),
-                'Nhà cung cấp': material_costs_df['supplier']
-            })
-            
+        # Only the first/last dates are read up front, the rows are fetched for the selected period
+        min_cost_date_str, max_cost_date_str = get_date_bounds('material_costs')
+        if min_cost_date_str is not None:
             # Date filter for material costs - with safer handling
             try:
-                # Get min and max dates from data
-                min_cost_date_str = material_costs_df['date'].min()
-                max_cost_date_str = material_costs_df['date'].max()
-                
                 min_cost_date = datetime.datetime.strptime(min_cost_date_str, '%Y-%m-%d').date()
                 max_cost_date = datetime.datetime.strptime(max_cost_date_str, '%Y-%m-%d').date()
                 
@@ -2590,16 +4714,17 @@ elif tab_selection == "Theo dõi Doanh thu":
                 start_date_str = start_date.strftime('%Y-%m-%d')
                 end_date_str = end_date.strftime('%Y-%m-%d')
                 
-                # Filter material costs
-                filtered_costs_display = material_costs_display[
-                    (material_costs_display['Ngày'] >= start_date_str) & 
-                    (material_costs_display['Ngày'] <= end_date_str)
-                ]
+                # Read material costs of the selected period
+                filtered_costs_df = query_dataframe('material_costs', start_date_str, end_date_str)
                 
-                filtered_costs_df = material_costs_df[
-                    (material_costs_df['date'] >= start_date_str) & 
-                    (material_costs_df['date'] <= end_date_str)
-                ]
+                # Format material costs for display
+                filtered_costs_display = pd.DataFrame({
+                    'Ngày': filtered_costs_df['date'],
+                    'Mã Nguyên liệu': filtered_costs_df['material_id'],
+                    'Số lượng': filtered_costs_df['quantity'],
+                    'Chi phí': filtered_costs_df['total_cost'].apply(lambda x: f"{x:,.0f} VND"),
+                    'Nhà cung cấp': filtered_costs_df['supplier']
+                })
                 
                 # Check if we have data in the selected range
                 if filtered_costs_df.empty:
@@ -2612,11 +4737,10 @@ elif tab_selection == "Theo dõi Doanh thu":
                     # Display filtered costs
                     st.dataframe(filtered_costs_display)
                     
-                    # Group costs by material
-                    material_grouped = filtered_costs_df.groupby('material_id').agg({
-                        'quantity': 'sum',
-                        'total_cost': 'sum'
-                    }).reset_index()
+                    # Group costs by material (in MongoDB with aggregation pushdown)
+                    material_grouped = aggregate_dataframe(
+                        'material_costs', ['material_id'], ['quantity', 'total_cost'], start_date_str, end_date_str
+                    )
                     
                     # Get material names (safely)
                     material_names = {}
@@ -2712,10 +4836,7 @@ elif tab_selection == "Theo dõi Doanh thu":
                 })
                 
                 # Update session state
-                if 'labor_costs' not in st.session_state:
-                    st.session_state.labor_costs = new_labor_cost
-                else:
-                    st.session_state.labor_costs = pd.concat([st.session_state.labor_costs, new_labor_cost], ignore_index=True)
+                st.session_state.labor_costs = pd.concat([get_table('labor_costs'), new_labor_cost], ignore_index=True)
                 
                 st.success(f"Đã lưu chi phí nhân công: {total_labor_cost:,.0f} VND")
                 
@@ -2726,18 +4847,12 @@ elif tab_selection == "Theo dõi Doanh thu":
                 st.rerun()
         
         # Display existing labor costs
-        if 'labor_costs' in st.session_state and not st.session_state.labor_costs.empty:
+        min_labor_date_str, max_labor_date_str = get_date_bounds('labor_costs')
+        if min_labor_date_str is not None:
             st.write("### Chi phí Nhân công Đã Lưu")
             
-            # Format labor costs for display
-            labor_costs_df = st.session_state.labor_costs.copy()
-            
             # Date filter for labor costs
             try:
-                # Get min and max dates from data
-                min_labor_date_str = labor_costs_df['date'].min()
-                max_labor_date_str = labor_costs_df['date'].max()
-                
                 min_labor_date = datetime.datetime.strptime(min_labor_date_str, '%Y-%m-%d').date()
                 max_labor_date = datetime.datetime.strptime(max_labor_date_str, '%Y-%m-%d').date()
                 
@@ -2757,11 +4872,8 @@ elif tab_selection == "Theo dõi Doanh thu":
                     start_date_str = start_date.strftime('%Y-%m-%d')
                     end_date_str = end_date.strftime('%Y-%m-%d')
                     
-                    # Filter labor costs
-                    filtered_labor_costs = labor_costs_df[
-                        (labor_costs_df['date'] >= start_date_str) & 
-                        (labor_costs_df['date'] <= end_date_str)
-                    ]
+                    # Read labor costs of the selected period
+                    filtered_labor_costs = query_dataframe('labor_costs', start_date_str, end_date_str)
                     
                     if not filtered_labor_costs.empty:
                         # Display total labor cost for the period
@@ -2802,7 +4914,7 @@ elif tab_selection == "Theo dõi Doanh thu":
                                 labor_id = int(selected_labor_to_delete.split(" - ")[0].replace("ID: ", ""))
                                 
                                 # Hiển thị thông tin chi tiết về dòng sẽ xóa
-                                labor_to_delete = labor_costs_df.loc[labor_id]
+                                labor_to_delete = filtered_labor_costs.loc[labor_id]
                                 st.write(f"**Chi tiết chi phí sẽ xóa:**")
                                 st.write(f"- Ngày: {labor_to_delete['date']}")
                                 st.write(f"- Người thực hiện: {labor_to_delete['worker_name']}")
@@ -2814,25 +4926,19 @@ elif tab_selection == "Theo dõi Doanh thu":
                                 
                                 if st.button("Xóa Chi phí Nhân công", key="delete_labor_button"):
                                     if confirm_delete:
-                                        # Xóa dòng chi phí được chọn
-                                        st.session_state.labor_costs = st.session_state.labor_costs.drop(labor_id)
-                                        
-                                        # Reset index sau khi xóa
-                                        st.session_state.labor_costs = st.session_state.labor_costs.reset_index(drop=True)
-                                        
-                                        # Lưu lại dữ liệu
-                                        save_dataframe(st.session_state.labor_costs, "labor_costs.csv")
-                                        
-                                        st.success(f"Đã xóa chi phí nhân công thành công!")
-                                        st.rerun()
+                                        # Xóa dòng chi phí được chọn và lưu lại dữ liệu
+                                        if delete_matching_row('labor_costs', labor_to_delete):
+                                            st.success("Đã xóa chi phí nhân công thành công!")
+                                            st.rerun()
+                                        else:
+                                            st.error("Không tìm thấy chi phí nhân công này, có thể đã bị xóa.")
                                     else:
                                         st.error("Vui lòng xác nhận việc xóa bằng cách đánh dấu vào ô xác nhận.")
                         
-                        # Group by worker
-                        worker_grouped = filtered_labor_costs.groupby('worker_name').agg({
-                            'hours': 'sum',
-                            'total_cost': 'sum'
-                        }).reset_index()
+                        # Group by worker (in MongoDB with aggregation pushdown)
+                        worker_grouped = aggregate_dataframe(
+                            'labor_costs', ['worker_name'], ['hours', 'total_cost'], start_date_str, end_date_str
+                        )
                         
                         # Format for display
                         worker_summary = pd.DataFrame({
@@ -2913,10 +5019,7 @@ elif tab_selection == "Theo dõi Doanh thu":
                 })
                 
                 # Cập nhật session state
-                if 'marketing_costs' not in st.session_state:
-                    st.session_state.marketing_costs = new_marketing_cost
-                else:
-                    st.session_state.marketing_costs = pd.concat([st.session_state.marketing_costs, new_marketing_cost], ignore_index=True)
+                st.session_state.marketing_costs = pd.concat([get_table('marketing_costs'), new_marketing_cost], ignore_index=True)
                 
                 st.success(f"Đã lưu chi phí marketing: {amount:,.0f} VND")
                 
@@ -2927,18 +5030,12 @@ elif tab_selection == "Theo dõi Doanh thu":
                 st.rerun()
         
         # Hiển thị chi phí marketing hiện có
-        if 'marketing_costs' in st.session_state and not st.session_state.marketing_costs.empty:
+        min_marketing_date_str, max_marketing_date_str = get_date_bounds('marketing_costs')
+        if min_marketing_date_str is not None:
             st.write("### Chi phí Marketing Đã Lưu")
             
-            # Format chi phí marketing để hiển thị
-            marketing_costs_df = st.session_state.marketing_costs.copy()
-            
             # Bộ lọc ngày
             try:
-                # Lấy ngày min và max từ dữ liệu
-                min_marketing_date_str = marketing_costs_df['date'].min()
-                max_marketing_date_str = marketing_costs_df['date'].max()
-                
                 min_marketing_date = datetime.datetime.strptime(min_marketing_date_str, '%Y-%m-%d').date()
                 max_marketing_date = datetime.datetime.strptime(max_marketing_date_str, '%Y-%m-%d').date()
                 
@@ -2958,11 +5055,8 @@ elif tab_selection == "Theo dõi Doanh thu":
                     start_date_str = start_date.strftime('%Y-%m-%d')
                     end_date_str = end_date.strftime('%Y-%m-%d')
                     
-                    # Lọc chi phí marketing
-                    filtered_marketing_costs = marketing_costs_df[
-                        (marketing_costs_df['date'] >= start_date_str) & 
-                        (marketing_costs_df['date'] <= end_date_str)
-                    ]
+                    # Đọc chi phí marketing của khoảng thời gian đã chọn
+                    filtered_marketing_costs = query_dataframe('marketing_costs', start_date_str, end_date_str)
                     
                     if not filtered_marketing_costs.empty:
                         # Hiển thị tổng chi phí cho khoảng thời gian
@@ -3002,7 +5096,7 @@ elif tab_selection == "Theo dõi Doanh thu":
                                 marketing_id = int(selected_marketing_to_delete.split(" - ")[0].replace("ID: ", ""))
                                 
                                 # Hiển thị thông tin chi tiết về dòng sẽ xóa
-                                marketing_to_delete = marketing_costs_df.loc[marketing_id]
+                                marketing_to_delete = filtered_marketing_costs.loc[marketing_id]
                                 st.write(f"**Chi tiết chi phí sẽ xóa:**")
                                 st.write(f"- Ngày: {marketing_to_delete['date']}")
                                 st.write(f"- Chiến dịch: {marketing_to_delete['campaign_name']}")
@@ -3014,24 +5108,19 @@ elif tab_selection == "Theo dõi Doanh thu":
                                 
                                 if st.button("Xóa Chi phí Marketing", key="delete_marketing_button"):
                                     if confirm_delete_marketing:
-                                        # Xóa dòng chi phí được chọn
-                                        st.session_state.marketing_costs = st.session_state.marketing_costs.drop(marketing_id)
-                                        
-                                        # Reset index sau khi xóa
-                                        st.session_state.marketing_costs = st.session_state.marketing_costs.reset_index(drop=True)
-                                        
-                                        # Lưu lại dữ liệu
-                                        save_dataframe(st.session_state.marketing_costs, "marketing_costs.csv")
-                                        
-                                        st.success(f"Đã xóa chi phí marketing thành công!")
-                                        st.rerun()
+                                        # Xóa dòng chi phí được chọn và lưu lại dữ liệu
+                                        if delete_matching_row('marketing_costs', marketing_to_delete):
+                                            st.success("Đã xóa chi phí marketing thành công!")
+                                            st.rerun()
+                                        else:
+                                            st.error("Không tìm thấy chi phí marketing này, có thể đã bị xóa.")
                                     else:
                                         st.error("Vui lòng xác nhận việc xóa bằng cách đánh dấu vào ô xác nhận.")
                         
-                        # Nhóm theo nền tảng
-                        platform_grouped = filtered_marketing_costs.groupby('platform').agg({
-                            'amount': 'sum'
-                        }).reset_index()
+                        # Nhóm theo nền tảng (tính trong MongoDB khi bật aggregation pushdown)
+                        platform_grouped = aggregate_dataframe(
+                            'marketing_costs', ['platform'], ['amount'], start_date_str, end_date_str
+                        )
                         
                         # Format để hiển thị
                         platform_summary = pd.DataFrame({
@@ -3050,10 +5139,10 @@ elif tab_selection == "Theo dõi Doanh thu":
                         })
                         st.bar_chart(chart_data.set_index('Nền tảng'))
                         
-                        # Nhóm theo chiến dịch
-                        campaign_grouped = filtered_marketing_costs.groupby('campaign_name').agg({
-                            'amount': 'sum'
-                        }).reset_index()
+                        # Nhóm theo chiến dịch (tính trong MongoDB khi bật aggregation pushdown)
+                        campaign_grouped = aggregate_dataframe(
+                            'marketing_costs', ['campaign_name'], ['amount'], start_date_str, end_date_str
+                        )
                         
                         # Format để hiển thị
                         campaign_summary = pd.DataFrame({
@@ -3084,7 +5173,7 @@ elif tab_selection == "Theo dõi Doanh thu":
                                 marketing_id = int(selected_marketing_to_delete.split(" - ")[0].replace("ID: ", ""))
                                 
                                 # Hiển thị thông tin chi tiết về dòng sẽ xóa
-                                marketing_to_delete = marketing_costs_df.loc[marketing_id]
+                                marketing_to_delete = filtered_marketing_costs.loc[marketing_id]
                                 st.write(f"**Chi tiết chi phí sẽ xóa:**")
                                 st.write(f"- Ngày: {marketing_to_delete['date']}")
                                 st.write(f"- Chiến dịch: {marketing_to_delete['campaign_name']}")
@@ -3096,17 +5185,12 @@ elif tab_selection == "Theo dõi Doanh thu":
                                 
                                 if st.button("Xóa Chi phí Marketing", key="delete_marketing_button"):
                                     if confirm_delete_marketing:
-                                        # Xóa dòng chi phí được chọn
-                                        st.session_state.marketing_costs = st.session_state.marketing_costs.drop(marketing_id)
-                                        
-                                        # Reset index sau khi xóa
-                                        st.session_state.marketing_costs = st.session_state.marketing_costs.reset_index(drop=True)
-                                        
-                                        # Lưu lại dữ liệu
-                                        save_dataframe(st.session_state.marketing_costs, "marketing_costs.csv")
-                                        
-                                        st.success(f"Đã xóa chi phí marketing thành công!")
-                                        st.rerun()
+                                        # Xóa dòng chi phí được chọn và lưu lại dữ liệu
+                                        if delete_matching_row('marketing_costs', marketing_to_delete):
+                                            st.success("Đã xóa chi phí marketing thành công!")
+                                            st.rerun()
+                                        else:
+                                            st.error("Không tìm thấy chi phí marketing này, có thể đã bị xóa.")
                                     else:
                                         st.error("Vui lòng xác nhận việc xóa bằng cách đánh dấu vào ô xác nhận.")
 
@@ -3116,7 +5200,129 @@ elif tab_selection == "Theo dõi Doanh thu":
                 st.error(f"Lỗi khi xử lý dữ liệu chi phí marketing: {str(e)}")
                 st.info("Vui lòng kiểm tra lại dữ liệu chi phí marketing.")
         else:
-            st.info("Chưa có dữ liệu chi phí marketing. Vui lòng thêm chi phí marketing để theo dõi.")
+            st.info("Chưa có dữ liệu chi phí marketing. Vui lòng thêm chi phí marketing để theo dõi.")
+
+    # Tab Phân tích Bán hàng: bảng pivot từ cube doanh thu đã tổng hợp sẵn
+    with income_tab5:
+        st.subheader("Phân tích Bán hàng")
+        
+        cube_dimension_labels = {
+            'category': "Danh mục",
+            'product_id': "Sản phẩm",
+            'customer': "Khách hàng",
+            'payment_method': "Phương thức thanh toán",
+            'date': "Ngày",
+            'month': "Tháng",
+            'year': "Năm",
+        }
+        cube_measure_labels = {
+            'revenue': "Doanh thu",
+            'quantity': "Số lượng",
+            'lines': "Số dòng đơn hàng",
+        }
+        
+        today = datetime.date.today()
+        col1, col2 = st.columns(2)
+        with col1:
+            cube_start_date = st.date_input(
+                "Từ ngày",
+                value=datetime.date(today.year, today.month, 1),
+                key="cube_start_date"
+            )
+        with col2:
+            cube_end_date = st.date_input(
+                "Đến ngày",
+                value=today,
+                min_value=cube_start_date,
+                key="cube_end_date"
+            )
+        
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            cube_rows = st.selectbox(
+                "Hàng",
+                options=list(cube_dimension_labels),
+                format_func=lambda x: cube_dimension_labels[x],
+                key="cube_rows"
+            )
+        with col2:
+            cube_columns = st.selectbox(
+                "Cột",
+                options=[None] + list(cube_dimension_labels),
+                format_func=lambda x: "(Không)" if x is None else cube_dimension_labels[x],
+                key="cube_columns"
+            )
+        with col3:
+            cube_measure = st.selectbox(
+                "Số đo",
+                options=list(cube_measure_labels),
+                format_func=lambda x: cube_measure_labels[x],
+                key="cube_measure"
+            )
+        
+        # Lọc (slice/dice) theo danh mục và phương thức thanh toán
+        cube_cells = sales_cube_cells(cube_start_date, cube_end_date)
+        col1, col2 = st.columns(2)
+        with col1:
+            cube_categories = st.multiselect(
+                "Danh mục",
+                options=sorted(cube_cells['category'].unique()),
+                key="cube_categories"
+            )
+        with col2:
+            cube_payments = st.multiselect(
+                "Phương thức thanh toán",
+                options=sorted(cube_cells['payment_method'].unique()),
+                key="cube_payments"
+            )
+        cube_filters = {}
+        if cube_categories:
+            cube_filters['category'] = cube_categories
+        if cube_payments:
+            cube_filters['payment_method'] = cube_payments
+        
+        if cube_columns == cube_rows:
+            cube_columns = None
+        cube_by = [cube_rows] if cube_columns is None else [cube_rows, cube_columns]
+        cube_result = cube_query(
+            cube_by, cube_start_date, cube_end_date, measures=[cube_measure], cells=cube_cells, **cube_filters
+        )
+        
+        if cube_result.empty:
+            st.info("Không có dữ liệu bán hàng trong khoảng thời gian và bộ lọc đã chọn.")
+            st.caption("Cube doanh thu được cập nhật khi tạo, sửa hoặc xóa đơn hàng và hóa đơn. Với dữ liệu có từ trước, hãy tính lại trong Quản lý Dữ liệu.")
+        else:
+            # Hiển thị tên sản phẩm thay cho mã sản phẩm
+            products = get_table('products')
+            product_names = dict(zip(products['product_id'], products['name']))
+            for dimension in cube_by:
+                if dimension == 'product_id':
+                    cube_result['product_id'] = cube_result['product_id'].map(lambda x: product_names.get(x, x))
+            
+            if cube_columns is None:
+                pivot = cube_result.set_index(cube_rows)
+            else:
+                pivot = cube_result.pivot_table(
+                    index=cube_rows, columns=cube_columns, values=cube_measure,
+                    aggfunc='sum', fill_value=0, margins=True, margins_name="Tổng"
+                )
+            pivot.index.name = cube_dimension_labels[cube_rows]
+            pivot = pivot.rename(columns=cube_measure_labels)
+            
+            value_format = "{:,.0f} VND" if cube_measure == 'revenue' else "{:,.0f}"
+            st.dataframe(pivot.map(value_format.format), use_container_width=True)
+            
+            total = cube_result[cube_measure].sum()
+            st.write(f"**Tổng {cube_measure_labels[cube_measure].lower()}:** {value_format.format(total)}")
+            st.caption(f"Tổng hợp từ {len(cube_cells):,} ô của cube doanh thu (ngày × sản phẩm × danh mục × khách hàng × thanh toán).")
+            
+            st.download_button(
+                label="Tải bảng phân tích (CSV)",
+                data=pivot.to_csv().encode('utf-8'),
+                file_name=f'phan_tich_ban_hang_{cube_start_date}_den_{cube_end_date}.csv',
+                mime='text/csv',
+                key="download_cube_pivot"
+            )
 
 # Materials Inventory Tab - Updated with Out-of-Stock Notifications
 elif tab_selection == "Kho Nguyên liệu":
@@ -3128,31 +5334,22 @@ elif tab_selection == "Kho Nguyên liệu":
 
     # Check for out-of-stock or low stock items immediately
     if not st.session_state.materials.empty:
-        out_of_stock_items = []
-        low_stock_items = []
+        replenishment = replenishment_plan(
+            lead_time_days=st.session_state.get('replenishment_lead_time', DEFAULT_LEAD_TIME_DAYS),
+            review_days=st.session_state.get('replenishment_review_days', REVIEW_PERIOD_DAYS)
+        )
+        out_of_stock_items = list(replenishment.loc[replenishment['quantity'] <= 0, 'name'])
         
-        for _, material in st.session_state.materials.iterrows():
-            # Get initial quantity - use price_per_unit * quantity as a rough estimate of initial value
-            initial_quantity = material.get('initial_quantity', None)
-            
-            # If initial_quantity is not available, estimate it from used_quantity
-            if initial_quantity is None or initial_quantity <= 0:
-                initial_quantity = material['quantity'] + material.get('used_quantity', 0)
-                    
-            # Calculate exact percentage remaining
-            percentage_remaining = (material['quantity'] / initial_quantity * 100) if initial_quantity > 0 else 100
-            
-            # Check stock levels more precisely
-            if material['quantity'] <= 0:
-                out_of_stock_items.append(material['name'])
-            elif percentage_remaining <= 10.0:  # Exactly 10% or less
-                # Skip this warning for new products
-                used_quantity = material.get('used_quantity', 0)
-                is_new_product = used_quantity == 0 and material['quantity'] > 0
-                
-                if not is_new_product:
-                    # Format percentage to exactly 1 decimal place for display
-                    low_stock_items.append(f"{material['name']} ({percentage_remaining:.1f}% còn lại)")
+        # Sắp hết hàng: tồn kho không đủ dùng đến khi hàng nhập mới về (dưới điểm đặt hàng lại)
+        low_stock = replenishment[
+            (replenishment['quantity'] > 0)
+            & (replenishment['daily_usage'] > 0)
+            & (replenishment['quantity'] <= replenishment['reorder_point'])
+        ]
+        low_stock_items = [
+            f"{name} (đủ dùng {days:.1f} ngày)"
+            for name, days in zip(low_stock['name'], low_stock['days_of_cover'])
+        ]
         
         # Show notifications for out-of-stock items
         if out_of_stock_items:
@@ -3160,7 +5357,7 @@ elif tab_selection == "Kho Nguyên liệu":
         
         # Show notifications for low stock items
         if low_stock_items:
-            st.warning(f"⚠️ **Cảnh báo: Các nguyên liệu sắp hết hàng (10% hoặc ít hơn số lượng ban đầu):** {', '.join(low_stock_items)}")
+            st.warning(f"⚠️ **Cảnh báo: Các nguyên liệu cần nhập thêm (dưới điểm đặt hàng lại):** {', '.join(low_stock_items)}")
     
     # Initialize material costs tracking if not exists
     if 'material_costs' not in st.session_state:
@@ -3168,7 +5365,7 @@ elif tab_selection == "Kho Nguyên liệu":
             'date', 'material_id', 'quantity', 'total_cost', 'supplier'
         ])
     
-    mat_tab1, mat_tab2, mat_tab3, mat_tab4 = st.tabs(["Xem Kho", "Cập nhật Kho", "Nhập Nguyên liệu", "Xóa Nguyên liệu"])
+    mat_tab1, mat_tab2, mat_tab3, mat_tab4, mat_tab5, mat_tab6, mat_tab7, mat_tab8 = st.tabs(["Xem Kho", "Cập nhật Kho", "Nhập Nguyên liệu", "Xóa Nguyên liệu", "Khả năng sản xuất", "Kế hoạch sản xuất", "Sổ kho", "Giá vốn"])
     
     with mat_tab1:
         st.subheader("Kho hiện tại")
@@ -3246,18 +5443,37 @@ elif tab_selection == "Kho Nguyên liệu":
             total_value = sum(m['quantity'] * m['price_per_unit'] for _, m in st.session_state.materials.iterrows() if m['quantity'] > 0)
             st.metric("Tổng Giá trị Kho", f"{total_value:,.0f} VND")
             
-            # Out of stock list
-            if 'Hết hàng' in status_counts or 'Sắp hết hàng' in status_counts:
-                st.subheader("Danh sách cần Nhập hàng")
-                needs_restock = materials_display[(materials_display['Trạng thái'] == 'Hết hàng') | 
-                                                 (materials_display['Trạng thái'] == 'Sắp hết hàng')]
-                
+            # Reorder list
+            st.subheader("Danh sách cần Nhập hàng")
+            col1, col2 = st.columns(2)
+            with col1:
+                st.number_input(
+                    "Thời gian giao hàng mặc định (ngày)", min_value=0, value=DEFAULT_LEAD_TIME_DAYS, step=1,
+                    key="replenishment_lead_time",
+                    help="Dùng cho nguyên liệu chưa có thời gian giao hàng riêng (đặt trong mục Cập nhật Kho)"
+                )
+            with col2:
+                st.number_input(
+                    "Mua đủ dùng thêm (ngày)", min_value=1, value=REVIEW_PERIOD_DAYS, step=1,
+                    key="replenishment_review_days"
+                )
+            st.caption(f"Tiêu thụ trung bình tính từ đơn hàng {REPLENISHMENT_WINDOW_DAYS} ngày gần nhất (quy đổi qua công thức).")
+            
+            needs_restock = replenishment[
+                (replenishment['suggested_quantity'] > 0) | (replenishment['quantity'] <= 0)
+            ].sort_values('days_of_cover')
+            
+            if needs_restock.empty:
+                st.success("Chưa có nguyên liệu nào cần nhập thêm.")
+            else:
                 restock_df = pd.DataFrame({
-                    'Mã nguyên liệu': needs_restock['material_id'],
+                    'Mã nguyên liệu': needs_restock.index,
                     'Tên': needs_restock['name'],
                     'Đơn vị': needs_restock['unit'],
-                    'Số lượng hiện tại': needs_restock['quantity'],
-                    'Trạng thái': needs_restock['Trạng thái']
+                    'Số lượng hiện tại': [f"{quantity:.5f}" for quantity in needs_restock['quantity']],
+                    'Tiêu thụ/ngày': [f"{usage:.5f}" for usage in needs_restock['daily_usage']],
+                    'Điểm đặt hàng lại': [f"{point:.5f}" for point in needs_restock['reorder_point']],
+                    'Nên mua': [f"{quantity:.5f}" for quantity in needs_restock['suggested_quantity']]
                 })
                 
                 st.dataframe(restock_df)
@@ -3265,17 +5481,14 @@ elif tab_selection == "Kho Nguyên liệu":
                 # Generate shopping list
                 if st.button("Tạo Danh sách mua hàng"):
                     shopping_list = ""
-                    for _, item in needs_restock.iterrows():
-                        current_qty = item['quantity']
+                    for material_id, item in needs_restock.iterrows():
+                        if item['suggested_quantity'] <= 0:
+                            # Hết hàng nhưng chưa có tiêu thụ gần đây
+                            shopping_list += f"- {item['name']}: (chưa có tiêu thụ gần đây, hiện tại: {item['quantity']:g})\n"
+                            continue
                         
-                        # Calculate suggested order quantity
-                        if current_qty <= 0:
-                            suggested_qty = 20  # Standard restock amount for out of stock
-                        else:
-                            suggested_qty = 20 - current_qty  # Top up to 20 units
-                            
-                        shopping_list += f"- {item['name']}: {suggested_qty} {item['unit']} " + \
-                                        f"(hiện tại: {current_qty}) - " + \
+                        shopping_list += f"- {item['name']}: {item['suggested_quantity']:.2f} {item['unit']} " + \
+                                        f"(hiện tại: {item['quantity']:g}) - " + \
                                         f"Đơn giá tham khảo: {item['price_per_unit']:,.0f} VND\n"
                     
                     # Display the shopping list
@@ -3379,6 +5592,17 @@ elif tab_selection == "Kho Nguyên liệu":
                     # Display total quantity (current + used)
                     st.info(f"Tổng lượng (hiện tại + đã sử dụng): {new_quantity + new_used_quantity:.5f}")
                     
+                    current_lead_time = 0
+                    if 'lead_time_days' in material_data.columns and pd.notna(material_data['lead_time_days'].iloc[0]):
+                        current_lead_time = int(material_data['lead_time_days'].iloc[0])
+                    new_lead_time = st.number_input(
+                        "Thời gian giao hàng (ngày)",
+                        min_value=0,
+                        value=current_lead_time,
+                        step=1,
+                        help="Số ngày từ lúc đặt đến lúc nhận hàng, dùng để tính điểm đặt hàng lại. Để 0 để dùng giá trị mặc định."
+                    )
+                    
                     # Get current supplier (if exists in data)
                     current_supplier = ""
                     
@@ -3395,11 +5619,12 @@ elif tab_selection == "Kho Nguyên liệu":
                     # Add supplier field
                     new_supplier = st.text_input("Nhà cung cấp", value=current_supplier)
                     
-                    if st.button("Cập nhật Nguyên liệu"):
-                        # Update the material quantity, price, and used quantity
-                        st.session_state.materials.at[material_idx, 'quantity'] = new_quantity
+                    if st.button("Cập nhật Nguyên liệu") and set_stock_level(selected_material_id, new_quantity, "Cập nhật Kho"):
+                        # The quantity is set on the server first (its ledger delta is taken from the
+                        # stored value), then the price and used quantity are saved with the table
                         st.session_state.materials.at[material_idx, 'price_per_unit'] = new_price
                         st.session_state.materials.at[material_idx, 'used_quantity'] = new_used_quantity
+                        st.session_state.materials.at[material_idx, 'lead_time_days'] = new_lead_time if new_lead_time > 0 else np.nan
                         
                         # If supplier was updated and not empty, record it in material_costs
                         if new_supplier and new_supplier != current_supplier:
@@ -3569,39 +5794,47 @@ elif tab_selection == "Kho Nguyên liệu":
                             elif import_quantity <= 0:
                                 st.error("Vui lòng nhập số lượng hợp lệ")
                             else:
-                                # Update material quantity
-                                new_quantity = current_quantity + import_quantity
-                                st.session_state.materials.at[material_idx, 'quantity'] = new_quantity
+                                try:
+                                    with unit_of_work():
+                                        # Sổ kho được ghi trước khi tồn kho trong phiên thay đổi, cùng lần lưu bảng materials
+                                        record_stock_movements(pd.Series({selected_material_id: import_quantity}), 'import', supplier, date=import_date)
+                                        
+                                        # Update material quantity
+                                        new_quantity = current_quantity + import_quantity
+                                        st.session_state.materials.at[material_idx, 'quantity'] = new_quantity
                                 
-                                # Update price (weighted average)
-                                current_total_value = current_quantity * st.session_state.materials.at[material_idx, 'price_per_unit']
-                                new_total_value = current_total_value + import_cost
-                                new_price_per_unit = new_total_value / new_quantity if new_quantity > 0 else 0
+                                        # Update price (weighted average)
+                                        current_total_value = current_quantity * st.session_state.materials.at[material_idx, 'price_per_unit']
+                                        new_total_value = current_total_value + import_cost
+                                        new_price_per_unit = new_total_value / new_quantity if new_quantity > 0 else 0
                                 
-                                st.session_state.materials.at[material_idx, 'price_per_unit'] = new_price_per_unit
+                                        st.session_state.materials.at[material_idx, 'price_per_unit'] = new_price_per_unit
                                 
-                                # Record the import cost
-                                if 'material_costs' not in st.session_state:
-                                    st.session_state.material_costs = pd.DataFrame(columns=[
-                                        'date', 'material_id', 'quantity', 'total_cost', 'supplier'
-                                    ])
+                                        # Record the import cost
+                                        if 'material_costs' not in st.session_state:
+                                            st.session_state.material_costs = pd.DataFrame(columns=[
+                                                'date', 'material_id', 'quantity', 'total_cost', 'supplier'
+                                            ])
                                     
-                                new_import = pd.DataFrame({
-                                    'date': [import_date],
-                                    'material_id': [selected_material_id],
-                                    'quantity': [import_quantity],
-                                    'total_cost': [import_cost],
-                                    'supplier': [supplier]
-                                })
+                                        new_import = pd.DataFrame({
+                                            'date': [import_date],
+                                            'material_id': [selected_material_id],
+                                            'quantity': [import_quantity],
+                                            'total_cost': [import_cost],
+                                            'supplier': [supplier]
+                                        })
                                 
-                                st.session_state.material_costs = pd.concat([st.session_state.material_costs, new_import], ignore_index=True)
+                                        st.session_state.material_costs = pd.concat([st.session_state.material_costs, new_import], ignore_index=True)
                                 
-                                st.success(f"Đã nhập {import_quantity} {current_unit} nguyên liệu {selected_material_id} thành công!")
-                                st.write(f"Số lượng mới: {new_quantity} {current_unit}")
-                                st.write(f"Giá đơn vị mới (trung bình): {new_price_per_unit:,.0f} VND/{current_unit}")
-                                # Save materials and material costs data
-                                save_dataframe(st.session_state.materials, "materials.csv")
-                                save_dataframe(st.session_state.material_costs, "material_costs.csv")
+                                        # Save materials and material costs data
+                                        save_dataframe(st.session_state.materials, "materials.csv")
+                                        save_dataframe(st.session_state.material_costs, "material_costs.csv")
+                                except SaveError as e:
+                                    st.error(f"Lỗi khi lưu nhập kho: {e}")
+                                else:
+                                    st.success(f"Đã nhập {import_quantity} {current_unit} nguyên liệu {selected_material_id} thành công!")
+                                    st.write(f"Số lượng mới: {new_quantity} {current_unit}")
+                                    st.write(f"Giá đơn vị mới (trung bình): {new_price_per_unit:,.0f} VND/{current_unit}")
             else:
                 st.info("Chưa có dữ liệu nguyên liệu. Vui lòng thêm nguyên liệu mới.")
                 
@@ -3662,49 +5895,56 @@ elif tab_selection == "Kho Nguyên liệu":
                 elif new_material_id in st.session_state.materials['material_id'].values:
                     st.error(f"Mã nguyên liệu {new_material_id} đã tồn tại")
                 else:
-                    # Calculate the price per unit
-                    price_per_unit = new_material_cost / new_material_quantity if new_material_quantity > 0 else 0
-                    
-                    # Add new material
-                    new_material = pd.DataFrame({
-                        'material_id': [new_material_id],
-                        'name': [new_material_name],
-                        'unit': [new_material_unit if selected_unit_option == "Khác" else selected_unit_option],
-                        'quantity': [new_material_quantity],
-                        'price_per_unit': [price_per_unit],
-                        'used_quantity': [0.0]
-                    })
+                    try:
+                        with unit_of_work():
+                            # Sổ kho được ghi trước khi tồn kho trong phiên thay đổi, cùng lần lưu bảng materials
+                            record_stock_movements(pd.Series({new_material_id: new_material_quantity}), 'import', supplier, date=import_date)
+                            
+                            # Calculate the price per unit
+                            price_per_unit = new_material_cost / new_material_quantity if new_material_quantity > 0 else 0
+                    
+                            # Add new material
+                            new_material = pd.DataFrame({
+                                'material_id': [new_material_id],
+                                'name': [new_material_name],
+                                'unit': [new_material_unit if selected_unit_option == "Khác" else selected_unit_option],
+                                'quantity': [new_material_quantity],
+                                'price_per_unit': [price_per_unit],
+                                'used_quantity': [0.0]
+                            })
                     
-                    # If materials DataFrame does not exist yet, create it
-                    if 'materials' not in st.session_state or st.session_state.materials.empty:
-                        st.session_state.materials = new_material
-                    else:
-                        st.session_state.materials = pd.concat([st.session_state.materials, new_material], ignore_index=True)
-                    
-                    # Record the initial inventory
-                    if 'material_costs' not in st.session_state:
-                        st.session_state.material_costs = pd.DataFrame(columns=[
-                            'date', 'material_id', 'quantity', 'total_cost', 'supplier'
-                        ])
-                    
-                    initial_import = pd.DataFrame({
-                        'date': [import_date],
-                        'material_id': [new_material_id],
-                        'quantity': [new_material_quantity],
-                        'total_cost': [new_material_cost],
-                        'supplier': [supplier]
-                    })
+                            # If materials DataFrame does not exist yet, create it
+                            if 'materials' not in st.session_state or st.session_state.materials.empty:
+                                st.session_state.materials = new_material
+                            else:
+                                st.session_state.materials = pd.concat([st.session_state.materials, new_material], ignore_index=True)
                     
-                    st.session_state.material_costs = pd.concat([st.session_state.material_costs, initial_import], ignore_index=True)
+                            # Record the initial inventory
+                            if 'material_costs' not in st.session_state:
+                                st.session_state.material_costs = pd.DataFrame(columns=[
+                                    'date', 'material_id', 'quantity', 'total_cost', 'supplier'
+                                ])
                     
-                    unit_display = new_material_unit if selected_unit_option == "Khác" else selected_unit_option
-                    st.success(f"Nguyên liệu mới {new_material_id} - {new_material_name} đã được thêm và nhập kho thành công!")
-                    st.write(f"Đã nhập: {new_material_quantity} {unit_display}")
-                    st.write(f"Giá đơn vị: {price_per_unit:,.0f} VND/{unit_display}")
-
-                    # Save materials and material costs data
-                    save_dataframe(st.session_state.materials, "materials.csv")
-                    save_dataframe(st.session_state.material_costs, "material_costs.csv")
+                            initial_import = pd.DataFrame({
+                                'date': [import_date],
+                                'material_id': [new_material_id],
+                                'quantity': [new_material_quantity],
+                                'total_cost': [new_material_cost],
+                                'supplier': [supplier]
+                            })
+                    
+                            st.session_state.material_costs = pd.concat([st.session_state.material_costs, initial_import], ignore_index=True)
+                    
+                            # Save materials and material costs data
+                            save_dataframe(st.session_state.materials, "materials.csv")
+                            save_dataframe(st.session_state.material_costs, "material_costs.csv")
+                    except SaveError as e:
+                        st.error(f"Lỗi khi lưu nguyên liệu mới: {e}")
+                    else:
+                        unit_display = new_material_unit if selected_unit_option == "Khác" else selected_unit_option
+                        st.success(f"Nguyên liệu mới {new_material_id} - {new_material_name} đã được thêm và nhập kho thành công!")
+                        st.write(f"Đã nhập: {new_material_quantity} {unit_display}")
+                        st.write(f"Giá đơn vị: {price_per_unit:,.0f} VND/{unit_display}")
 
     with mat_tab4:
         st.subheader("Xóa Nguyên liệu")
@@ -3766,13 +6006,15 @@ elif tab_selection == "Kho Nguyên liệu":
                     st.write(f"**Giá/Đơn vị:** {material_info['price_per_unit']:,.0f} VND")
                     
                     # Kiểm tra xem nguyên liệu có trong công thức nào không
-                    material_in_recipes = selected_material_id in st.session_state.recipes['material_id'].values
+                    # (tính cả nguyên liệu được dùng qua bán thành phẩm)
+                    flat_recipes, _ = explode_recipes()
+                    material_in_recipes = selected_material_id in flat_recipes['material_id'].values
                     
                     if material_in_recipes:
                         st.warning("⚠️ Nguyên liệu này đang được sử dụng trong các công thức sản phẩm. Xóa nguyên liệu có thể ảnh hưởng đến sản phẩm.")
                         
                         # Danh sách sản phẩm sử dụng nguyên liệu này
-                        product_recipes = st.session_state.recipes[st.session_state.recipes['material_id'] == selected_material_id]
+                        product_recipes = flat_recipes[flat_recipes['material_id'] == selected_material_id]
                         product_ids = product_recipes['product_id'].unique()
                         
                         # Lấy tên sản phẩm
@@ -3792,36 +6034,301 @@ elif tab_selection == "Kho Nguyên liệu":
                     delete_confirmed = st.checkbox("Tôi hiểu rằng hành động này không thể hoàn tác", key="delete_material_confirm")
                     
                     if st.button("Xóa Nguyên liệu") and delete_confirmed:
-                        # 1. Xóa lịch sử chi phí nhập hàng liên quan đến nguyên liệu này
-                        if 'material_costs' in st.session_state and not st.session_state.material_costs.empty:
-                            st.session_state.material_costs = st.session_state.material_costs[
-                                st.session_state.material_costs['material_id'] != selected_material_id
-                            ]
+                        with unit_of_work():
+                            # Phần tồn kho còn lại được ghi vào sổ kho như một biến động xóa nguyên liệu
+                            record_stock_movements(
+                                pd.Series({selected_material_id: -float(material_info['quantity'])}), 'removal', material_info['name']
+                            )
+                            
+                            # 1. Xóa lịch sử chi phí nhập hàng liên quan đến nguyên liệu này
+                            if 'material_costs' in st.session_state and not st.session_state.material_costs.empty:
+                                st.session_state.material_costs = st.session_state.material_costs[
+                                    st.session_state.material_costs['material_id'] != selected_material_id
+                                ]
                         
-                        # 2. Xóa nguyên liệu khỏi bảng materials
-                        st.session_state.materials = st.session_state.materials[
-                            st.session_state.materials['material_id'] != selected_material_id
-                        ]
+                            # 2. Xóa nguyên liệu khỏi bảng materials
+                            st.session_state.materials = st.session_state.materials[
+                                st.session_state.materials['material_id'] != selected_material_id
+                            ]
                         
-                        if material_in_recipes:
-                            # Hiển thị cảnh báo về công thức bị ảnh hưởng
-                            st.warning(f"Các công thức sử dụng nguyên liệu {selected_material_id} sẽ không còn chính xác!")
+                            if material_in_recipes:
+                                # Hiển thị cảnh báo về công thức bị ảnh hưởng
+                                st.warning(f"Các công thức sử dụng nguyên liệu {selected_material_id} sẽ không còn chính xác!")
                         
-                        # Lưu dữ liệu sau khi xóa
-                        save_dataframe(st.session_state.materials, "materials.csv")
-                        save_dataframe(st.session_state.material_costs, "material_costs.csv")
+                            # Lưu dữ liệu sau khi xóa
+                            save_dataframe(st.session_state.materials, "materials.csv")
+                            save_dataframe(st.session_state.material_costs, "material_costs.csv")
                         
                         st.success(f"Đã xóa nguyên liệu {selected_material_id} thành công!")
                         # Làm mới trang để cập nhật hiển thị
                         st.rerun()
         else:
             st.info("Chưa có dữ liệu nguyên liệu để xóa.")
+    
+    with mat_tab5:
+        st.subheader("Khả năng sản xuất với tồn kho hiện tại")
+        
+        capacity = product_capacity()
+        if capacity.empty:
+            st.info("Chưa có công thức sản phẩm nào.")
+        else:
+            product_names = dict(zip(st.session_state.products['product_id'], st.session_state.products['name']))
+            material_names = dict(zip(st.session_state.materials['material_id'], st.session_state.materials['name']))
+            
+            st.write("**Tính riêng từng sản phẩm** (nếu chỉ làm sản phẩm đó):")
+            capacity = capacity.dropna(subset=['max_quantity']).sort_values('max_quantity')
+            capacity_display = pd.DataFrame({
+                'Mã sản phẩm': capacity.index,
+                'Tên sản phẩm': [product_names.get(pid, pid) for pid in capacity.index],
+                'Có thể làm tối đa': capacity['max_quantity'].astype(int).to_numpy(),
+                'Nguyên liệu giới hạn': [material_names.get(mid, mid) for mid in capacity['limiting_material']]
+            })
+            st.dataframe(capacity_display)
+            
+            st.write("**Tính chung cho nhiều sản phẩm** (các sản phẩm dùng chung nguyên liệu):")
+            st.write("Nhập số lượng mong muốn, sản phẩm đứng trước được ưu tiên khi không đủ nguyên liệu.")
+            mix_products = st.multiselect(
+                "Chọn sản phẩm",
+                options=list(capacity.index),
+                format_func=lambda pid: f"{pid} - {product_names.get(pid, pid)}",
+                key="capacity_mix_products"
+            )
+            
+            if mix_products:
+                requested = {}
+                for product_id in mix_products:
+                    requested[product_id] = st.number_input(
+                        f"{product_names.get(product_id, product_id)}",
+                        min_value=0,
+                        value=1,
+                        step=1,
+                        key=f"capacity_mix_{product_id}"
+                    )
+                
+                allocation = allocate_product_mix(pd.Series(requested, dtype=float))
+                allocation_display = pd.DataFrame({
+                    'Sản phẩm': [product_names.get(pid, pid) for pid in allocation.index],
+                    'Mong muốn': allocation['requested'].astype(int).to_numpy(),
+                    'Có thể làm': allocation['allocated'].astype(int).to_numpy()
+                })
+                st.dataframe(allocation_display)
+                
+                if (allocation['allocated'] < allocation['requested']).any():
+                    st.warning("Tồn kho không đủ cho toàn bộ số lượng mong muốn.")
+                else:
+                    st.success("Tồn kho đủ cho toàn bộ số lượng mong muốn.")
+    
+    with mat_tab6:
+        st.subheader("Kế hoạch sản xuất tối ưu lợi nhuận")
+        st.write("Đề xuất số lượng mỗi sản phẩm nên làm để lãi gộp lớn nhất với tồn kho hiện tại.")
+        
+        if st.session_state.products.empty:
+            st.info("Chưa có sản phẩm nào.")
+        else:
+            plan_products = st.session_state.products[~st.session_state.products['product_id'].duplicated()]
+            
+            min_quantities = {}
+            max_quantities = {}
+            with st.expander("Số lượng tối thiểu / tối đa (tùy chọn)"):
+                st.write("Để tối đa bằng 0 nghĩa là không giới hạn.")
+                for _, product in plan_products.iterrows():
+                    col1, col2, col3 = st.columns([3, 1, 1])
+                    with col1:
+                        st.write(f"{product['product_id']} - {product['name']}")
+                    with col2:
+                        min_quantities[product['product_id']] = st.number_input(
+                            "Tối thiểu", min_value=0, value=0, step=1,
+                            key=f"plan_min_{product['product_id']}"
+                        )
+                    with col3:
+                        max_quantity = st.number_input(
+                            "Tối đa", min_value=0, value=0, step=1,
+                            key=f"plan_max_{product['product_id']}"
+                        )
+                        max_quantities[product['product_id']] = max_quantity if max_quantity > 0 else None
+            
+            if st.button("Lập kế hoạch", key="optimize_production"):
+                start_time = time.perf_counter()
+                plan, solution = optimize_production_mix(plan_products['product_id'], min_quantities, max_quantities)
+                elapsed_ms = (time.perf_counter() - start_time) * 1000
+                
+                if plan is None:
+                    st.error(solution)
+                else:
+                    plan = plan[plan['quantity'] > 0]
+                    if plan.empty:
+                        st.info("Không có sản phẩm nào có lãi với tồn kho hiện tại.")
+                    else:
+                        product_names = dict(zip(plan_products['product_id'], plan_products['name']))
+                        plan_display = pd.DataFrame({
+                            'Sản phẩm': [product_names.get(pid, pid) for pid in plan.index],
+                            'Số lượng': plan['quantity'].astype(int).to_numpy(),
+                            'Lãi/đơn vị': [f"{margin:,.0f} VND" for margin in plan['unit_margin']],
+                            'Lãi gộp': [f"{margin:,.0f} VND" for margin in plan['margin']]
+                        })
+                        st.dataframe(plan_display)
+                        st.metric("Tổng lãi gộp dự kiến", f"{plan['margin'].sum():,.0f} VND")
+                    
+                    caption = PRODUCTION_PLAN_REASONS[solution['reason']]
+                    if solution['status'] is not None and solution['reason'] != 'optimal':
+                        caption += f" - trạng thái bộ giải: {solution['status']}"
+                    st.caption(f"{caption} - {elapsed_ms:.0f} ms")
+    
+    with mat_tab7:
+        st.subheader("Sổ kho")
+        material_names = dict(zip(st.session_state.materials['material_id'], st.session_state.materials['name']))
+        
+        # Ghi nhận hao hụt
+        st.write("### Ghi nhận Hao hụt")
+        if not st.session_state.materials.empty:
+            col1, col2, col3 = st.columns([2, 1, 2])
+            with col1:
+                waste_material_id = st.selectbox(
+                    "Nguyên liệu",
+                    options=list(material_names),
+                    format_func=lambda mid: f"{mid} - {material_names.get(mid, mid)}",
+                    key="waste_material"
+                )
+            with col2:
+                waste_quantity = st.number_input("Số lượng", min_value=0.0, value=0.0, step=0.1, key="waste_quantity")
+            with col3:
+                waste_reason = st.text_input("Lý do (hỏng, hết hạn...)", key="waste_reason")
+            
+            if st.button("Ghi nhận Hao hụt", key="record_waste"):
+                if waste_quantity <= 0:
+                    st.error("Vui lòng nhập số lượng hợp lệ")
+                else:
+                    success, short = apply_inventory_movement(
+                        pd.Series({waste_material_id: -waste_quantity}), kind='waste', ref=waste_reason
+                    )
+                    if success:
+                        st.success(f"Đã ghi nhận hao hụt {waste_quantity} {material_names.get(waste_material_id, waste_material_id)}")
+                    elif short:
+                        st.error("Số lượng hao hụt lớn hơn tồn kho hiện tại")
+        
+        # Tồn kho tại một ngày bất kỳ
+        st.write("### Tồn kho theo ngày")
+        as_of_date = st.date_input("Tồn kho cuối ngày", value=datetime.date.today(), key="ledger_as_of")
+        historical_stock = derive_stock(as_of_date)
+        if historical_stock.empty:
+            st.info("Sổ kho chưa có dữ liệu đến ngày này.")
+        else:
+            st.dataframe(pd.DataFrame({
+                'Mã nguyên liệu': historical_stock.index,
+                'Tên': [material_names.get(mid, mid) for mid in historical_stock.index],
+                'Tồn kho': [f"{quantity:.5f}" for quantity in historical_stock]
+            }))
+        
+        # Lịch sử biến động
+        st.write("### Lịch sử biến động")
+        col1, col2 = st.columns(2)
+        with col1:
+            history_start = st.date_input("Từ ngày", value=datetime.date.today() - datetime.timedelta(days=7), key="ledger_start")
+        with col2:
+            history_end = st.date_input("Đến ngày", value=datetime.date.today(), key="ledger_end")
+        movements = query_dataframe('stock_movements', start_date=history_start, end_date=history_end)
+        if movements.empty:
+            st.info("Không có biến động kho trong khoảng thời gian này.")
+        else:
+            movements = movements.sort_values('ts', ascending=False)
+            st.dataframe(pd.DataFrame({
+                'Thời gian': movements['ts'].str[:19],
+                'Nguyên liệu': [material_names.get(mid, mid) for mid in movements['material_id']],
+                'Thay đổi': [f"{delta:+.5f}" for delta in movements['delta']],
+                'Loại': [STOCK_MOVEMENT_KINDS.get(kind, kind) for kind in movements['kind'].astype(str)],
+                'Tham chiếu': movements['ref']
+            }))
+        
+        # Đối chiếu tồn kho hiện tại với sổ kho
+        st.write("### Đối chiếu với Sổ kho")
+        ledger_stock = derive_stock()
+        if ledger_stock.empty:
+            st.info("Sổ kho sẽ bắt đầu từ biến động kho tiếp theo.")
+        else:
+            table_stock = pd.to_numeric(material_rows()['quantity'], errors='coerce').fillna(0)
+            differences = ledger_stock.reindex(table_stock.index).fillna(0) - table_stock
+            differences = differences[differences.abs() > 1e-6]
+            if differences.empty:
+                st.success("Tồn kho khớp với sổ kho.")
+            else:
+                st.warning("Tồn kho khác với sổ kho ở các nguyên liệu sau:")
+                st.dataframe(pd.DataFrame({
+                    'Nguyên liệu': [material_names.get(mid, mid) for mid in differences.index],
+                    'Tồn kho': table_stock.reindex(differences.index).to_numpy(),
+                    'Theo sổ kho': ledger_stock.reindex(differences.index).to_numpy()
+                }))
+                if st.button("Khôi phục tồn kho từ sổ kho", key="rebuild_stock"):
+                    materials = st.session_state.materials
+                    for material_id in differences.index:
+                        materials.loc[materials['material_id'] == material_id, 'quantity'] = float(ledger_stock[material_id])
+                    save_dataframe(st.session_state.materials, "materials.csv")
+                    st.success("Đã khôi phục tồn kho từ sổ kho!")
+                    st.rerun()
+            
+            if st.button("Tạo snapshot tồn kho", key="take_stock_snapshot"):
+                take_stock_snapshot(ledger_stock)
+                st.success("Đã tạo snapshot tồn kho!")
+    
+    with mat_tab8:
+        st.subheader("Giá vốn nguyên liệu")
+        
+        methods = list(COSTING_METHODS)
+        selected_method = st.selectbox(
+            "Phương pháp tính giá vốn cho đơn hàng mới",
+            options=methods,
+            index=methods.index(costing_method()),
+            format_func=lambda method: COSTING_METHODS[method],
+            key="costing_method_select"
+        )
+        if selected_method != costing_method():
+            set_shop_setting('costing_method', selected_method)
+        st.caption("Giá vốn nguyên liệu được ghi lên đơn hàng lúc bán, đơn hàng đã tạo không bị tính lại.")
+        
+        if not st.session_state.materials.empty:
+            # Giá trị tồn kho theo từng phương pháp
+            stock = material_rows()
+            on_hand = stock_levels(stock.index)
+            prices = pd.to_numeric(stock['price_per_unit'], errors='coerce').fillna(0)
+            value_rows = []
+            for material_id, quantity in on_hand.items():
+                layers = remaining_cost_layers(material_id)
+                # Phần tồn kho không có trong lịch sử nhập được tính theo giá hiện tại
+                untracked = max(quantity - layers['remaining'].sum(), 0)
+                fifo_value = (layers['remaining'] * layers['unit_cost']).sum() + untracked * prices[material_id]
+                value_rows.append({
+                    'Mã nguyên liệu': material_id,
+                    'Tên': stock.at[material_id, 'name'],
+                    'Tồn kho': f"{quantity:.5f}",
+                    'Giá trị (giá hiện tại)': f"{quantity * prices[material_id]:,.0f} VND",
+                    'Giá trị (FIFO)': f"{fifo_value:,.0f} VND"
+                })
+            st.write("### Giá trị tồn kho")
+            st.dataframe(pd.DataFrame(value_rows))
+            
+            st.write("### Lớp giá nhập")
+            layer_material_id = st.selectbox(
+                "Chọn nguyên liệu",
+                options=list(stock.index),
+                format_func=lambda mid: f"{mid} - {stock.at[mid, 'name']}",
+                key="cost_layer_material"
+            )
+            layers = remaining_cost_layers(layer_material_id)
+            if layers.empty:
+                st.info("Nguyên liệu này chưa có lịch sử nhập hàng.")
+            else:
+                st.dataframe(pd.DataFrame({
+                    'Ngày nhập': layers['date'],
+                    'Nhà cung cấp': layers['supplier'],
+                    'Lượng nhập': [f"{quantity:.5f}" for quantity in layers['quantity']],
+                    'Giá nhập/đơn vị': [f"{cost:,.0f} VND" for cost in layers['unit_cost']],
+                    'Còn lại (FIFO)': [f"{quantity:.5f}" for quantity in layers['remaining']]
+                }))
 
 # Product Management Tab
 elif tab_selection == "Quản lý Sản phẩm":
     st.header("Quản lý Sản phẩm")
     
-    price_tab1, price_tab2, price_tab3, price_tab4 = st.tabs(["Xem Sản phẩm", "Cập nhật Sản phẩm", "Thêm Sản phẩm Mới", "Xóa Sản phẩm"])
+    price_tab1, price_tab2, price_tab3, price_tab4, price_tab5 = st.tabs(["Xem Sản phẩm", "Cập nhật Sản phẩm", "Thêm Sản phẩm Mới", "Xóa Sản phẩm", "Bán thành phẩm"])
     
     with price_tab1:
         st.subheader("Sản phẩm Hiện tại")
@@ -3844,44 +6351,12 @@ elif tab_selection == "Quản lý Sản phẩm":
                 
                 profit_data = []
                 
+                # Giá thành đơn vị (nguyên liệu, nhân công, khấu hao và chi phí khác) của từng sản phẩm
+                unit_costs = get_unit_costs()['total_cost']
+                
                 for _, product in st.session_state.products.iterrows():
                     product_id = product['product_id']
-                    product_recipes = st.session_state.recipes[st.session_state.recipes['product_id'] == product_id]
-                    
-                    # Calculate cost
-                    cost = 0
-                    if not product_recipes.empty:
-                        for _, recipe in product_recipes.iterrows():
-                            material_id = recipe['material_id']
-                            quantity = recipe['quantity']
-                            
-                            material_price_data = st.session_state.materials[st.session_state.materials['material_id'] == material_id]
-                            if not material_price_data.empty:
-                                material_price = material_price_data['price_per_unit'].iloc[0]
-                                cost += quantity * material_price
-
-                    # Thêm chi phí nhân công, khấu hao và chi phí khác từ product_costs
-                    # Chỉ áp dụng nếu có dữ liệu product_costs
-                    if 'product_costs' in st.session_state and not st.session_state.product_costs.empty:
-                        product_cost_data = st.session_state.product_costs[
-                            st.session_state.product_costs['product_id'] == product_id
-                        ]
-                        
-                        if not product_cost_data.empty:
-                            # Thêm chi phí nhân công (production_fee)
-                            if 'production_fee' in product_cost_data.columns:
-                                production_fee = product_cost_data['production_fee'].iloc[0]
-                                cost += production_fee
-                            
-                            # Thêm chi phí khác (other_fee)
-                            if 'other_fee' in product_cost_data.columns:
-                                other_fee = product_cost_data['other_fee'].iloc[0]
-                                cost += other_fee
-                            
-                            # Thêm chi phí khấu hao (Depreciation_fee)
-                            if 'Depreciation_fee' in product_cost_data.columns:
-                                depreciation_fee = product_cost_data['Depreciation_fee'].iloc[0]
-                                cost += depreciation_fee
+                    cost = unit_costs.get(product_id, 0)
                     
                     # Calculate profit margin
                     price = product['price']
@@ -4040,7 +6515,7 @@ elif tab_selection == "Quản lý Sản phẩm":
                                 st.write(f"{material['name']} ({material['unit']})")
                             with col2:
                                 quantity = st.number_input(
-                                    f"SL",
+                                    "SL",
                                     min_value=0.0,
                                     value=float(current_quantity),
                                     step=0.00001,
@@ -4063,6 +6538,45 @@ elif tab_selection == "Quản lý Sản phẩm":
                     else:
                         st.warning("Không có nguyên liệu nào trong kho. Vui lòng thêm nguyên liệu trước.")
                     
+                    # Bán thành phẩm dùng trong công thức
+                    if not st.session_state.preparations.empty:
+                        st.write("Bán thành phẩm:")
+                        prep_costs = preparation_unit_costs()
+                        for _, preparation in st.session_state.preparations.iterrows():
+                            prep_id = preparation['prep_id']
+                            
+                            current_quantity = 0
+                            if not current_recipe.empty:
+                                prep_in_recipe = current_recipe[current_recipe['material_id'] == prep_id]
+                                if not prep_in_recipe.empty:
+                                    current_quantity = prep_in_recipe['quantity'].iloc[0]
+                            
+                            col1, col2, col3 = st.columns([3, 1, 2])
+                            with col1:
+                                st.write(f"{preparation['name']} ({preparation['unit']})")
+                            with col2:
+                                quantity = st.number_input(
+                                    "SL",
+                                    min_value=0.0,
+                                    value=float(current_quantity),
+                                    step=0.00001,
+                                    format="%.5f",
+                                    key=f"update_recipe_{prep_id}"
+                                )
+                            with col3:
+                                if quantity > 0:
+                                    material_cost = quantity * prep_costs.get(prep_id, 0)
+                                    st.write(f"{material_cost:,.0f} VND")
+                                    total_material_cost += material_cost
+                                else:
+                                    st.write("0 VND")
+                            
+                            if quantity > 0:
+                                recipe_materials.append({
+                                    'material_id': prep_id,
+                                    'quantity': quantity
+                                })
+                    
                     # Calculate total cost and suggested price
                     total_cost = total_material_cost + production_fee + other_fee + depreciation_fee
 
@@ -4163,9 +6677,10 @@ elif tab_selection == "Quản lý Sản phẩm":
                             st.session_state.recipes = pd.concat([st.session_state.recipes, new_recipes], ignore_index=True)
                         
                         # Save data
-                        save_dataframe(st.session_state.products, "products.csv")
-                        save_dataframe(st.session_state.recipes, "recipes.csv")
-                        save_dataframe(st.session_state.product_costs, "product_costs.csv")
+                        with unit_of_work():
+                            save_dataframe(st.session_state.products, "products.csv")
+                            save_dataframe(st.session_state.recipes, "recipes.csv")
+                            save_dataframe(st.session_state.product_costs, "product_costs.csv")
                         
                         st.success(f"Sản phẩm {selected_product_id} đã được cập nhật thành công!")
         else:
@@ -4237,7 +6752,7 @@ elif tab_selection == "Quản lý Sản phẩm":
                     st.write(f"{material['name']} ({material['unit']})")
                 with col2:
                     quantity = st.number_input(
-                        f"SL",
+                        "SL",
                         min_value=0.0,
                         value=0.0,
                         step=0.00001,
@@ -4260,6 +6775,37 @@ elif tab_selection == "Quản lý Sản phẩm":
         else:
             st.warning("Không có nguyên liệu nào trong kho. Vui lòng thêm nguyên liệu trước.")
         
+        # Bán thành phẩm dùng trong công thức
+        if not st.session_state.preparations.empty:
+            st.write("Bán thành phẩm:")
+            prep_costs = preparation_unit_costs()
+            for _, preparation in st.session_state.preparations.iterrows():
+                col1, col2, col3 = st.columns([3, 1, 2])
+                with col1:
+                    st.write(f"{preparation['name']} ({preparation['unit']})")
+                with col2:
+                    quantity = st.number_input(
+                        "SL",
+                        min_value=0.0,
+                        value=0.0,
+                        step=0.00001,
+                        format="%.5f",
+                        key=f"new_recipe_{preparation['prep_id']}"
+                    )
+                with col3:
+                    if quantity > 0:
+                        material_cost = quantity * prep_costs.get(preparation['prep_id'], 0)
+                        st.write(f"{material_cost:,.0f} VND")
+                        total_material_cost += material_cost
+                    else:
+                        st.write("0 VND")
+                
+                if quantity > 0:
+                    recipe_materials.append({
+                        'material_id': preparation['prep_id'],
+                        'quantity': quantity
+                    })
+        
         # Calculate total cost and suggested price
         total_cost = total_material_cost + production_fee + other_fee + Depreciation_fee
 
@@ -4348,11 +6894,12 @@ elif tab_selection == "Quản lý Sản phẩm":
                 st.session_state.product_costs = pd.concat([st.session_state.product_costs, new_cost_info], ignore_index=True)
                 
                 # Save products, recipes, and product costs data
+                with unit_of_work():
+                    save_dataframe(st.session_state.products, "products.csv")
+                    save_dataframe(st.session_state.recipes, "recipes.csv")
+                    if 'product_costs' in st.session_state:
+                        save_dataframe(st.session_state.product_costs, "product_costs.csv")
                 st.success(f"Sản phẩm {new_product_id} đã được thêm thành công!")
-                save_dataframe(st.session_state.products, "products.csv")
-                save_dataframe(st.session_state.recipes, "recipes.csv")
-                if 'product_costs' in st.session_state:
-                    save_dataframe(st.session_state.product_costs, "product_costs.csv")
     
     # Add new Delete Products tab
     with price_tab4:
@@ -4400,14 +6947,172 @@ elif tab_selection == "Quản lý Sản phẩm":
                         # Delete product's recipes from recipes DataFrame
                         st.session_state.recipes = st.session_state.recipes[st.session_state.recipes['product_id'] != selected_product_id]
                         
-                        st.success(f"Sản phẩm {selected_product_id} đã được xóa thành công!")
-        
                         # Save products and recipes data
-                        save_dataframe(st.session_state.products, "products.csv")
-                        save_dataframe(st.session_state.recipes, "recipes.csv")
+                        with unit_of_work():
+                            save_dataframe(st.session_state.products, "products.csv")
+                            save_dataframe(st.session_state.recipes, "recipes.csv")
+                        
+                        st.success(f"Sản phẩm {selected_product_id} đã được xóa thành công!")
         
         else:
             st.info("Chưa có dữ liệu sản phẩm để xóa.")
+    
+    with price_tab5:
+        st.subheader("Bán thành phẩm")
+        st.write("Bán thành phẩm (cốt bánh, kem bơ, ganache...) được làm từ nguyên liệu hoặc bán thành phẩm khác và có thể dùng trong công thức của nhiều sản phẩm.")
+        
+        preparations = st.session_state.preparations
+        preparation_items = st.session_state.preparation_items
+        material_names = dict(zip(st.session_state.materials['material_id'], st.session_state.materials['name']))
+        prep_names = dict(zip(preparations['prep_id'], preparations['name']))
+        
+        if not preparations.empty:
+            prep_costs = preparation_unit_costs()
+            prep_display = []
+            for _, preparation in preparations.iterrows():
+                prep_id = preparation['prep_id']
+                components = preparation_items[preparation_items['prep_id'] == prep_id]
+                prep_display.append({
+                    'Mã': prep_id,
+                    'Tên': preparation['name'],
+                    'Đơn vị': preparation['unit'],
+                    'Sản lượng mỗi mẻ': preparation['yield_quantity'],
+                    'Thành phần mỗi mẻ': ", ".join(
+                        f"{material_names.get(component_id, prep_names.get(component_id, component_id))}: {quantity:g}"
+                        for component_id, quantity in zip(components['component_id'], components['quantity'])
+                    ),
+                    'Giá vốn NVL / đơn vị': f"{prep_costs.get(prep_id, 0):,.0f} VND"
+                })
+            st.dataframe(pd.DataFrame(prep_display))
+        else:
+            st.info("Chưa có bán thành phẩm nào.")
+        
+        st.write("### Thêm hoặc Cập nhật Bán thành phẩm")
+        prep_options = ["Tạo mới"] + [f"{prep_id} - {name}" for prep_id, name in prep_names.items()]
+        selected_prep = st.selectbox("Chọn bán thành phẩm", options=prep_options, key="prep_edit_select")
+        
+        if selected_prep == "Tạo mới":
+            edit_prep_id = st.text_input("Mã bán thành phẩm (vd: BTP01)", key="new_prep_id")
+            current_prep = None
+            current_components = preparation_items.iloc[0:0]
+        else:
+            edit_prep_id = selected_prep.split(' - ')[0]
+            current_prep = preparations[preparations['prep_id'] == edit_prep_id].iloc[0]
+            current_components = preparation_items[preparation_items['prep_id'] == edit_prep_id]
+        form_key = edit_prep_id if current_prep is not None else "new"
+        
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            prep_name = st.text_input(
+                "Tên bán thành phẩm",
+                value=current_prep['name'] if current_prep is not None else "",
+                key=f"prep_name_{form_key}"
+            )
+        with col2:
+            prep_unit = st.text_input(
+                "Đơn vị",
+                value=current_prep['unit'] if current_prep is not None else "g",
+                key=f"prep_unit_{form_key}"
+            )
+        with col3:
+            prep_yield = st.number_input(
+                "Sản lượng mỗi mẻ",
+                min_value=0.00001,
+                value=float(current_prep['yield_quantity']) if current_prep is not None else 1.0,
+                step=0.00001,
+                format="%.5f",
+                key=f"prep_yield_{form_key}"
+            )
+        
+        st.write("Thành phần cho một mẻ:")
+        current_quantities = dict(zip(current_components['component_id'], current_components['quantity']))
+        component_rows = []
+        component_options = [
+            (material_id, f"{name} ({unit})")
+            for material_id, name, unit in zip(
+                st.session_state.materials['material_id'], st.session_state.materials['name'], st.session_state.materials['unit']
+            )
+        ] + [
+            (prep_id, f"{name} ({unit}) - bán thành phẩm")
+            for prep_id, name, unit in zip(preparations['prep_id'], preparations['name'], preparations['unit'])
+            if prep_id != edit_prep_id
+        ]
+        for component_id, label in component_options:
+            col1, col2 = st.columns([3, 1])
+            with col1:
+                st.write(label)
+            with col2:
+                quantity = st.number_input(
+                    "SL",
+                    min_value=0.0,
+                    value=float(current_quantities.get(component_id, 0)),
+                    step=0.00001,
+                    format="%.5f",
+                    key=f"prep_component_{form_key}_{component_id}"
+                )
+            if quantity > 0:
+                component_rows.append({'prep_id': edit_prep_id, 'component_id': component_id, 'quantity': quantity})
+        
+        if st.button("Lưu Bán thành phẩm", key="save_preparation"):
+            new_items = pd.DataFrame(component_rows, columns=['prep_id', 'component_id', 'quantity'])
+            candidate_items = pd.concat([
+                preparation_items[preparation_items['prep_id'] != edit_prep_id], new_items
+            ], ignore_index=True)
+            cycle = find_preparation_cycle(candidate_items)
+            
+            if not edit_prep_id or not prep_name:
+                st.error("Vui lòng nhập mã và tên bán thành phẩm")
+            elif current_prep is None and edit_prep_id in prep_names:
+                st.error(f"Mã bán thành phẩm {edit_prep_id} đã tồn tại")
+            elif edit_prep_id in material_names:
+                st.error(f"Mã {edit_prep_id} đang được dùng cho một nguyên liệu")
+            elif new_items.empty:
+                st.error("Vui lòng thêm ít nhất một thành phần")
+            elif cycle:
+                st.error(f"Công thức tạo thành vòng lặp: {' → '.join(map(str, cycle))}")
+            else:
+                new_prep = pd.DataFrame({
+                    'prep_id': [edit_prep_id],
+                    'name': [prep_name],
+                    'unit': [prep_unit],
+                    'yield_quantity': [prep_yield]
+                })
+                st.session_state.preparations = pd.concat([
+                    preparations[preparations['prep_id'] != edit_prep_id], new_prep
+                ], ignore_index=True)
+                st.session_state.preparation_items = candidate_items
+                
+                with unit_of_work():
+                    save_dataframe(st.session_state.preparations, "preparations.csv")
+                    save_dataframe(st.session_state.preparation_items, "preparation_items.csv")
+                
+                st.success(f"Đã lưu bán thành phẩm {edit_prep_id}!")
+                st.rerun()
+        
+        if not preparations.empty:
+            st.write("### Xóa Bán thành phẩm")
+            delete_prep = st.selectbox(
+                "Chọn bán thành phẩm để xóa",
+                options=[f"{prep_id} - {name}" for prep_id, name in prep_names.items()],
+                key="prep_delete_select"
+            )
+            delete_prep_id = delete_prep.split(' - ')[0]
+            used_in_recipes = delete_prep_id in st.session_state.recipes['material_id'].values
+            used_in_preparations = delete_prep_id in preparation_items['component_id'].values
+            
+            if st.button("Xóa Bán thành phẩm", key="delete_preparation"):
+                if used_in_recipes or used_in_preparations:
+                    st.error("Bán thành phẩm đang được dùng trong công thức sản phẩm hoặc bán thành phẩm khác, không thể xóa.")
+                else:
+                    st.session_state.preparations = preparations[preparations['prep_id'] != delete_prep_id]
+                    st.session_state.preparation_items = preparation_items[preparation_items['prep_id'] != delete_prep_id]
+                    
+                    with unit_of_work():
+                        save_dataframe(st.session_state.preparations, "preparations.csv")
+                        save_dataframe(st.session_state.preparation_items, "preparation_items.csv")
+                    
+                    st.success(f"Đã xóa bán thành phẩm {delete_prep_id}!")
+                    st.rerun()
 
 # Invoice Management Tab - Updated with Completion Status
 elif tab_selection == "Quản lý Hóa đơn":
@@ -4639,10 +7344,13 @@ elif tab_selection == "Quản lý Hóa đơn":
                                 st.session_state.invoices['invoice_id'] == selected_invoice_id
                             ].index[0]
                             st.session_state.invoices.at[invoice_idx, 'payment_method'] = new_payment_method
+                            refresh_sales_cube_days([get_order_date(st.session_state.invoices.at[invoice_idx, 'order_id'])])
 
                             # Save both invoice and status data
-                            save_dataframe(st.session_state.invoice_status, "invoice_status.csv")
-                            save_dataframe(st.session_state.invoices, "invoices.csv")
+                            with unit_of_work():
+                                save_dataframe(st.session_state.invoice_status, "invoice_status.csv")
+                                save_dataframe(st.session_state.invoices, "invoices.csv")
+                                save_dataframe(st.session_state.sales_cube, "sales_cube.csv")
                             
                             st.success(f"Thông tin hóa đơn {selected_invoice_id} đã được cập nhật!")
                             # Bỏ dòng time.sleep(0.5) vì module time chưa được import
@@ -4742,12 +7450,15 @@ elif tab_selection == "Quản lý Hóa đơn":
                 st.session_state.order_items = pd.concat([st.session_state.order_items, demo_item], ignore_index=True)
                 st.session_state.invoices = pd.concat([st.session_state.invoices, demo_invoice], ignore_index=True)
                 st.session_state.invoice_status = pd.concat([st.session_state.invoice_status, demo_status], ignore_index=True)
+                refresh_sales_cube_days([get_order_date(order_id)])
                 
                 # Save orders, order items, invoices, and invoice status data
-                save_dataframe(st.session_state.orders, "orders.csv")
-                save_dataframe(st.session_state.order_items, "order_items.csv")
-                save_dataframe(st.session_state.invoices, "invoices.csv")
-                save_dataframe(st.session_state.invoice_status, "invoice_status.csv")
+                with unit_of_work():
+                    save_dataframe(st.session_state.orders, "orders.csv")
+                    save_dataframe(st.session_state.order_items, "order_items.csv")
+                    save_dataframe(st.session_state.invoices, "invoices.csv")
+                    save_dataframe(st.session_state.invoice_status, "invoice_status.csv")
+                    save_dataframe(st.session_state.sales_cube, "sales_cube.csv")
                 
                 st.success("Đã tạo hóa đơn mẫu thành công!")
                 time.sleep(0.5)  # Brief pause to ensure data is saved
@@ -4931,14 +7642,15 @@ elif tab_selection == "Quản lý Hóa đơn":
                                 ]
                             
                             # 4. Lưu các thay đổi
-                            save_dataframe(st.session_state.invoices, "invoices.csv")
-                            save_dataframe(st.session_state.invoice_status, "invoice_status.csv")
-                            save_dataframe(st.session_state.income, "income.csv")
-                            save_dataframe(st.session_state.materials, "materials.csv")
+                            with unit_of_work():
+                                save_dataframe(st.session_state.invoices, "invoices.csv")
+                                save_dataframe(st.session_state.invoice_status, "invoice_status.csv")
+                                save_dataframe(st.session_state.income, "income.csv")
+                                save_dataframe(st.session_state.sales_cube, "sales_cube.csv")
                             
-                            if delete_order_too:
-                                save_dataframe(st.session_state.orders, "orders.csv")
-                                save_dataframe(st.session_state.order_items, "order_items.csv")
+                                if delete_order_too:
+                                    save_dataframe(st.session_state.orders, "orders.csv")
+                                    save_dataframe(st.session_state.order_items, "order_items.csv")
                             
                             st.success(f"Đã xóa hóa đơn {selected_invoice_id} thành công!" + 
                                     (f" và đơn hàng {order_id}" if delete_order_too else ""))
@@ -5013,8 +7725,7 @@ elif tab_selection == "Quản lý Dữ liệu":
             if st.button("Lưu Tất cả Dữ liệu"):
                 try:
                     # Save all current data
-                    save_all_data()
-                    st.success("Đã lưu tất cả dữ liệu thành công!")
+                    show_save_summary(save_all_data())
                 except Exception as e:
                     st.error(f"Lỗi khi lưu dữ liệu: {str(e)}")
         
@@ -5083,13 +7794,16 @@ elif tab_selection == "Quản lý Dữ liệu":
                         st.session_state.invoices = default_invoices.copy()
                         st.session_state.invoice_status = default_invoice_status.copy()
                         st.session_state.income = default_income.copy()
+                        st.session_state.sales_cube = default_sales_cube.copy()
                         
                         # Save the reset data
-                        save_dataframe(st.session_state.orders, "orders.csv")
-                        save_dataframe(st.session_state.order_items, "order_items.csv")
-                        save_dataframe(st.session_state.invoices, "invoices.csv")
-                        save_dataframe(st.session_state.invoice_status, "invoice_status.csv")
-                        save_dataframe(st.session_state.income, "income.csv")
+                        with unit_of_work():
+                            save_dataframe(st.session_state.orders, "orders.csv")
+                            save_dataframe(st.session_state.order_items, "order_items.csv")
+                            save_dataframe(st.session_state.invoices, "invoices.csv")
+                            save_dataframe(st.session_state.invoice_status, "invoice_status.csv")
+                            save_dataframe(st.session_state.income, "income.csv")
+                            save_dataframe(st.session_state.sales_cube, "sales_cube.csv")
                         
                     elif reset_options == "Xóa dữ liệu kho":
                         # Reset materials data
@@ -5097,8 +7811,9 @@ elif tab_selection == "Quản lý Dữ liệu":
                         st.session_state.material_costs = default_material_costs.copy()
                         
                         # Save the reset data
-                        save_dataframe(st.session_state.materials, "materials.csv")
-                        save_dataframe(st.session_state.material_costs, "material_costs.csv")
+                        with unit_of_work():
+                            save_dataframe(st.session_state.materials, "materials.csv")
+                            save_dataframe(st.session_state.material_costs, "material_costs.csv")
                         
                     elif reset_options == "Xóa dữ liệu sản phẩm":
                         # Reset product data
@@ -5106,8 +7821,9 @@ elif tab_selection == "Quản lý Dữ liệu":
                         st.session_state.recipes = default_recipes.copy()
                         
                         # Save the reset data
-                        save_dataframe(st.session_state.products, "products.csv")
-                        save_dataframe(st.session_state.recipes, "recipes.csv")
+                        with unit_of_work():
+                            save_dataframe(st.session_state.products, "products.csv")
+                            save_dataframe(st.session_state.recipes, "recipes.csv")
                         
                     else:  # Xóa tất cả
                         # Reset all data
@@ -5119,6 +7835,7 @@ elif tab_selection == "Quản lý Dữ liệu":
                         st.session_state.invoices = default_invoices.copy()
                         st.session_state.invoice_status = default_invoice_status.copy()
                         st.session_state.income = default_income.copy()
+                        st.session_state.sales_cube = default_sales_cube.copy()
                         st.session_state.material_costs = default_material_costs.copy()
                         
                         # Save all reset data
@@ -5141,10 +7858,7 @@ elif tab_selection == "Quản lý Dữ liệu":
         
         # Create table of all data structures in app
         session_data = []
-        for key in [
-            'products', 'materials', 'recipes', 'orders', 'order_items', 
-            'invoices', 'income', 'material_costs', 'invoice_status'
-        ]:
+        for key in TABLE_DEFAULTS:
             if key in st.session_state:
                 rows = len(st.session_state[key])
                 columns = len(st.session_state[key].columns) if rows > 0 else 0
@@ -5163,6 +7877,18 @@ elif tab_selection == "Quản lý Dữ liệu":
         
         st.table(pd.DataFrame(session_data))
         
+        # Daily revenue table rebuild
+        st.subheader("Bảng doanh thu theo ngày")
+        st.write("Doanh thu theo ngày và cube phân tích bán hàng được tổng hợp từ các đơn hàng có hóa đơn. Tính lại toàn bộ nếu số liệu doanh thu không khớp với đơn hàng.")
+        if st.button("Tính lại toàn bộ doanh thu từ đơn hàng", key="rebuild_income"):
+            start_time = time.perf_counter()
+            rebuild_income()
+            rebuild_sales_cube()
+            with unit_of_work():
+                save_dataframe(st.session_state.income, "income.csv")
+                save_dataframe(st.session_state.sales_cube, "sales_cube.csv")
+            st.success(f"Đã tính lại {len(st.session_state.income)} ngày doanh thu trong {time.perf_counter() - start_time:.2f} giây")
+        
         # MongoDB storage info
         if "mongo_client" in st.session_state and "mongo_db" in st.session_state:
             st.subheader("Tình trạng MongoDB")
@@ -5210,13 +7936,33 @@ elif tab_selection == "Quản lý Dữ liệu":
                 if out_of_sync:
                     st.warning(f"Dữ liệu không đồng bộ: {', '.join(out_of_sync)}. Hãy sử dụng nút 'Lưu Tất cả Dữ liệu' để cập nhật MongoDB.")
                 
+                # Index usage since the server last started (from $indexStats)
+                index_data = []
+                for key in COLLECTION_INDEXES:
+                    if key not in actual_collections:
+                        continue
+                    for stats in mongo_db[key].aggregate([{'$indexStats': {}}]):
+                        index_data.append({
+                            "Tên dữ liệu": key,
+                            "Chỉ mục": stats['name'],
+                            "Trường": ", ".join(stats['key'].keys()),
+                            "Số lần sử dụng": stats['accesses']['ops'],
+                            "Từ thời điểm": stats['accesses']['since'].strftime('%Y-%m-%d %H:%M'),
+                        })
+                
+                if index_data:
+                    st.write("#### Chỉ mục và mức độ sử dụng:")
+                    st.table(pd.DataFrame(index_data))
+                
             except Exception as e:
                 st.error(f"Lỗi khi truy cập MongoDB: {str(e)}")
         
         # Add a force save button
         if st.button("Lưu lại tất cả dữ liệu"):
-            save_all_data()
-            st.success("Đã lưu lại tất cả dữ liệu thành công!")
+            try:
+                show_save_summary(save_all_data(force=True))
+            except SaveError as e:
+                st.error(str(e))
 
 
 elif tab_selection == "Quản lý chi tiêu gia đình":
@@ -5335,9 +8081,21 @@ elif tab_selection == "Quản lý chi tiêu gia đình":
             income_data = filtered_expenses[filtered_expenses['type'] == 'income']
             expense_data = filtered_expenses[filtered_expenses['type'] == 'expense']
             
-            # Calculate totals
-            total_income = income_data['amount'].sum() if not income_data.empty else 0
-            total_expense = expense_data['amount'].sum() if not expense_data.empty else 0
+            # Calculate totals of the period and of the previous period of the same length
+            # from the cumulative-sum index (by type and payment method)
+            expense_index = get_prefix_index('family_expenses', ['amount'], ['type', 'payment_method'])
+            payment_filter = {} if payment_method_filter == "Tất cả" else {'payment_method': payment_method_filter}
+            previous_start_str, previous_end_str = previous_period(start_date_str, end_date_str)
+            
+            def period_amounts(transaction_type):
+                totals = expense_index.range_totals(
+                    [start_date_str, previous_start_str], [end_date_str, previous_end_str],
+                    type=transaction_type, **payment_filter
+                )
+                return totals[0, 0], totals[1, 0]
+            
+            total_income, previous_income = period_amounts('income')
+            total_expense, previous_expense = period_amounts('expense')
             balance = total_income - total_expense
             
             # Display summary metrics
@@ -5349,13 +8107,17 @@ elif tab_selection == "Quản lý chi tiêu gia đình":
             
             col1, col2, col3 = st.columns(3)
             with col1:
-                st.metric("Tổng Thu", f"{total_income:,.0f} VND")
+                st.metric("Tổng Thu", f"{total_income:,.0f} VND",
+                          delta=f"{total_income - previous_income:,.0f} VND so với kỳ trước")
             with col2:
-                st.metric("Tổng Chi", f"{total_expense:,.0f} VND")
+                st.metric("Tổng Chi", f"{total_expense:,.0f} VND",
+                          delta=f"{total_expense - previous_expense:,.0f} VND so với kỳ trước",
+                          delta_color="inverse")
             with col3:
                 st.metric("Còn lại", f"{balance:,.0f} VND", 
                         delta=f"{balance:,.0f} VND", 
                         delta_color="normal" if balance >= 0 else "inverse")
+            st.caption(f"Kỳ trước: {previous_start_str} đến {previous_end_str}")
                         
             # Display expense and income tables side by side
             col1, col2 = st.columns(2)
@@ -6626,8 +9388,9 @@ elif tab_selection == "Quản lý chi tiêu gia đình":
                                     ]
                                     
                                     # Save both dataframes
-                                    save_dataframe(st.session_state.family_expenses, "family_expenses.csv")
-                                    save_dataframe(st.session_state.expected_transactions, "expected_transactions.csv")
+                                    with unit_of_work():
+                                        save_dataframe(st.session_state.family_expenses, "family_expenses.csv")
+                                        save_dataframe(st.session_state.expected_transactions, "expected_transactions.csv")
                                     
                                     st.success(f"Đã chuyển đổi khoản chi dự kiến thành khoản chi thực tế thành công!")
                                     st.rerun()  # Reload to update the display
@@ -7238,8 +10001,9 @@ elif tab_selection == "Quản lý chi tiêu gia đình":
                                     ]
                                     
                                     # Save both dataframes
-                                    save_dataframe(st.session_state.family_expenses, "family_expenses.csv")
-                                    save_dataframe(st.session_state.expected_transactions, "expected_transactions.csv")
+                                    with unit_of_work():
+                                        save_dataframe(st.session_state.family_expenses, "family_expenses.csv")
+                                        save_dataframe(st.session_state.expected_transactions, "expected_transactions.csv")
                                     
                                     st.success(f"Đã chuyển đổi khoản thu dự kiến thành khoản thu thực tế thành công!")
                                     st.rerun()  # Reload to update the display
@@ -0,0 +1,116 @@
+"""Test fixtures: load the data functions of app.py without running its Streamlit pages.
+
+app.py is a Streamlit script, so importing it would render every page. The fixtures
+execute only its imports, constants, table defaults, functions and classes against a
+minimal stand-in for the `st` module, and give each test a fresh session state.
+"""
+import ast
+import functools
+import pathlib
+import types
+
+import pytest
+
+APP_PATH = pathlib.Path(__file__).resolve().parent.parent / 'app.py'
+
+
+class SessionState(dict):
+    """dict with attribute access, like st.session_state"""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+    def __delattr__(self, name):
+        del self[name]
+
+
+def _cache_decorator(*args, **kwargs):
+    return functools.cache
+
+
+def _fake_streamlit(messages):
+    def record(level):
+        return lambda *args, **kwargs: messages.append((level, ' '.join(map(str, args))))
+
+    sidebar = types.SimpleNamespace(
+        write=record('sidebar'), error=record('sidebar'), warning=record('sidebar'), info=record('sidebar')
+    )
+    return types.SimpleNamespace(
+        session_state=SessionState(),
+        secrets={},
+        cache_resource=_cache_decorator,
+        cache_data=_cache_decorator,
+        error=record('error'),
+        warning=record('warning'),
+        info=record('info'),
+        success=record('success'),
+        sidebar=sidebar,
+    )
+
+
+def _is_module_constant(node):
+    """Constants and table defaults; the page code assigns lowercase names from widgets"""
+    if not isinstance(node, ast.Assign):
+        return False
+    names = [target.id for target in node.targets if isinstance(target, ast.Name)]
+    return bool(names) and all(name.isupper() or name.startswith('default_') for name in names)
+
+
+def load_app():
+    """Namespace with the definitions of app.py, bound to a fake `st` (namespace['st'])"""
+    messages = []
+    namespace = {'__name__': 'app', 'st': _fake_streamlit(messages), 'show_debug': False, 'messages': messages}
+    tree = ast.parse(APP_PATH.read_text(encoding='utf-8'))
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            if any(alias.name == 'streamlit' for alias in node.names):
+                continue
+            try:
+                exec(compile(ast.Module([node], []), str(APP_PATH), 'exec'), namespace)
+            except ImportError:
+                # PDF and chart libraries are only needed by the pages
+                pass
+        elif isinstance(node, (ast.FunctionDef, ast.ClassDef)) or _is_module_constant(node):
+            exec(compile(ast.Module([node], []), str(APP_PATH), 'exec'), namespace)
+    return namespace
+
+
+@pytest.fixture
+def app():
+    """Fresh app namespace with an empty session state and no database"""
+    return load_app()
+
+
+@pytest.fixture
+def db(app):
+    """In-memory MongoDB database connected to the app session"""
+    mongomock = pytest.importorskip('mongomock')
+    client = mongomock.MongoClient()
+    database = client['bakery_test']
+    app['st'].session_state.mongo_client = client
+    app['st'].session_state.mongo_db = database
+    return database
+
+
+
+def load_materials(app, db, rows):
+    """Store materials in MongoDB and load them into the session like the app does"""
+    db['materials'].insert_many([dict(row, used_quantity=row.get('used_quantity', 0.0)) for row in rows])
+    st = app['st']
+    st.session_state.materials = app['load_dataframe']('materials.csv', app['default_materials'])
+    return st.session_state.materials
+
+
+@pytest.fixture
+def materials(app, db):
+    """Two stored materials loaded into the session: M1 (10) and M2 (3)"""
+    return load_materials(app, db, [
+        {'material_id': 'M1', 'name': 'Bột', 'unit': 'g', 'quantity': 10.0, 'price_per_unit': 100},
+        {'material_id': 'M2', 'name': 'Đường', 'unit': 'g', 'quantity': 3.0, 'price_per_unit': 10},
+    ])
@@ -0,0 +1,59 @@
+"""Material issue costs (FIFO position kept per material) and the persisted costing method"""
+import pandas as pd
+import pytest
+
+from conftest import load_app, load_materials
+
+
+@pytest.fixture
+def flour(app, db):
+    """20 g of flour bought in two layers: 10 g at 100 and 10 g at 200"""
+    db['material_costs'].insert_many([
+        {'date': '2026-01-01', 'material_id': 'M1', 'quantity': 10.0, 'total_cost': 1000, 'supplier': 'A'},
+        {'date': '2026-01-05', 'material_id': 'M1', 'quantity': 10.0, 'total_cost': 2000, 'supplier': 'B'},
+    ])
+    return load_materials(app, db, [
+        {'material_id': 'M1', 'name': 'Bột', 'unit': 'g', 'quantity': 20.0, 'price_per_unit': 150},
+    ])
+
+
+def sell(app, quantity, ref):
+    """FIFO cost of a sale, then the stock issue itself (like update_materials_after_order)"""
+    required = pd.Series({'M1': quantity})
+    cost = float(app['material_issue_costs'](required, 'fifo').sum())
+    assert app['apply_inventory_movement'](-required, kind='sale', ref=ref)[0]
+    return cost
+
+
+def test_fifo_after_waste_continues_from_sold_quantity(app, db, flour):
+    assert sell(app, 5.0, 'ORD-1') == 500.0
+    assert app['apply_inventory_movement'](pd.Series({'M1': -5.0}), kind='waste')[0]
+
+    # Waste does not use up the first layer for sales: 5 g at 100 are left in it
+    assert sell(app, 8.0, 'ORD-2') == 5 * 100 + 3 * 200
+
+
+def test_fifo_after_manual_adjustment(app, db, flour):
+    assert sell(app, 4.0, 'ORD-1') == 400.0
+    assert app['set_stock_level']('M1', 30.0, 'Kiểm kê')
+
+    assert sell(app, 2.0, 'ORD-2') == 200.0
+    assert db['materials'].find_one({'material_id': 'M1'})['consumed_quantity'] == 6.0
+
+
+def test_return_moves_fifo_position_back(app, db, flour):
+    sell(app, 8.0, 'ORD-1')
+    assert app['apply_inventory_movement'](pd.Series({'M1': 8.0}), kind='return', ref='ORD-1')[0]
+
+    assert sell(app, 10.0, 'ORD-2') == 1000.0
+
+
+def test_costing_method_is_a_shop_setting(app, db):
+    assert app['costing_method']() == 'standard'
+
+    app['set_shop_setting']('costing_method', 'fifo')
+
+    other = load_app()
+    other['st'].session_state.mongo_client = app['st'].session_state.mongo_client
+    other['st'].session_state.mongo_db = db
+    assert other['costing_method']() == 'fifo'
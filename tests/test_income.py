@@ -0,0 +1,66 @@
+"""Daily income from the costs recorded on each order when it was sold"""
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def shop(app):
+    st = app['st']
+    st.session_state.products = pd.DataFrame({
+        'product_id': ['P1'], 'name': ['Bánh mì'], 'price': [20000], 'category': ['Mì'], 'unit': ['cái'],
+    })
+    st.session_state.product_costs = pd.DataFrame({
+        'product_id': ['P1'], 'material_cost': [0.0], 'production_fee': [0.0], 'other_fee': [1000.0],
+        'Depreciation_fee': [500.0], 'total_cost': [1500.0], 'price': [20000],
+    })
+    st.session_state.orders = pd.DataFrame({
+        'order_id': ['O1', 'O2'], 'date': ['2026-03-01', '2026-03-02'], 'customer_name': ['An', 'Bình'],
+        'total_amount': [40000, 20000],
+        'material_cost': [8000.0, 4000.0], 'other_fee': [2000.0, 1000.0], 'Depreciation_fee': [1000.0, 500.0],
+    })
+    st.session_state.order_items = pd.DataFrame({
+        'order_id': ['O1', 'O2'], 'product_id': ['P1', 'P1'], 'quantity': [2, 1],
+        'price': [20000, 20000], 'subtotal': [40000, 20000],
+    })
+    st.session_state.invoices = pd.DataFrame({
+        'invoice_id': ['I1', 'I2'], 'order_id': ['O1', 'O2'], 'payment_method': ['Tiền mặt', 'Tiền mặt'],
+    })
+    # The other tables of the order page start empty, like on a new install
+    for name in app['PAGE_TABLES']['Quản lý Đơn hàng']:
+        app['get_table'](name)
+    return st.session_state
+
+
+def income_by_day(state):
+    return state.income.set_index('date')[['cost_of_goods', 'other_costs', 'depreciation_costs', 'profit']].to_dict('index')
+
+
+def test_rebuild_uses_costs_recorded_on_orders(app, shop):
+    # Fees changed after the orders were sold
+    shop.product_costs.loc[0, ['other_fee', 'Depreciation_fee']] = [3000.0, 2000.0]
+
+    app['rebuild_income']()
+
+    assert income_by_day(shop) == {
+        '2026-03-01': {'cost_of_goods': 8000.0, 'other_costs': 2000.0, 'depreciation_costs': 1000.0, 'profit': 29000.0},
+        '2026-03-02': {'cost_of_goods': 4000.0, 'other_costs': 1000.0, 'depreciation_costs': 500.0, 'profit': 14500.0},
+    }
+
+
+def test_rebuild_keeps_days_of_orders_without_recorded_costs(app, shop):
+    app['rebuild_income']()
+    before = income_by_day(shop)
+    shop.orders.loc[shop.orders['order_id'] == 'O1', ['material_cost', 'other_fee', 'Depreciation_fee']] = None
+    shop.product_costs.loc[0, ['other_fee', 'Depreciation_fee']] = [3000.0, 2000.0]
+
+    app['rebuild_income']()
+
+    assert income_by_day(shop) == before
+
+
+def test_order_without_recorded_costs_uses_unit_costs(app, shop):
+    shop.orders.loc[shop.orders['order_id'] == 'O2', ['other_fee', 'Depreciation_fee']] = None
+
+    rows = app['compute_income_rows'](shop.orders[shop.orders['order_id'] == 'O2'])
+
+    assert rows[['cost_of_goods', 'other_costs', 'depreciation_costs']].iloc[0].tolist() == [4000.0, 1000.0, 500.0]
@@ -0,0 +1,67 @@
+"""Stock movements applied as guarded $inc updates (apply_inventory_movement)"""
+import pandas as pd
+
+
+def stored_quantities(db):
+    return {doc['material_id']: doc['quantity'] for doc in db['materials'].find()}
+
+
+def session_quantities(app):
+    materials = app['st'].session_state.materials
+    return dict(zip(materials['material_id'], materials['quantity'].astype(float)))
+
+
+def test_issue_updates_server_session_and_ledger(app, db, materials):
+    success, short = app['apply_inventory_movement'](pd.Series({'M1': -4.0, 'M2': -1.0}), kind='sale', ref='ORD-1')
+
+    assert (success, short) == (True, [])
+    assert stored_quantities(db) == {'M1': 6.0, 'M2': 2.0}
+    assert session_quantities(app) == {'M1': 6.0, 'M2': 2.0}
+    assert not app['is_table_dirty']('materials')
+    ledger = {doc['material_id']: doc['delta'] for doc in db['stock_movements'].find({'kind': 'sale'})}
+    assert ledger == {'M1': -4.0, 'M2': -1.0}
+
+
+def test_partial_shortage_rolls_back_applied_materials(app, db, materials):
+    # Another terminal used most of M2 after this session loaded the table
+    db['materials'].update_one({'material_id': 'M2'}, {'$inc': {'quantity': -2.5}})
+
+    success, short = app['apply_inventory_movement'](pd.Series({'M1': -4.0, 'M2': -1.0}), kind='sale', ref='ORD-1')
+
+    assert (success, short) == (False, ['M2'])
+    # M1 was deducted before M2 came up short and is given back exactly once
+    assert stored_quantities(db) == {'M1': 10.0, 'M2': 0.5}
+    assert session_quantities(app) == {'M1': 10.0, 'M2': 0.5}
+    assert db['materials'].find_one({'material_id': 'M1'})['used_quantity'] == 0.0
+    assert db['stock_movements'].count_documents({'kind': 'sale'}) == 0
+
+
+def test_concurrent_update_is_not_applied_twice(app, db, materials):
+    # Another terminal sells 3 of M1: this session still shows 10
+    db['materials'].update_one({'material_id': 'M1'}, {'$inc': {'quantity': -3.0}})
+
+    success, _ = app['apply_inventory_movement'](pd.Series({'M1': -2.0}), kind='sale', ref='ORD-2')
+
+    assert success
+    assert stored_quantities(db)['M1'] == 5.0
+    assert session_quantities(app)['M1'] == 5.0
+
+
+def test_shortage_in_session_sends_nothing(app, db, materials):
+    success, short = app['apply_inventory_movement'](pd.Series({'M2': -5.0}), kind='waste')
+
+    assert (success, short) == (False, ['M2'])
+    assert stored_quantities(db) == {'M1': 10.0, 'M2': 3.0}
+
+
+def test_material_not_stored_yet_changes_in_session_only(app, db, materials):
+    st = app['st']
+    st.session_state.materials = pd.concat([st.session_state.materials, pd.DataFrame([
+        {'material_id': 'M3', 'name': 'Bơ', 'unit': 'g', 'quantity': 1.0, 'price_per_unit': 5, 'used_quantity': 0.0}
+    ])], ignore_index=True)
+
+    success, _ = app['apply_inventory_movement'](pd.Series({'M3': 2.0}), kind='return')
+
+    assert success
+    assert session_quantities(app)['M3'] == 3.0
+    assert 'M3' not in stored_quantities(db)
@@ -0,0 +1,59 @@
+"""Prefix-sum index over a table loaded in the session (PrefixSumIndex / get_prefix_index)"""
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def expenses(app):
+    st = app['st']
+    st.session_state.family_expenses = pd.DataFrame({
+        'date': ['2026-01-01', '2026-01-02', '2026-01-03', '2026-01-05'],
+        'type': ['Chi', 'Chi', 'Thu', 'Chi'],
+        'amount': [100, 200, 1000, 400],
+    })
+    return st.session_state.family_expenses
+
+
+def index_of(app):
+    return app['get_prefix_index']('family_expenses', ['amount'], ['type'])
+
+
+def test_range_totals_per_category(app, expenses):
+    index = index_of(app)
+
+    assert index.total('2026-01-02', '2026-01-05', type='Chi')['amount'] == 600
+    assert index.total(type='Thu')['amount'] == 1000
+    assert list(index.range_totals(['2026-01-01', '2026-01-04'], ['2026-01-03', '2026-01-31'])[:, 0]) == [1300, 400]
+
+
+def test_rerun_hashes_only_the_last_indexed_row(app, expenses, monkeypatch):
+    index = index_of(app)
+    hashed = []
+    row_hash = type(index)._row_hash
+    monkeypatch.setattr(type(index), '_row_hash', lambda self, df: hashed.append(len(df)) or row_hash(self, df))
+
+    index_of(app)
+    st = app['st']
+    st.session_state.family_expenses = pd.concat([expenses, pd.DataFrame([
+        {'date': '2026-01-06', 'type': 'Chi', 'amount': 50}
+    ])], ignore_index=True)
+    index = index_of(app)
+
+    assert max(hashed) == 1
+    assert index.total(type='Chi')['amount'] == 750
+
+
+def test_saved_edit_in_the_middle_of_the_table(app, expenses):
+    index_of(app)
+    st = app['st']
+    expenses.at[1, 'amount'] = 250
+    app['save_dataframe'](expenses, 'family_expenses.csv')
+
+    index = index_of(app)
+
+    assert index.total('2026-01-02', '2026-01-02', type='Chi')['amount'] == 250
+    assert index.total(type='Chi')['amount'] == 750
+    # Deleting a row in the middle is picked up the same way
+    app['save_dataframe'](expenses.drop(index=2).reset_index(drop=True), 'family_expenses.csv')
+    assert index_of(app).total()['amount'] == 750
+    assert st.session_state.family_expenses['amount'].sum() == 750
@@ -0,0 +1,81 @@
+"""Production mix planner: MILP with a greedy fallback (optimize_production_mix)"""
+import sys
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def bakery(app):
+    """10 flour (M1). P1 (margin 3) uses 2 flour, P2 (margin 7) uses 6, P3 (margin 1) uses none."""
+    st = app['st']
+    st.session_state.materials = pd.DataFrame({
+        'material_id': ['M1'], 'name': ['Bột'], 'unit': ['g'], 'quantity': [10.0], 'price_per_unit': [0.0],
+        'used_quantity': [0.0],
+    })
+    st.session_state.products = pd.DataFrame({
+        'product_id': ['P1', 'P2', 'P3'], 'name': ['Bánh mì', 'Bánh kem', 'Trà'],
+        'price': [3, 7, 1], 'category': ['', '', ''], 'unit': ['cái', 'cái', 'ly'],
+    })
+    st.session_state.recipes = pd.DataFrame({
+        'product_id': ['P1', 'P2'], 'material_id': ['M1', 'M1'], 'quantity': [2.0, 6.0],
+    })
+    return st.session_state
+
+
+def quantities(plan):
+    return plan['quantity'].astype(int).to_dict()
+
+
+def test_milp_finds_the_optimal_mix(app, bakery):
+    pytest.importorskip('scipy.optimize')
+
+    plan, info = app['optimize_production_mix'](['P1', 'P2', 'P3'], min_quantities={'P3': 2})
+
+    assert quantities(plan) == {'P1': 5, 'P2': 0, 'P3': 2}
+    assert plan['margin'].sum() == 17
+    assert info == {'method': 'milp', 'status': 0, 'reason': 'optimal'}
+
+
+def test_greedy_without_scipy(app, bakery, monkeypatch):
+    monkeypatch.setitem(sys.modules, 'scipy.optimize', None)
+
+    plan, info = app['optimize_production_mix'](['P1', 'P2'])
+
+    # Highest margin first: one P2, then two P1 with the flour left
+    assert quantities(plan) == {'P1': 2, 'P2': 1}
+    assert info == {'method': 'greedy', 'status': None, 'reason': 'no_scipy'}
+
+
+def fake_milp(status, x):
+    return lambda **kwargs: types.SimpleNamespace(status=status, x=None if x is None else np.array(x, dtype=float))
+
+
+def test_time_limited_solution_is_not_reported_optimal(app, bakery, monkeypatch):
+    scipy_optimize = pytest.importorskip('scipy.optimize')
+    monkeypatch.setattr(scipy_optimize, 'milp', fake_milp(1, [2.0, 1.0]))
+
+    plan, info = app['optimize_production_mix'](['P1', 'P2'])
+
+    assert quantities(plan) == {'P1': 2, 'P2': 1}
+    assert info == {'method': 'milp', 'status': 1, 'reason': 'time_limit'}
+
+
+def test_greedy_when_milp_has_no_solution(app, bakery, monkeypatch):
+    scipy_optimize = pytest.importorskip('scipy.optimize')
+    monkeypatch.setattr(scipy_optimize, 'milp', fake_milp(2, None))
+
+    plan, info = app['optimize_production_mix'](['P1', 'P2'])
+
+    assert quantities(plan) == {'P1': 2, 'P2': 1}
+    assert info == {'method': 'greedy', 'status': 2, 'reason': 'no_solution'}
+    assert set(app['PRODUCTION_PLAN_REASONS']) >= {'optimal', 'time_limit', 'no_solution', 'no_scipy', 'no_products'}
+
+
+def test_minimum_quantities_beyond_stock(app, bakery):
+    plan, message = app['optimize_production_mix'](['P1', 'P2'], min_quantities={'P2': 2})
+
+    assert plan is None
+    assert message == "Tồn kho không đủ cho số lượng tối thiểu đã chọn"
@@ -0,0 +1,62 @@
+"""Multi-level recipes: preparation cycles and the bill of materials (explode_recipes / get_bom)"""
+import pandas as pd
+import pytest
+
+
+def preparation_items(rows):
+    return pd.DataFrame(rows, columns=['prep_id', 'component_id', 'quantity'])
+
+
+@pytest.fixture
+def recipes(app):
+    """P1 = 1 FILL + 0.5 M1; FILL (yield 1) = 1 DOUGH + 2 M3; DOUGH (yield 2) = 3 M1 + 1 M2"""
+    st = app['st']
+    st.session_state.recipes = pd.DataFrame({
+        'product_id': ['P1', 'P1', 'P2'], 'material_id': ['FILL', 'M1', 'M2'], 'quantity': [1.0, 0.5, 4.0],
+    })
+    st.session_state.preparations = pd.DataFrame({
+        'prep_id': ['DOUGH', 'FILL'], 'name': ['Bột nhào', 'Nhân'], 'unit': ['g', 'g'], 'yield_quantity': [2.0, 1.0],
+    })
+    st.session_state.preparation_items = preparation_items([
+        ('DOUGH', 'M1', 3.0), ('DOUGH', 'M2', 1.0), ('FILL', 'DOUGH', 1.0), ('FILL', 'M3', 2.0),
+    ])
+    return st.session_state
+
+
+def test_find_preparation_cycle(app):
+    find_cycle = app['find_preparation_cycle']
+
+    cycle = find_cycle(preparation_items([('A', 'B', 1), ('B', 'C', 1), ('C', 'A', 1), ('C', 'M1', 1)]))
+    assert cycle[0] == cycle[-1] and set(cycle) == {'A', 'B', 'C'}
+    assert find_cycle(preparation_items([('A', 'A', 1)])) == ['A', 'A']
+    assert find_cycle(preparation_items([('A', 'B', 1), ('A', 'C', 1), ('B', 'C', 1)])) is None
+
+
+def test_nested_preparations_explode_to_raw_materials(app, recipes):
+    flat, compositions = app['explode_recipes']()
+
+    assert compositions['DOUGH'] == {'M1': 1.5, 'M2': 0.5}
+    assert compositions['FILL'] == {'M1': 1.5, 'M2': 0.5, 'M3': 2.0}
+    bom = app['get_bom']()
+    assert bom.loc['P1'].to_dict() == {'M1': 2.0, 'M2': 0.5, 'M3': 2.0}
+    assert bom.loc['P2'].to_dict() == {'M1': 0.0, 'M2': 4.0, 'M3': 0.0}
+    assert set(flat['material_id']) == {'M1', 'M2', 'M3'}
+
+
+def test_bom_follows_changed_preparation(app, recipes):
+    app['get_bom']()
+    recipes.preparation_items = preparation_items([
+        ('DOUGH', 'M1', 4.0), ('DOUGH', 'M2', 1.0), ('FILL', 'DOUGH', 1.0), ('FILL', 'M3', 2.0),
+    ])
+
+    assert app['get_bom']().at['P1', 'M1'] == 2.5
+
+
+def test_stored_cycle_does_not_recurse_forever(app, recipes):
+    recipes.preparation_items = preparation_items([
+        ('DOUGH', 'FILL', 1.0), ('DOUGH', 'M2', 1.0), ('FILL', 'DOUGH', 1.0), ('FILL', 'M3', 2.0),
+    ])
+
+    _, compositions = app['explode_recipes']()
+
+    assert compositions['FILL']['M3'] == 2.0
@@ -0,0 +1,83 @@
+"""Sales cube kept per day from the order write paths (refresh_sales_cube_days / cube_query)"""
+import pandas as pd
+import pytest
+
+from conftest import load_app
+
+
+@pytest.fixture
+def sales(app):
+    st = app['st']
+    st.session_state.products = pd.DataFrame({
+        'product_id': ['P1', 'P2'], 'name': ['Bánh mì', 'Bánh bông lan'],
+        'price': [20000, 50000], 'category': ['Mì', 'Ngọt'], 'unit': ['cái', 'cái'],
+    })
+    st.session_state.orders = pd.DataFrame({
+        'order_id': ['O1', 'O2', 'O3'],
+        'date': ['2026-03-01', '2026-03-01', '2026-03-02'],
+        'customer_name': ['An', 'Bình', 'An'],
+    })
+    st.session_state.order_items = pd.DataFrame({
+        'order_id': ['O1', 'O1', 'O2', 'O3'],
+        'product_id': ['P1', 'P2', 'P1', 'P2'],
+        'quantity': [2, 1, 3, 1],
+        'price': [20000, 50000, 20000, 50000],
+        'subtotal': [40000, 50000, 60000, 50000],
+    })
+    st.session_state.invoices = pd.DataFrame({
+        'invoice_id': ['I1', 'I2', 'I3'],
+        'order_id': ['O1', 'O2', 'O3'],
+        'payment_method': ['Tiền mặt', 'Chuyển khoản', 'Tiền mặt'],
+    })
+    app['rebuild_sales_cube']()
+    return st.session_state
+
+
+def revenue_by(app, dimension, **kwargs):
+    result = app['cube_query']([dimension], measures=['revenue'], **kwargs)
+    return dict(zip(result[dimension], result['revenue']))
+
+
+def test_slice_and_dice(app, sales):
+    assert revenue_by(app, 'category') == {'Mì': 100000, 'Ngọt': 100000}
+    assert revenue_by(app, 'customer', payment_method='Tiền mặt') == {'An': 140000}
+    assert revenue_by(app, 'product_id', start_date='2026-03-02', end_date='2026-03-02') == {'P2': 50000}
+    assert revenue_by(app, 'month', category=['Ngọt']) == {'2026-03': 100000}
+
+
+def test_refresh_after_order_is_deleted(app, sales):
+    sales.orders = sales.orders[sales.orders['order_id'] != 'O2']
+    sales.order_items = sales.order_items[sales.order_items['order_id'] != 'O2']
+    sales.invoices = sales.invoices[sales.invoices['order_id'] != 'O2']
+
+    app['refresh_sales_cube_days'](['2026-03-01'])
+
+    assert revenue_by(app, 'customer') == {'An': 140000}
+    assert revenue_by(app, 'payment_method') == {'Tiền mặt': 140000}
+    # Only the cells of the refreshed day were rebuilt
+    assert sorted(sales.sales_cube['date'].unique()) == ['2026-03-01', '2026-03-02']
+
+
+def test_refresh_without_the_invoice_being_deleted(app, sales):
+    app['refresh_sales_cube_days'](['2026-03-02'], excluded_invoice_ids=['I3'])
+
+    assert revenue_by(app, 'date') == {'2026-03-01': 150000}
+
+
+def test_category_change_needs_no_rebuild(app, sales):
+    sales.products.loc[sales.products['product_id'] == 'P2', 'category'] = 'Bánh ngọt'
+
+    assert revenue_by(app, 'category') == {'Mì': 100000, 'Bánh ngọt': 100000}
+
+
+def test_saved_cube_is_queried_without_loading_orders(app, db, sales):
+    app['save_dataframe'](sales.products, 'products.csv')
+    app['save_dataframe'](sales.sales_cube, 'sales_cube.csv')
+
+    other = load_app()
+    other['st'].session_state.mongo_client = app['st'].session_state.mongo_client
+    other['st'].session_state.mongo_db = db
+    result = other['cube_query'](['category'], '2026-03-02', '2026-03-31', measures=['revenue', 'lines'])
+
+    assert result.to_dict('records') == [{'category': 'Ngọt', 'revenue': 50000.0, 'lines': 1}]
+    assert not {'orders', 'order_items', 'invoices', 'sales_cube'} & set(other['st'].session_state)
@@ -0,0 +1,126 @@
+"""Stock ledger: opening snapshot, snapshots on write, backdated movements and atomic ledger writes"""
+import datetime
+
+import pandas as pd
+import pymongo
+import pytest
+
+from conftest import load_app
+
+
+def stored_quantities(db):
+    return {doc['material_id']: doc['quantity'] for doc in db['materials'].find()}
+
+
+def days_ago(days):
+    return (datetime.date.today() - datetime.timedelta(days=days)).strftime('%Y-%m-%d')
+
+
+def failing_insert(*args, **kwargs):
+    raise pymongo.errors.OperationFailure('insert failed')
+
+
+def test_opening_snapshot_is_written_once_by_two_terminals(app, db, materials):
+    other = load_app()
+    other['st'].session_state.mongo_client = app['st'].session_state.mongo_client
+    other['st'].session_state.mongo_db = db
+    other['st'].session_state.materials = other['load_dataframe']('materials.csv', other['default_materials'])
+
+    app['apply_inventory_movement'](pd.Series({'M1': -1.0}), kind='sale', ref='ORD-1')
+    other['apply_inventory_movement'](pd.Series({'M2': -1.0}), kind='sale', ref='ORD-2')
+
+    snapshots = list(db['stock_snapshots'].find({}, {'_id': 0}))
+    assert {(doc['material_id'], doc['quantity']) for doc in snapshots} == {('M1', 10.0), ('M2', 3.0)}
+    assert {doc['ts'] for doc in snapshots} == {app['STOCK_LEDGER_OPENING_TS']}
+    assert app['derive_stock']().to_dict() == {'M1': 9.0, 'M2': 2.0}
+
+
+def test_backdated_movement_after_snapshot(app, db, materials):
+    app['STOCK_SNAPSHOT_INTERVAL'] = 2
+    issue = app['apply_inventory_movement']
+    issue(pd.Series({'M1': -1.0}), kind='sale', ref='ORD-1', date=days_ago(3))
+    issue(pd.Series({'M1': -1.0}), kind='sale', ref='ORD-2', date=days_ago(2))
+    # The second movement reached the interval: a snapshot of today's stock was written
+    assert db['stock_snapshots'].count_documents({'ts': {'$ne': app['STOCK_LEDGER_OPENING_TS']}}) == 2
+
+    # An order entered today for an earlier day
+    issue(pd.Series({'M1': -2.0}), kind='sale', ref='ORD-0', date=days_ago(10))
+
+    derive_stock = app['derive_stock']
+    assert derive_stock()['M1'] == 6.0
+    assert derive_stock(days_ago(0))['M1'] == 6.0
+    assert derive_stock(days_ago(3))['M1'] == 7.0
+    assert derive_stock(days_ago(10))['M1'] == 8.0
+    assert derive_stock(days_ago(11))['M1'] == 10.0
+
+
+def test_reading_stock_does_not_write_snapshots(app, db, materials):
+    app['apply_inventory_movement'](pd.Series({'M1': -1.0}), kind='sale', ref='ORD-1')
+    app['STOCK_SNAPSHOT_INTERVAL'] = 1
+    before = db['stock_snapshots'].count_documents({})
+
+    app['derive_stock']()
+
+    assert db['stock_snapshots'].count_documents({}) == before
+
+
+def test_latest_snapshot_as_of_date(app, db):
+    db['stock_snapshots'].insert_many([
+        {'ts': '2026-01-01 08:00:00.000000', 'date': '2026-01-01', 'material_id': 'M1', 'quantity': 5.0},
+        {'ts': '2026-01-03 08:00:00.000000', 'date': '2026-01-03', 'material_id': 'M1', 'quantity': 4.0},
+        {'ts': '2026-01-03 18:00:00.000000', 'date': '2026-01-03', 'material_id': 'M1', 'quantity': 3.0},
+    ])
+    latest = app['latest_stock_snapshot']
+
+    assert latest('2026-01-02')[0] == '2026-01-01 08:00:00.000000'
+    ts, stock = latest()
+    assert ts == '2026-01-03 18:00:00.000000'
+    assert stock.to_dict() == {'M1': 3.0}
+    assert latest('2025-12-31')[0] is None
+
+
+def test_ledger_failure_restores_stock(app, db, materials, monkeypatch):
+    app['apply_inventory_movement'](pd.Series({'M1': -1.0}), kind='sale', ref='ORD-1')
+    monkeypatch.setitem(app, '_insert_appended', failing_insert)
+
+    success, short = app['apply_inventory_movement'](pd.Series({'M1': -4.0, 'M2': -1.0}), kind='sale', ref='ORD-2')
+
+    assert (success, short) == (False, [])
+    assert stored_quantities(db) == {'M1': 9.0, 'M2': 3.0}
+    assert db['stock_movements'].count_documents({'ref': 'ORD-2'}) == 0
+
+
+def test_ledger_failure_restores_manual_stock_level(app, db, materials, monkeypatch):
+    app['apply_inventory_movement'](pd.Series({'M1': -1.0}), kind='sale', ref='ORD-1')
+    monkeypatch.setitem(app, '_insert_appended', failing_insert)
+
+    assert not app['set_stock_level']('M1', 20.0, 'Kiểm kê')
+    assert stored_quantities(db)['M1'] == 9.0
+
+
+def test_failed_save_removes_ledger_rows_of_the_unit_of_work(app, db, materials, monkeypatch):
+    def failing_write(*args, **kwargs):
+        raise pymongo.errors.OperationFailure('write failed')
+    monkeypatch.setitem(app, '_apply_collection_write', failing_write)
+    st = app['st']
+
+    with pytest.raises(app['SaveError']):
+        with app['unit_of_work']():
+            app['record_stock_movements'](pd.Series({'M1': 5.0}), 'import', 'NCC')
+            st.session_state.materials.loc[st.session_state.materials['material_id'] == 'M1', 'quantity'] = 15.0
+            app['save_dataframe'](st.session_state.materials, 'materials.csv')
+
+    assert db['stock_movements'].count_documents({}) == 0
+    assert stored_quantities(db)['M1'] == 10.0
+
+
+def test_removed_material_is_a_ledger_movement(app, db, materials):
+    st = app['st']
+    with app['unit_of_work']():
+        app['record_stock_movements'](pd.Series({'M2': -3.0}), 'removal', 'Đường')
+        st.session_state.materials = st.session_state.materials[st.session_state.materials['material_id'] != 'M2']
+        app['save_dataframe'](st.session_state.materials, 'materials.csv')
+
+    assert stored_quantities(db) == {'M1': 10.0}
+    assert db['stock_movements'].find_one({'material_id': 'M2'})['kind'] == 'removal'
+    assert app['derive_stock']().to_dict() == {'M1': 10.0, 'M2': 0.0}